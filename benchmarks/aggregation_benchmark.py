@@ -0,0 +1,114 @@
+"""Benchmark of the integer-coded aggregation of triplets, against the
+per-occurrence aggregation with StatsDict.from_iterable it replaced.
+
+Usage:
+    python benchmarks/aggregation_benchmark.py [--n-triplets 10000000]
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from conspiracies.corpusprocessing.aggregation import (
+    StatsDict,
+    TripletAggregator,
+    TripletStats,
+)
+from conspiracies.corpusprocessing.triplet_table import TripletTable
+
+
+def synthetic_table(n_triplets: int, seed: int = 0) -> TripletTable:
+    """Triplets with Zipf distributed entities and predicates, spread over
+    documents with timestamps in a year."""
+    rng = np.random.default_rng(seed)
+    n_entities = max(n_triplets // 20, 1)
+    n_predicates = max(n_triplets // 200, 1)
+    n_docs = max(n_triplets // 5, 1)
+    strings = [f"entity {i}" for i in range(n_entities)] + [
+        f"predicate {i}" for i in range(n_predicates)
+    ]
+
+    def zipf(n: int) -> np.ndarray:
+        return (rng.zipf(1.5, n_triplets) - 1) % n
+
+    no_heads = np.full(n_triplets, -1)
+    return TripletTable(
+        strings,
+        [f"doc {i}" for i in range(n_docs)],
+        subject=zipf(n_entities),
+        predicate=n_entities + zipf(n_predicates),
+        object=zipf(n_entities),
+        subject_head=no_heads,
+        predicate_head=no_heads,
+        object_head=no_heads,
+        doc=rng.integers(0, n_docs, n_triplets),
+        timestamp=rng.integers(1_577_836_800, 1_609_459_200, n_triplets) * 10**6,
+        utc_offset=np.zeros(n_triplets),
+    )
+
+
+def from_iterable_aggregate(table: TripletTable) -> TripletStats:
+    table = table[table.subject != table.object]
+    subjects = table.text("subject").tolist()
+    predicates = table.text("predicate").tolist()
+    objects = table.text("object").tolist()
+    docs = table.doc_ids().tolist()
+    timestamps = table.datetimes()
+    return TripletStats(
+        triplets=StatsDict.from_iterable(
+            zip(zip(subjects, predicates, objects), docs, timestamps),
+        ),
+        entities=StatsDict.from_iterable(
+            (entity, doc, timestamp)
+            for subject, obj, doc, timestamp in zip(
+                subjects,
+                objects,
+                docs,
+                timestamps,
+            )
+            for entity in [subject, obj]
+        ),
+        predicates=StatsDict.from_iterable(zip(predicates, docs, timestamps)),
+    )
+
+
+def main(n_triplets: int, reference: bool) -> None:
+    table = synthetic_table(n_triplets)
+
+    start = time.perf_counter()
+    stats = TripletAggregator().aggregate(table)
+    grouped_time = time.perf_counter() - start
+    print(
+        f"{n_triplets} triplets, {len(stats.triplets)} unique triplets, "
+        f"{len(stats.entities)} entities: integer-coded {grouped_time:.1f}s",
+    )
+
+    if reference:
+        start = time.perf_counter()
+        expected = from_iterable_aggregate(table)
+        reference_time = time.perf_counter() - start
+        for name in ("triplets", "entities", "predicates"):
+            for key, entry in getattr(expected, name).items():
+                assert sorted(entry["docs"]) == sorted(
+                    getattr(stats, name)[key]["docs"],
+                )
+                entry["docs"] = getattr(stats, name)[key]["docs"]
+        assert stats == expected
+        print(
+            f"from_iterable {reference_time:.1f}s "
+            f"({reference_time / grouped_time:.1f}x)",
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--n-triplets", type=int, default=10_000_000)
+    parser.add_argument(
+        "--no-reference",
+        dest="reference",
+        action="store_false",
+        help="Skip the slow from_iterable aggregation.",
+    )
+    args = parser.parse_args()
+    main(args.n_triplets, args.reference)
@@ -0,0 +1,81 @@
+"""Benchmark of merging clusters that share members with union-find, against
+the all-pairs networkx graph it replaced.
+
+Usage:
+    python benchmarks/combine_clusters_benchmark.py [--n-clusters 5000]
+"""
+
+import argparse
+import random
+import time
+from collections import defaultdict
+
+import networkx
+
+from conspiracies.corpusprocessing.clustering import Clustering
+
+
+def networkx_combine_clusters(clusters, get_combine_key=lambda x: x):
+    matches = defaultdict(set)
+    for i, cluster in enumerate(clusters):
+        for member in cluster:
+            key = get_combine_key(member)
+            if key:
+                matches[key].add(i)
+
+    graph = networkx.Graph()
+    graph.add_nodes_from(range(len(clusters)))
+    for match in matches.values():
+        for i in match:
+            for j in match:
+                if i != j:
+                    graph.add_edge(i, j)
+
+    # order components and their clusters by index for comparison
+    components = sorted(sorted(c) for c in networkx.connected_components(graph))
+    return [
+        [member for i in component for member in clusters[i]]
+        for component in components
+    ]
+
+
+def synthetic_clusters(n_clusters: int, n_strings: int, n_common: int, seed: int = 0):
+    """Clusters of random strings, where a few common strings appear in many
+    clusters, like frequent entities do."""
+    rng = random.Random(seed)
+    common = [f"common {i}" for i in range(n_common)]
+    clusters = []
+    for _ in range(n_clusters):
+        size = rng.randint(2, 30)
+        members = [f"string {rng.randrange(n_strings)}" for _ in range(size)]
+        if rng.random() < 0.3:
+            members.append(rng.choice(common))
+        clusters.append(members)
+    return clusters
+
+
+def main(n_clusters: int) -> None:
+    for n_strings, n_common in [(n_clusters * 100, 5), (n_clusters * 10, 50)]:
+        clusters = synthetic_clusters(n_clusters, n_strings, n_common)
+
+        start = time.perf_counter()
+        expected = networkx_combine_clusters(clusters)
+        networkx_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        merged = Clustering._combine_clusters(clusters)
+        union_find_time = time.perf_counter() - start
+
+        assert merged == expected
+        print(
+            f"{n_clusters} clusters, {len(merged)} after merging: "
+            f"networkx {networkx_time:.3f}s, union-find {union_find_time:.3f}s "
+            f"({networkx_time / union_find_time:.1f}x)",
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--n-clusters", type=int, default=5000)
+    args = parser.parse_args()
+    main(args.n_clusters)
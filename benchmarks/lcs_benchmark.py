@@ -0,0 +1,68 @@
+"""Micro-benchmark of the longest common substring size used by the overlap
+metrics of the relation extraction, against the SequenceMatcher based
+implementation it replaced.
+
+Usage:
+    python benchmarks/lcs_benchmark.py [--n-texts 300] [--repeat 3]
+"""
+
+import argparse
+import random
+import string
+import timeit
+from difflib import SequenceMatcher
+
+from conspiracies.docprocessing.relationextraction.data_classes import (
+    _lcs_size,
+    lcs_size_matrix,
+)
+
+
+def sequence_matcher_lcs_size(a, b) -> int:
+    return SequenceMatcher(None, a, b).find_longest_match().size
+
+
+def random_texts(n_texts: int, min_length: int, max_length: int):
+    alphabet = string.ascii_lowercase[:8] + " "
+    return [
+        "".join(random.choices(alphabet, k=random.randint(min_length, max_length)))
+        for _ in range(n_texts)
+    ]
+
+
+def main(n_texts: int, repeat: int) -> None:
+    random.seed(0)
+    for min_length, max_length in [(2, 20), (20, 80), (80, 250)]:
+        texts = random_texts(n_texts, min_length, max_length)
+        a, b = texts[: n_texts // 2], texts[n_texts // 2 :]
+        pairs = [(a_i, b_j) for a_i in a for b_j in b]
+
+        def run_sequence_matcher():
+            return [sequence_matcher_lcs_size(x, y) for x, y in pairs]
+
+        def run_bit_parallel():
+            return [_lcs_size(x, y) for x, y in pairs]
+
+        def run_matrix():
+            return lcs_size_matrix(a, b)
+
+        timings = {
+            name: min(timeit.repeat(fn, number=1, repeat=repeat))
+            for name, fn in [
+                ("SequenceMatcher", run_sequence_matcher),
+                ("_lcs_size", run_bit_parallel),
+                ("lcs_size_matrix", run_matrix),
+            ]
+        }
+        print(f"{len(pairs)} pairs of length {min_length}-{max_length}:")
+        for name, seconds in timings.items():
+            speedup = timings["SequenceMatcher"] / seconds
+            print(f"  {name:<16} {seconds:8.3f}s  {speedup:5.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--n-texts", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    main(args.n_texts, args.repeat)
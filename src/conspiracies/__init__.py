@@ -2,4 +2,5 @@ from .registry import registry  # noqa F401
 from conspiracies.docprocessing.doc_utils import (
     docs_from_jsonl,  # noqa F401
     docs_to_jsonl,  # noqa F401
+    iter_docs_from_jsonl,  # noqa F401
 )
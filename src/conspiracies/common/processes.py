@@ -0,0 +1,11 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+
+def spawn_pool(max_workers: int) -> ProcessPoolExecutor:
+    """A process pool whose workers are spawned rather than forked.
+
+    Forking a process with running thread pools, e.g. of torch or numba,
+    can deadlock the child, so all worker processes are started with spawn.
+    """
+    return ProcessPoolExecutor(max_workers, mp_context=get_context("spawn"))
@@ -0,0 +1,53 @@
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict, Iterable, Tuple, Union
+
+
+class SQLiteStore:
+    """A persistent key-value store in a table of an SQLite database.
+
+    Args:
+        path: Path to the SQLite database file. It is created if it does not exist.
+        table: The name of the table holding the values.
+    """
+
+    def __init__(self, path: Union[str, Path], table: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.table = table
+        self._connection = sqlite3.connect(self.path)
+        with self._connection:
+            self._connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                "(key TEXT PRIMARY KEY, value NOT NULL)",
+            )
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Get the values of the keys that are in the store."""
+        keys = list(set(keys))
+        values = {}
+        # stay below the maximum number of SQL variables
+        for i in range(0, len(keys), 500):
+            chunk = keys[i : i + 500]
+            rows = self._connection.execute(
+                f"SELECT key, value FROM {self.table} "
+                f"WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            values.update(rows)
+        return values
+
+    def set_many(self, items: Iterable[Tuple[str, Any]]) -> None:
+        """Store (key, value) pairs, replacing the values of existing keys."""
+        with self._connection:
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)",
+                items,
+            )
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __len__(self) -> int:
+        query = f"SELECT COUNT(*) FROM {self.table}"
+        return self._connection.execute(query).fetchone()[0]
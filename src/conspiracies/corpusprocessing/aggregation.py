@@ -1,5 +1,7 @@
+import zlib
 from collections import Counter, defaultdict
 from datetime import datetime
+from pathlib import Path
 from typing import (
     List,
     TypedDict,
@@ -13,10 +15,19 @@ from typing import (
     Mapping,
 )
 
+import numpy as np
 from pydantic import BaseModel
 
 from conspiracies.corpusprocessing.clustering import Mappings
-from conspiracies.corpusprocessing.triplet import Triplet, TripletField
+from conspiracies.corpusprocessing.triplet import Triplet
+from conspiracies.corpusprocessing.triplet_table import (
+    MISSING,
+    StringPool,
+    TripletTable,
+    isoformats,
+    pack_strings,
+    unpack_strings,
+)
 
 
 def min_max_normalizer(values: Iterable[Union[int, float]]) -> Callable[[float], float]:
@@ -29,11 +40,26 @@ def min_max_normalizer(values: Iterable[Union[int, float]]) -> Callable[[float],
     return lambda x: (x - min_value) / (max_value - min_value)
 
 
+def group_by_first_occurrence(codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Group integer codes, numbering the groups in order of first occurrence.
+
+    Returns:
+        The index of the first occurrence of each group, and the group of each
+            code.
+    """
+    _, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind="stable")
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return first[order], rank[inverse.reshape(-1)]
+
+
 class StatsEntry(TypedDict):
     key: Union[str, Tuple[str]]
     frequency: int
     norm_frequency: float
     docs: Optional[list[str]]
+    n_docs: int
     first_occurrence: Optional[datetime]
     last_occurrence: Optional[datetime]
     alt_labels: Optional[list[str]]
@@ -78,6 +104,7 @@ class StatsDict(Dict[str, StatsEntry]):
                     frequency=value,
                     norm_frequency=normalizer(value),
                     docs=list(docs[key]) if key in docs else None,
+                    n_docs=len(docs[key]) if key in docs else 0,
                     first_occurrence=(
                         first_occurrence[key].isoformat()
                         if key in first_occurrence
@@ -96,6 +123,352 @@ class StatsDict(Dict[str, StatsEntry]):
             },
         )
 
+    @classmethod
+    def from_groups(
+        cls,
+        keys: List[Any],
+        groups: np.ndarray,
+        rows: np.ndarray,
+        table: TripletTable,
+        alt_labels: Mapping[str, list[str]] = None,
+    ):
+        """Like `from_iterable`, for occurrences grouped by integer codes. See
+        `PartialStatsDict.from_groups`."""
+        return PartialStatsDict.from_groups(keys, groups, rows, table).finalize(
+            alt_labels,
+        )
+
+
+def first_and_last(
+    groups: np.ndarray,
+    timestamps: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Find the first and last occurrence of each group by timestamp. Like min
+    and max in `StatsDict.from_iterable`, the later of tied occurrences is
+    both first and last.
+
+    Returns:
+        The groups that occur, and the index of their first and last occurrence.
+    """
+    # sort by group and timestamp, keeping the order of occurrence on ties
+    order = np.lexsort((timestamps, groups))
+    sorted_groups, timestamps = groups[order], timestamps[order]
+    ends = np.flatnonzero(np.diff(sorted_groups, append=-1))
+    # the first occurrence ends the first run of equal timestamps in a group
+    run_ends = np.flatnonzero(
+        np.diff(sorted_groups, append=-1) | np.diff(timestamps, append=-1),
+    )
+    starts = np.append(0, ends[:-1] + 1)[: len(ends)]
+    first_ends = run_ends[np.searchsorted(run_ends, starts)]
+    return sorted_groups[ends], order[first_ends], order[ends]
+
+
+class PartialStatsDict:
+    """The mergeable state of a StatsDict, aggregated from a part of a corpus.
+
+    Partial aggregates of shards of a corpus, e.g. months, can be combined
+    into the aggregate of the whole corpus: frequencies are added, doc sets
+    are joined and the first and last occurrences are the earliest and latest
+    ones. Normalized frequencies and alternative labels are only added by
+    `finalize`, as they depend on the whole corpus.
+
+    Args:
+        keys: The unique keys, in order of first occurrence.
+        frequencies: The frequency of each key.
+        docs: The doc ids that occur.
+        doc_bounds: The docs of key i are docs[doc_indices[doc_bounds[i] :
+            doc_bounds[i + 1]]].
+        doc_indices: The indices of the docs of each key, sorted by key.
+        first_timestamp: The first occurrence of each key, encoded like the
+            timestamps of a TripletTable.
+        first_offset: The UTC offset of the first occurrence of each key.
+        last_timestamp: The last occurrence of each key.
+        last_offset: The UTC offset of the last occurrence of each key.
+    """
+
+    arrays = (
+        "frequencies",
+        "doc_bounds",
+        "doc_indices",
+        "first_timestamp",
+        "first_offset",
+        "last_timestamp",
+        "last_offset",
+    )
+
+    def __init__(
+        self,
+        keys: List[Any],
+        frequencies: np.ndarray,
+        docs: List[str],
+        doc_bounds: np.ndarray,
+        doc_indices: np.ndarray,
+        first_timestamp: np.ndarray,
+        first_offset: np.ndarray,
+        last_timestamp: np.ndarray,
+        last_offset: np.ndarray,
+    ):
+        self.keys = keys
+        self.frequencies = np.asarray(frequencies, dtype=np.int64)
+        self.docs = docs
+        self.doc_bounds = np.asarray(doc_bounds, dtype=np.int64)
+        self.doc_indices = np.asarray(doc_indices, dtype=np.int32)
+        self.first_timestamp = np.asarray(first_timestamp, dtype=np.int64)
+        self.first_offset = np.asarray(first_offset, dtype=np.int16)
+        self.last_timestamp = np.asarray(last_timestamp, dtype=np.int64)
+        self.last_offset = np.asarray(last_offset, dtype=np.int16)
+
+    @classmethod
+    def _from_occurrences(
+        cls,
+        keys: List[Any],
+        groups: np.ndarray,
+        frequencies: np.ndarray,
+        docs: List[str],
+        doc_groups: np.ndarray,
+        doc_indices: np.ndarray,
+        first: Tuple[np.ndarray, np.ndarray, np.ndarray],
+        last: Tuple[np.ndarray, np.ndarray, np.ndarray],
+    ) -> "PartialStatsDict":
+        """Aggregate occurrences of the groups of keys, each with a frequency,
+        a doc and a first and last timestamp and UTC offset. Docs and
+        timestamps are given separately for the occurrences that have them."""
+        n_groups = len(keys)
+        n_docs = max(len(docs), 1)
+        total_frequencies = np.bincount(
+            groups,
+            weights=frequencies,
+            minlength=n_groups,
+        ).astype(np.int64)
+
+        # the unique (group, doc) pairs, sorted by group, of the docs that occur
+        pairs = np.unique(doc_groups * n_docs + doc_indices)
+        doc_groups, doc_indices = np.divmod(pairs, n_docs)
+        used_docs, doc_indices = np.unique(doc_indices, return_inverse=True)
+
+        first_groups, first_index, _ = first_and_last(first[0], first[1])
+        last_groups, _, last_index = first_and_last(last[0], last[1])
+        first_timestamp = np.zeros(n_groups, dtype=np.int64)
+        first_timestamp[first_groups] = first[1][first_index]
+        first_offset = np.full(n_groups, MISSING, dtype=np.int16)
+        first_offset[first_groups] = first[2][first_index]
+        last_timestamp = np.zeros(n_groups, dtype=np.int64)
+        last_timestamp[last_groups] = last[1][last_index]
+        last_offset = np.full(n_groups, MISSING, dtype=np.int16)
+        last_offset[last_groups] = last[2][last_index]
+
+        return cls(
+            keys=keys,
+            frequencies=total_frequencies,
+            docs=[docs[i] for i in used_docs.tolist()],
+            doc_bounds=np.searchsorted(doc_groups, np.arange(n_groups + 1)),
+            doc_indices=doc_indices.reshape(-1),
+            first_timestamp=first_timestamp,
+            first_offset=first_offset,
+            last_timestamp=last_timestamp,
+            last_offset=last_offset,
+        )
+
+    @classmethod
+    def from_groups(
+        cls,
+        keys: List[Any],
+        groups: np.ndarray,
+        rows: np.ndarray,
+        table: TripletTable,
+    ) -> "PartialStatsDict":
+        """Aggregate occurrences grouped by integer codes.
+
+        Args:
+            keys: The key of each group, in order of first occurrence.
+            groups: The group of each occurrence.
+            rows: The row of the table each occurrence is in, which holds its
+                doc and timestamp.
+            table: The table of triplets.
+        """
+        docs = table.doc[rows]
+        has_doc = np.array([bool(doc) for doc in table.docs] + [False])[docs]
+        timestamped = table.utc_offset[rows] != MISSING
+        occurrences = (
+            groups[timestamped],
+            table.timestamp[rows[timestamped]],
+            table.utc_offset[rows[timestamped]],
+        )
+        return cls._from_occurrences(
+            keys,
+            groups,
+            np.ones(len(groups), dtype=np.int64),
+            table.docs,
+            groups[has_doc],
+            docs[has_doc],
+            occurrences,
+            occurrences,
+        )
+
+    @classmethod
+    def combine(cls, partials: Iterable["PartialStatsDict"]) -> "PartialStatsDict":
+        """Combine partial aggregates. Given in the order of the shards, keys
+        stay in order of first occurrence and ties between first and last
+        occurrences are resolved as if the shards were aggregated together."""
+        partials = list(partials)
+        key_ids: Dict[Any, int] = {}
+        docs = StringPool()
+        columns = defaultdict(list)
+        for partial in partials:
+            group = np.array(
+                [key_ids.setdefault(key, len(key_ids)) for key in partial.keys],
+                dtype=np.int64,
+            )
+            doc_ids = np.array([docs.add(doc) for doc in partial.docs], dtype=np.int64)
+            columns["groups"].append(group)
+            columns["frequencies"].append(partial.frequencies)
+            columns["doc_groups"].append(np.repeat(group, np.diff(partial.doc_bounds)))
+            columns["doc_indices"].append(doc_ids[partial.doc_indices])
+            for name in ("first", "last"):
+                timestamp = getattr(partial, f"{name}_timestamp")
+                offset = getattr(partial, f"{name}_offset")
+                has_timestamp = offset != MISSING
+                columns[f"{name}_groups"].append(group[has_timestamp])
+                columns[f"{name}_timestamp"].append(timestamp[has_timestamp])
+                columns[f"{name}_offset"].append(offset[has_timestamp])
+
+        def concatenate(name: str) -> np.ndarray:
+            return np.concatenate([np.empty(0, dtype=np.int64)] + columns[name])
+
+        return cls._from_occurrences(
+            list(key_ids),
+            concatenate("groups"),
+            concatenate("frequencies"),
+            docs.strings,
+            concatenate("doc_groups"),
+            concatenate("doc_indices"),
+            (
+                concatenate("first_groups"),
+                concatenate("first_timestamp"),
+                concatenate("first_offset"),
+            ),
+            (
+                concatenate("last_groups"),
+                concatenate("last_timestamp"),
+                concatenate("last_offset"),
+            ),
+        )
+
+    def merge(self, other: "PartialStatsDict") -> "PartialStatsDict":
+        return self.combine([self, other])
+
+    def sample_docs(self, max_docs: int) -> Tuple[np.ndarray, np.ndarray]:
+        """A sample of at most max_docs docs of each key, as doc bounds and doc
+        indices like the full doc membership.
+
+        The sample of a key is its docs with the smallest CRC32 hashes of
+        their ids. It is not a random sample like a reservoir sample: it is
+        deterministic per doc id, so a doc with a small hash is listed for
+        every key it belongs to, and the sample does not depend on the order
+        of the docs, so it is the same for a corpus and for its combined
+        shards.
+        """
+        counts = np.diff(self.doc_bounds)
+        if not np.any(counts > max_docs):
+            return self.doc_bounds, self.doc_indices
+        hashes = np.array(
+            [zlib.crc32(doc.encode("utf-8")) for doc in self.docs],
+            dtype=np.int64,
+        )
+        groups = np.repeat(np.arange(len(self)), counts)
+        order = np.lexsort((self.doc_indices, hashes[self.doc_indices], groups))
+        rank = np.arange(len(order)) - np.repeat(self.doc_bounds[:-1], counts)
+        sample = np.sort(order[rank < max_docs])
+        return (
+            np.searchsorted(groups[sample], np.arange(len(self) + 1)),
+            self.doc_indices[sample],
+        )
+
+    def finalize(
+        self,
+        alt_labels: Mapping[str, list[str]] = None,
+        max_docs: int = None,
+    ) -> StatsDict:
+        """The StatsDict of the aggregate, with normalized frequencies.
+
+        Args:
+            alt_labels: The alternative labels of keys.
+            max_docs: The maximum number of docs listed for each key, see
+                `sample_docs`. n_docs is the number of all the docs of a key.
+        """
+        frequencies = self.frequencies.tolist()
+        normalizer = min_max_normalizer(frequencies) if frequencies else None
+        n_docs = np.diff(self.doc_bounds).tolist()
+        doc_bounds, doc_indices = (
+            (self.doc_bounds, self.doc_indices)
+            if max_docs is None
+            else self.sample_docs(max_docs)
+        )
+        doc_bounds = doc_bounds.tolist()
+        doc_names = np.array(self.docs, dtype=object)[doc_indices].tolist()
+        first_occurrences = isoformats(self.first_timestamp, self.first_offset)
+        last_occurrences = isoformats(self.last_timestamp, self.last_offset)
+        return StatsDict(
+            {
+                key: StatsEntry(
+                    key=key,
+                    frequency=frequency,
+                    norm_frequency=normalizer(frequency),
+                    docs=doc_names[doc_bounds[i] : doc_bounds[i + 1]] or None,
+                    n_docs=n_docs[i],
+                    first_occurrence=first_occurrence,
+                    last_occurrence=last_occurrence,
+                    alt_labels=(
+                        alt_labels[key] if alt_labels and key in alt_labels else None
+                    ),
+                )
+                for i, (key, frequency, first_occurrence, last_occurrence) in (
+                    enumerate(
+                        zip(
+                            self.keys,
+                            frequencies,
+                            first_occurrences,
+                            last_occurrences,
+                        ),
+                    )
+                )
+            },
+        )
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """The state as arrays, e.g. to save with numpy. Keys and docs are
+        packed with `pack_strings`, tuple keys flattened."""
+        key_width = (
+            len(self.keys[0]) if self.keys and isinstance(self.keys[0], tuple) else 0
+        )
+        keys, key_offsets = pack_strings(
+            [part for key in self.keys for part in key] if key_width else self.keys,
+        )
+        docs, doc_offsets = pack_strings(self.docs)
+        return {
+            "keys": keys,
+            "key_offsets": key_offsets,
+            "key_width": np.array(key_width),
+            "docs": docs,
+            "doc_offsets": doc_offsets,
+            **{name: getattr(self, name) for name in self.arrays},
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Mapping[str, np.ndarray]) -> "PartialStatsDict":
+        keys = unpack_strings(arrays["keys"], arrays["key_offsets"])
+        key_width = int(arrays["key_width"])
+        if key_width:
+            keys = list(zip(*(keys[i::key_width] for i in range(key_width))))
+        return cls(
+            keys=keys,
+            docs=unpack_strings(arrays["docs"], arrays["doc_offsets"]),
+            **{name: arrays[name] for name in cls.arrays},
+        )
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
 
 class TripletStats(BaseModel):
     triplets: StatsDict
@@ -109,56 +482,176 @@ class TripletStats(BaseModel):
         }
 
 
+class PartialTripletStats:
+    """The mergeable state of TripletStats. See `PartialStatsDict`."""
+
+    statsdicts = ("triplets", "entities", "predicates")
+
+    def __init__(
+        self,
+        triplets: PartialStatsDict,
+        entities: PartialStatsDict,
+        predicates: PartialStatsDict,
+    ):
+        self.triplets = triplets
+        self.entities = entities
+        self.predicates = predicates
+
+    @classmethod
+    def combine(
+        cls,
+        partials: Iterable["PartialTripletStats"],
+    ) -> "PartialTripletStats":
+        """Combine partial aggregates, given in the order of the shards."""
+        partials = list(partials)
+        return cls(
+            **{
+                name: PartialStatsDict.combine(
+                    getattr(partial, name) for partial in partials
+                )
+                for name in cls.statsdicts
+            },
+        )
+
+    def merge(self, other: "PartialTripletStats") -> "PartialTripletStats":
+        return self.combine([self, other])
+
+    def save(self, path: Union[str, Path]) -> None:
+        """Save the partial aggregate to a compressed .npz file."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as f:
+            np.savez_compressed(
+                f,
+                **{
+                    f"{name}.{array}": value
+                    for name in self.statsdicts
+                    for array, value in getattr(self, name).to_arrays().items()
+                },
+            )
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "PartialTripletStats":
+        with np.load(path) as data:
+            arrays = {key: data[key] for key in data.files}
+        return cls(
+            **{
+                name: PartialStatsDict.from_arrays(
+                    {
+                        key[len(name) + 1 :]: value
+                        for key, value in arrays.items()
+                        if key.startswith(f"{name}.")
+                    },
+                )
+                for name in cls.statsdicts
+            },
+        )
+
+
 class TripletAggregator:
+    """Aggregates triplets into stats of triplets, entities and predicates.
 
-    def __init__(self, mappings: Mappings = None):
+    To aggregate a corpus in shards, e.g. in parallel or as new shards arrive,
+    aggregate each shard with `aggregate_partial`, combine the partial
+    aggregates with `PartialTripletStats.combine` and `finalize` the result.
+
+    Args:
+        mappings: The mappings of entities and predicates to their labels.
+        max_docs: The maximum number of example docs listed for each triplet,
+            entity and predicate. All docs are listed if None.
+    """
+
+    def __init__(self, mappings: Mappings = None, max_docs: int = None):
         self._mappings = mappings
+        self._max_docs = max_docs
 
     def aggregate(
         self,
-        triplets: List[Triplet],
+        triplets: Union[List[Triplet], TripletTable],
         remove_identical_subj_and_obj: bool = True,
-    ):
+    ) -> TripletStats:
+        return self.finalize(
+            self.aggregate_partial(triplets, remove_identical_subj_and_obj),
+        )
+
+    def finalize(self, partial: PartialTripletStats) -> TripletStats:
+        """The stats of a (combined) partial aggregate."""
+        return TripletStats(
+            triplets=partial.triplets.finalize(max_docs=self._max_docs),
+            entities=partial.entities.finalize(
+                self._mappings.entity_alt_labels() if self._mappings else None,
+                self._max_docs,
+            ),
+            predicates=partial.predicates.finalize(
+                self._mappings.predicate_alt_labels() if self._mappings else None,
+                self._max_docs,
+            ),
+        )
+
+    def aggregate_partial(
+        self,
+        triplets: Union[List[Triplet], TripletTable],
+        remove_identical_subj_and_obj: bool = True,
+    ) -> PartialTripletStats:
+        if not isinstance(triplets, TripletTable):
+            triplets = TripletTable.from_triplets(triplets)
         if self._mappings is not None:
-            triplets = [
-                Triplet(
-                    subject=TripletField(
-                        text=self._mappings.map_entity(t.subject.text),
-                    ),
-                    predicate=TripletField(
-                        text=self._mappings.map_predicate(t.predicate.text),
-                    ),
-                    object=TripletField(text=self._mappings.map_entity(t.object.text)),
-                    doc=t.doc,
-                    timestamp=t.timestamp,
-                )
-                for t in triplets
-            ]
+            triplets = triplets.map(
+                self._mappings.entities,
+                self._mappings.predicates,
+            )
 
         if remove_identical_subj_and_obj:
-            triplets = [t for t in triplets if t.subject.text != t.object.text]
+            triplets = triplets[triplets.subject != triplets.object]
 
-        return TripletStats(
-            triplets=StatsDict.from_iterable(
-                (
-                    (
-                        (t.subject.text, t.predicate.text, t.object.text),
-                        t.doc,
-                        t.timestamp,
-                    )
-                    for t in triplets
-                )
+        strings = np.array(triplets.strings, dtype=object)
+        subjects = triplets.subject.astype(np.int64)
+        predicates = triplets.predicate.astype(np.int64)
+        objects = triplets.object.astype(np.int64)
+        rows = np.arange(len(triplets))
+        n_strings = max(len(strings), 1)
+
+        # code (subject, predicate) pairs first, so the codes fit in an int64
+        _, subject_predicate = np.unique(
+            subjects * n_strings + predicates,
+            return_inverse=True,
+        )
+        first, triplet_groups = group_by_first_occurrence(
+            subject_predicate.reshape(-1) * n_strings + objects,
+        )
+        triplet_keys = list(
+            zip(
+                strings[subjects[first]].tolist(),
+                strings[predicates[first]].tolist(),
+                strings[objects[first]].tolist(),
+            ),
+        )
+
+        # the subject and object of a triplet are consecutive occurrences
+        entities = np.stack([subjects, objects], axis=1).reshape(-1)
+        first, entity_groups = group_by_first_occurrence(entities)
+        entity_keys = strings[entities[first]].tolist()
+
+        first, predicate_groups = group_by_first_occurrence(predicates)
+        predicate_keys = strings[predicates[first]].tolist()
+
+        return PartialTripletStats(
+            triplets=PartialStatsDict.from_groups(
+                triplet_keys,
+                triplet_groups,
+                rows,
+                triplets,
             ),
-            entities=StatsDict.from_iterable(
-                (
-                    (entity, t.doc, t.timestamp)
-                    for t in triplets
-                    for entity in [t.subject.text, t.object.text]
-                ),
-                self._mappings.entity_alt_labels(),
+            entities=PartialStatsDict.from_groups(
+                entity_keys,
+                entity_groups,
+                np.repeat(rows, 2),
+                triplets,
             ),
-            predicates=StatsDict.from_iterable(
-                ((t.predicate.text, t.doc, t.timestamp) for t in triplets),
-                self._mappings.predicate_alt_labels(),
+            predicates=PartialStatsDict.from_groups(
+                predicate_keys,
+                predicate_groups,
+                rows,
+                triplets,
             ),
         )
@@ -1,16 +1,28 @@
+import hashlib
+from copy import copy
 from collections import defaultdict
-from typing import List, Callable, Any, Hashable, Dict
+from pathlib import Path
+from typing import List, Callable, Any, Hashable, Dict, Optional, Tuple, Union
 
-import networkx
 import numpy as np
 from hdbscan import HDBSCAN
+from hdbscan.hdbscan_ import _tree_to_labels
 from pydantic import BaseModel
 from sentence_transformers import SentenceTransformer
+from sklearn.metrics import adjusted_rand_score
 from sklearn.preprocessing import StandardScaler
 from umap import UMAP
 
 from conspiracies.common.modelchoice import ModelChoice
+from conspiracies.common.processes import spawn_pool
+from conspiracies.corpusprocessing.embedding_cache import EmbeddingCache
+from conspiracies.corpusprocessing.incremental import (
+    ClusterPrototypes,
+    DriftReport,
+    normalize_rows,
+)
 from conspiracies.corpusprocessing.triplet import TripletField, Triplet
+from conspiracies.corpusprocessing.triplet_table import TripletTable
 
 
 class Mappings(BaseModel):
@@ -36,6 +48,82 @@ class Mappings(BaseModel):
         return alt_labels
 
 
+class SweepResult(BaseModel):
+    """Statistics of the clustering with one setting of the thresholds.
+
+    The noise ratio is the fraction of fields that are not in any cluster,
+    and the mapping size is the number of unique texts that are mapped.
+    """
+
+    min_cluster_size: int
+    min_samples: int
+    n_clusters: int
+    noise_ratio: float
+    mapping_size: int
+
+
+class SamplingReport(BaseModel):
+    """Agreement of sample-then-assign clustering with clustering all fields of
+    a held-out subset.
+
+    The adjusted Rand index compares the clusters of the unique texts,
+    with every unclustered text in a cluster of its own.
+    """
+
+    n_fields: int
+    n_texts: int
+    sample_size: int
+    adjusted_rand_index: float
+    clustered_ratio_full: float
+    clustered_ratio_sampled: float
+
+
+class DisjointSet:
+    """Union-find over the integers 0, ..., n - 1."""
+
+    def __init__(self, n: int):
+        self._parents = list(range(n))
+
+    def find(self, i: int) -> int:
+        parents = self._parents
+        while parents[i] != i:
+            # path halving
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    def union(self, i: int, j: int) -> None:
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            # keep the smallest element as the root
+            self._parents[max(i, j)] = min(i, j)
+
+    def groups(self) -> List[List[int]]:
+        """The sets in order of their smallest element, each in ascending order."""
+        groups: Dict[int, List[int]] = {}
+        for i in range(len(self._parents)):
+            groups.setdefault(self.find(i), []).append(i)
+        return list(groups.values())
+
+
+class EmbeddingLookup:
+    """The embeddings of unique texts, looked up by text.
+
+    Unlike an array with a row per field, it holds every text once, so it
+    is cheap to send to worker processes.
+    """
+
+    def __init__(self, texts: List[str], embeddings: np.ndarray):
+        self.index = {text: i for i, text in enumerate(texts)}
+        self.embeddings = embeddings
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self.embeddings[[self.index[text] for text in texts]])
+
+
+Embed = Callable[[List[str]], np.ndarray]
+
+
 class Clustering:
     def __init__(
         self,
@@ -45,6 +133,16 @@ class Clustering:
         min_cluster_size: int = 5,
         min_samples: int = 3,
         embedding_model: str = None,
+        cache_dir: Optional[Union[str, Path]] = None,
+        min_similarity: float = 0.75,
+        max_growth: float = 0.5,
+        max_unassigned_ratio: float = 0.5,
+        n_jobs: Optional[int] = None,
+        max_sample_size: Optional[int] = None,
+        assign_batch_size: int = 10_000,
+        blocking: bool = False,
+        min_block_size: int = 50,
+        merge_similarity: float = 0.9,
     ):
         self.language = language
         self.n_dimensions = n_dimensions
@@ -52,105 +150,535 @@ class Clustering:
         self.min_cluster_size = min_cluster_size
         self.min_samples = min_samples
         self._embedding_model = embedding_model
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        # assignment of new texts and drift thresholds for incremental updates
+        self.min_similarity = min_similarity
+        self.max_growth = max_growth
+        self.max_unassigned_ratio = max_unassigned_ratio
+        # number of cores, entities and predicates are clustered concurrently if > 1
+        self.n_jobs = n_jobs
+        # only a sample of the fields is clustered if there are more than this
+        self.max_sample_size = max_sample_size
+        self.assign_batch_size = assign_batch_size
+        # cluster blocks of fields with the same head separately and merge
+        # clusters across blocks with similar centroids
+        self.blocking = blocking
+        self.min_block_size = min_block_size
+        self.merge_similarity = merge_similarity
+        self._allow_single_cluster = False
+        self._model = None
 
-    def _get_embedding_model(self):
+    def _get_embedding_model_name(self) -> str:
         # figure out embedding model if not given explicitly
         if self._embedding_model is None:
-            embedding_model = ModelChoice(
+            return ModelChoice(
                 da="vesteinn/DanskBERT",
                 en="all-MiniLM-L6-v2",
                 fallback="sentence-transformers/paraphrase-multilingual-mpnet-base-v2",
             ).get_model(self.language)
-        else:
-            embedding_model = self._embedding_model
-        return SentenceTransformer(embedding_model)
+        return self._embedding_model
+
+    def _get_embedding_model(self):
+        if self._model is None:
+            self._model = SentenceTransformer(self._get_embedding_model_name())
+        return self._model
+
+    def _hdbscan_kwargs(self) -> Dict[str, Any]:
+        kwargs: Dict[str, Any] = {"allow_single_cluster": self._allow_single_cluster}
+        if self.n_jobs is not None:
+            kwargs["core_dist_n_jobs"] = self.n_jobs
+        return kwargs
+
+    def _embed_unique(self, texts: List[str]) -> EmbeddingLookup:
+        """Embed the unique texts.
+
+        If a cache directory is set, embeddings are looked up in and added
+        to an on-disk cache, so only texts not seen in earlier runs with
+        the same embedding model are encoded.
+        """
+        unique_texts = list(dict.fromkeys(texts))
+
+        model_name = self._get_embedding_model_name()
+        cache = (
+            EmbeddingCache(self.cache_dir / "embeddings.db")
+            if self.cache_dir is not None
+            else None
+        )
+        cached = cache.get_many(model_name, unique_texts) if cache is not None else {}
+        missing = [text for text in unique_texts if text not in cached]
+        print(
+            f"{len(texts)} texts, {len(unique_texts)} unique, "
+            f"{len(unique_texts) - len(missing)} cached.",
+        )
+
+        if missing:
+            print("Creating embeddings:")
+            encoded = self._get_embedding_model().encode(
+                missing,
+                show_progress_bar=True,
+            )
+            cached.update(zip(missing, encoded))
+            if cache is not None:
+                cache.set_many(model_name, zip(missing, encoded))
+        if cache is not None:
+            cache.close()
+
+        if not unique_texts:
+            return EmbeddingLookup([], np.zeros((0, 0), dtype=np.float32))
+        return EmbeddingLookup(
+            unique_texts,
+            np.stack([cached[text] for text in unique_texts]),
+        )
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        """Embed texts, encoding each unique text only once. See
+        `_embed_unique`."""
+        return self._embed_unique(texts)(texts)
 
     @staticmethod
     def _combine_clusters(
         clusters: List[List[Any]],
         get_combine_key: Callable[[Any], Hashable] = lambda x: x,
     ) -> List[List[Any]]:
-        # find matches of on combine key and keep track of their indices
-        matches = defaultdict(set)
+        # clusters sharing a combine key are merged, i.e. the connected components
+        # of the graph with edges between clusters with a common key
+        components = DisjointSet(len(clusters))
+        first_cluster_of_key: Dict[Hashable, int] = {}
         for i, cluster in enumerate(clusters):
             for member in cluster:
                 key = get_combine_key(member)
                 if key:
-                    matches[key].add(i)
-
-        # create a graph where nodes are cluster indices and edges are key matches
-        graph = networkx.Graph()
-        graph.add_nodes_from(range(len(clusters)))
-        for match in matches.values():
-            for i in match:
-                for j in match:
-                    if i != j:
-                        graph.add_edge(i, j)
-
-        # connected components of the graph tell us which clusters should be merged
+                    components.union(first_cluster_of_key.setdefault(key, i), i)
+
+        # components in order of their first cluster, clusters in index order
         merged_clusters = []
-        for component in networkx.connected_components(graph):
+        for component in components.groups():
             merged = []
-            for node in component:
-                merged += clusters[node]
+            for i in component:
+                merged += clusters[i]
             merged_clusters.append(merged)
 
         return merged_clusters
 
-    def _cluster(
+    def _input_hash(self, texts: List[str]) -> str:
+        digest = hashlib.sha256(self._get_embedding_model_name().encode("utf-8"))
+        for text in texts:
+            digest.update(b"\x00" + text.encode("utf-8"))
+        return digest.hexdigest()[:32]
+
+    def _load_or_compute(
         self,
+        name: str,
+        compute: Callable[[], np.ndarray],
+    ) -> np.ndarray:
+        """Load a stored array memory-mapped, or compute and store it first.
+
+        Without a cache directory the array is just computed.
+        """
+        if self.cache_dir is None:
+            return compute()
+        path = self.cache_dir / "arrays" / f"{name}.npy"
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{name}.tmp.npy")
+            np.save(tmp_path, np.asarray(compute(), dtype=np.float32))
+            tmp_path.replace(path)
+        return np.load(path, mmap_mode="r")
+
+    def _reduced_array_name(self, key: str) -> str:
+        if self.n_dimensions is None:
+            return f"scaled-{key}"
+        return f"umap-{key}-{self.n_dimensions}-{self.n_neighbors}"
+
+    def _reduced_embeddings(
+        self,
+        texts: List[str],
+        embed: Optional[Embed] = None,
+    ) -> np.ndarray:
+        """The scaled and optionally UMAP reduced embeddings of texts.
+
+        If a cache directory is set, the raw, scaled and reduced embeddings
+        are stored as .npy files keyed by a hash of the texts and the
+        parameters they depend on, so a rerun with other thresholds starts
+        from the stored arrays.
+        """
+        key = self._input_hash(texts)
+
+        def raw() -> np.ndarray:
+            return (embed if embed is not None else self._embed)(texts)
+
+        def scale() -> np.ndarray:
+            return StandardScaler().fit_transform(
+                self._load_or_compute(f"raw-{key}", raw),
+            )
+
+        if self.n_dimensions is None:
+            return self._load_or_compute(self._reduced_array_name(key), scale)
+
+        def reduce() -> np.ndarray:
+            scaled = self._load_or_compute(f"scaled-{key}", scale)
+            print("Reducing embedding space")
+            reducer = UMAP(
+                n_components=self.n_dimensions,
+                n_neighbors=self.n_neighbors,
+                n_jobs=self.n_jobs if self.n_jobs is not None else -1,
+            )
+            return reducer.fit_transform(scaled)
+
+        return self._load_or_compute(self._reduced_array_name(key), reduce)
+
+    def _embed_unless_stored(self, texts: List[str]) -> Optional[EmbeddingLookup]:
+        """The embeddings of the unique texts, or None if their reduced
+        embeddings are stored already and the embeddings are not needed."""
+        if self.cache_dir is not None:
+            name = self._reduced_array_name(self._input_hash(texts))
+            if (self.cache_dir / "arrays" / f"{name}.npy").exists():
+                return None
+        return self._embed_unique(texts)
+
+    @staticmethod
+    def _merged_clusters(
         fields: List[TripletField],
-    ):
-        model = self._get_embedding_model()
-        print("Creating embeddings:")
-        embeddings = model.encode(
-            [field.text for field in fields],
-            show_progress_bar=True,
+        labels: np.ndarray,
+        probabilities: np.ndarray,
+    ) -> List[List[int]]:
+        # skip noise and low confidence, clusters hold indices of the fields
+        keep = (labels != -1) & (probabilities >= 0.1)
+        idxs = np.flatnonzero(keep)
+        clusters = defaultdict(list)
+        for i, label in zip(idxs.tolist(), labels[idxs].tolist()):
+            clusters[label].append(i)
+
+        merged = Clustering._combine_clusters(
+            list(clusters.values()),
+            get_combine_key=lambda i: fields[i].text,
         )
-        embeddings = StandardScaler().fit_transform(embeddings)
 
-        if self.n_dimensions is not None:
-            print("Reducing embedding space")
-            reducer = UMAP(n_components=self.n_dimensions, n_neighbors=self.n_neighbors)
-            embeddings = reducer.fit_transform(embeddings)
+        # too risky with false positives from this
+        # merged = Clustering._combine_clusters(
+        #     merged,
+        #     get_combine_key=lambda i: fields[i].head,
+        # )
+        return merged
+
+    @staticmethod
+    def _rank_members(
+        embeddings: np.ndarray,
+        clusters: List[List[int]],
+    ) -> List[List[int]]:
+        """Sort the members of each cluster by their inner product with the
+        cluster mean, highest first, keeping the order of ties.
+
+        Members are indices into embeddings. All clusters are ranked at
+        once with array operations over the concatenated members.
+        """
+        sizes = np.array([len(cluster) for cluster in clusters], dtype=np.int64)
+        if not sizes.sum():
+            return [list(cluster) for cluster in clusters]
+        members = np.concatenate(
+            [np.asarray(cluster, dtype=np.int64) for cluster in clusters],
+        )
+        cluster_ids = np.repeat(np.arange(len(clusters)), sizes)
+        member_embeddings = embeddings[members]
+
+        nonempty = sizes > 0
+        starts = np.cumsum(sizes) - sizes
+        means = np.zeros((len(clusters), embeddings.shape[1]), dtype=embeddings.dtype)
+        means[nonempty] = (
+            np.add.reduceat(member_embeddings, starts[nonempty]) / sizes[nonempty, None]
+        )
+        scores = np.einsum("ij,ij->i", member_embeddings, means[cluster_ids])
+
+        # lexsort is stable, so ties keep their order like list.sort does
+        order = np.lexsort((-scores, cluster_ids))
+        ranked = np.split(members[order], np.cumsum(sizes)[:-1])
+        return [cluster.tolist() for cluster in ranked]
+
+    def _cluster_all(
+        self,
+        fields: List[TripletField],
+        embed: Optional[Embed] = None,
+    ) -> List[List[TripletField]]:
+        embeddings = self._reduced_embeddings([field.text for field in fields], embed)
 
         print("Clustering ...")
         hdbscan_model = HDBSCAN(
             min_cluster_size=self.min_cluster_size,
             min_samples=self.min_samples,
+            **self._hdbscan_kwargs(),
         )
         hdbscan_model.fit(embeddings)
 
-        clusters = defaultdict(list)
-        for field, embedding, label, probability in zip(
+        merged = self._merged_clusters(
             fields,
-            embeddings,
             hdbscan_model.labels_,
             hdbscan_model.probabilities_,
-        ):
-            # skip noise and low confidence
-            if label == -1 or probability < 0.1:
-                continue
-            clusters[label].append((field, embedding))
+        )
 
-        merged = self._combine_clusters(
-            list(clusters.values()),
-            get_combine_key=lambda t: t[0].text,
+        # sort by how "prototypical" a member is in the cluster
+        ranked = self._rank_members(embeddings, merged)
+        return [[fields[i] for i in cluster] for cluster in ranked]
+
+    def _sample(self, fields: List[TripletField]) -> List[TripletField]:
+        """A uniform sample of max_sample_size fields, or all fields if there
+        are not more. Unique texts are sampled by their frequency, so dense
+        regions stay dense."""
+        if self.max_sample_size is None or len(fields) <= self.max_sample_size:
+            return fields
+        rng = np.random.default_rng(0)
+        sample_idxs = np.sort(
+            rng.choice(len(fields), self.max_sample_size, replace=False),
         )
+        print(f"Clustering a sample of {len(sample_idxs)} of {len(fields)} fields")
+        return [fields[i] for i in sample_idxs]
 
-        # too risky with false positives from this
-        # merged = self._combine_clusters(
-        #     merged,
-        #     get_combine_key=lambda t: t[0].head,
-        # )
+    def _prototypes(
+        self,
+        fields: List[TripletField],
+        clusters: List[List[TripletField]],
+        embed: Optional[Callable[[List[str]], np.ndarray]] = None,
+    ) -> ClusterPrototypes:
+        texts = list({member.text: None for cluster in clusters for member in cluster})
+        embed = embed if embed is not None else self._embed
+        return ClusterPrototypes.from_clusters(
+            [[member.text for member in cluster] for cluster in clusters],
+            dict(zip(texts, embed(texts))),
+            known_texts={field.text for field in fields},
+            n_fields=len(fields),
+        )
 
-        # sort by how "prototypical" a member is in the cluster
-        for cluster in merged:
-            mean = np.mean(np.stack([t[1] for t in cluster]), axis=0)
-            cluster.sort(key=lambda t: np.inner(t[1], mean), reverse=True)
+    def _assign_remaining(
+        self,
+        fields: List[TripletField],
+        sample: List[TripletField],
+        clusters: List[List[TripletField]],
+        embed: Optional[Embed] = None,
+    ) -> List[List[TripletField]]:
+        """Assign the texts of fields that are not in the clustered sample to
+        the cluster with the most similar prototype. The texts are embedded
+        and assigned in batches of assign_batch_size, so only a batch of
+        embeddings is in memory at a time."""
+        if len(sample) == len(fields):
+            return clusters
+        embed = embed if embed is not None else self._embed
+        prototypes = self._prototypes(sample, clusters, embed)
+        sampled_texts = {field.text for field in sample}
+        remaining = [
+            text
+            for text in dict.fromkeys(field.text for field in fields)
+            if text not in sampled_texts
+        ]
+        print(f"Assigning {len(remaining)} texts to {len(clusters)} clusters")
+        assignments: Dict[str, int] = {}
+        for start in range(0, len(remaining), self.assign_batch_size):
+            batch = remaining[start : start + self.assign_batch_size]
+            assigned, _ = prototypes.assign(embed(batch), self.min_similarity)
+            for text, cluster in zip(batch, assigned.tolist()):
+                if cluster >= 0:
+                    assignments[text] = cluster
+
+        # assigned members come after the ranked members of the sample
+        clusters = [list(cluster) for cluster in clusters]
+        for field in fields:
+            if field.text in assignments:
+                clusters[assignments[field.text]].append(field)
+        return clusters
+
+    def _cluster_sampled(
+        self,
+        fields: List[TripletField],
+        embed: Optional[Embed] = None,
+    ) -> List[List[TripletField]]:
+        """Cluster a sample of max_sample_size fields and assign the texts that
+        are not in the sample to the cluster with the most similar prototype.
+        """
+        sample = self._sample(fields)
+        clusters = self._cluster_all(sample, embed)
+        return self._assign_remaining(fields, sample, clusters, embed)
+
+    @staticmethod
+    def _block_key(field: TripletField) -> Optional[str]:
+        if not field.head:
+            return None
+        key = "".join(c for c in field.head.lower() if c.isalnum())
+        return key or None
+
+    def _blocks(self, fields: List[TripletField]) -> List[np.ndarray]:
+        """Partition the fields by the normalized text of their head. Fields
+        without a head and blocks smaller than min_block_size go to a
+        catch-all block, which comes last."""
+        blocks = defaultdict(list)
+        for i, field in enumerate(fields):
+            blocks[self._block_key(field)].append(i)
+        catch_all = blocks.pop(None, [])
+        partition = []
+        for block in blocks.values():
+            if len(block) < self.min_block_size:
+                catch_all += block
+            else:
+                partition.append(np.array(block))
+        if catch_all:
+            partition.append(np.sort(np.array(catch_all)))
+        return partition
+
+    def _reconcile_blocks(
+        self,
+        clusters: List[List[TripletField]],
+        block_ids: List[int],
+        embed: Embed,
+        batch_size: int = 1024,
+    ) -> List[List[TripletField]]:
+        def member_embeddings(cluster: List[TripletField]) -> np.ndarray:
+            return embed([member.text for member in cluster])
+
+        components = DisjointSet(len(clusters))
+        first_cluster_of_text: Dict[str, int] = {}
+        for i, cluster in enumerate(clusters):
+            for member in cluster:
+                components.union(first_cluster_of_text.setdefault(member.text, i), i)
+
+        if clusters:
+            centroids = normalize_rows(
+                np.stack(
+                    [
+                        normalize_rows(member_embeddings(cluster)).mean(axis=0)
+                        for cluster in clusters
+                    ],
+                ),
+            )
+            block_ids = np.array(block_ids)
+            for start in range(0, len(clusters), batch_size):
+                similarities = centroids[start : start + batch_size] @ centroids.T
+                rows, cols = np.nonzero(similarities >= self.merge_similarity)
+                rows += start
+                for i, j in zip(rows.tolist(), cols.tolist()):
+                    if i < j and block_ids[i] != block_ids[j]:
+                        components.union(i, j)
+
+        merged_clusters = []
+        for component in components.groups():
+            merged = [member for i in component for member in clusters[i]]
+            if len(component) > 1:
+                # the reduced spaces of the blocks differ, so rank in the raw one
+                ranked = self._rank_members(
+                    member_embeddings(merged),
+                    [list(range(len(merged)))],
+                )[0]
+                merged = [merged[i] for i in ranked]
+            merged_clusters.append(merged)
+        return merged_clusters
+
+    def _cluster_blocked(
+        self,
+        fields: List[TripletField],
+        embed: Optional[Embed] = None,
+    ) -> List[List[TripletField]]:
+        """Cluster each block of fields from `_blocks` separately, in n_jobs
+        worker processes, and merge clusters of different blocks which share
+        a text or have centroids with a cosine similarity of at least
+        merge_similarity."""
+        texts = list(dict.fromkeys(field.text for field in fields))
+        lookup = (
+            EmbeddingLookup(texts, embed(texts))
+            if embed is not None
+            else self._embed_unique(texts)
+        )
+        blocks = self._blocks(fields)
+        print(f"Clustering {len(fields)} fields in {len(blocks)} blocks")
+
+        worker = copy(self)
+        worker.blocking = False
+        # a block often holds a single concept, which HDBSCAN should keep
+        worker._allow_single_cluster = True
+        block_fields = [[fields[i] for i in block] for block in blocks]
+        block_embeddings = []
+        for block in block_fields:
+            block_texts = list(dict.fromkeys(field.text for field in block))
+            block_embeddings.append(EmbeddingLookup(block_texts, lookup(block_texts)))
+        if self.n_jobs is not None and self.n_jobs > 1 and len(blocks) > 1:
+            worker.n_jobs = 1
+            with spawn_pool(min(self.n_jobs, len(blocks))) as executor:
+                block_clusters = list(
+                    executor.map(worker._cluster_block, block_fields, block_embeddings),
+                )
+        else:
+            block_clusters = [
+                worker._cluster_block(f, e)
+                for f, e in zip(block_fields, block_embeddings)
+            ]
+
+        clusters = [cluster for result in block_clusters for cluster in result]
+        block_ids = [i for i, result in enumerate(block_clusters) for _ in result]
+        return self._reconcile_blocks(clusters, block_ids, lookup)
+
+    def _cluster(
+        self,
+        fields: List[TripletField],
+        embed: Optional[Embed] = None,
+    ) -> List[List[TripletField]]:
+        """Cluster fields. If given, embed is used to embed texts instead of
+        the embedding model."""
+        if self.blocking:
+            return self._cluster_blocked(fields, embed)
+        if self.max_sample_size is not None and len(fields) > self.max_sample_size:
+            return self._cluster_sampled(fields, embed)
+        return self._cluster_all(fields, embed)
+
+    def _cluster_block(
+        self,
+        fields: List[TripletField],
+        embed: EmbeddingLookup,
+    ) -> List[List[TripletField]]:
+        # UMAP and HDBSCAN need a few more points than neighbors and samples
+        min_size = max(self.min_cluster_size, self.min_samples + 1)
+        if self.n_dimensions is not None:
+            min_size = max(min_size, self.n_neighbors + 1)
+        if len(fields) < min_size:
+            return []
+        return self._cluster(fields, embed)
 
-        # get rid of embeddings in returned list
-        return [[t[0] for t in cluster] for cluster in merged]
+    def _sweep(
+        self,
+        fields: List[TripletField],
+        min_cluster_sizes: List[int],
+        min_samples: List[int],
+    ) -> List["SweepResult"]:
+        embeddings = self._reduced_embeddings([field.text for field in fields])
+        results = []
+        for samples in min_samples:
+            # the single linkage tree only depends on min_samples, and flat
+            # clusterings for any min_cluster_size can be extracted from it
+            print(f"Building hierarchy for min_samples={samples}")
+            hdbscan_model = HDBSCAN(
+                min_cluster_size=min(min_cluster_sizes),
+                min_samples=samples,
+                **self._hdbscan_kwargs(),
+            )
+            hdbscan_model.fit(embeddings)
+            tree = hdbscan_model.single_linkage_tree_.to_numpy()
+            for min_cluster_size in min_cluster_sizes:
+                labels, probabilities, *_ = _tree_to_labels(
+                    embeddings,
+                    tree,
+                    min_cluster_size=min_cluster_size,
+                    allow_single_cluster=self._allow_single_cluster,
+                )
+                merged = self._merged_clusters(fields, labels, probabilities)
+                n_clustered = sum(len(cluster) for cluster in merged)
+                results.append(
+                    SweepResult(
+                        min_cluster_size=min_cluster_size,
+                        min_samples=samples,
+                        n_clusters=len(merged),
+                        noise_ratio=(
+                            1 - n_clustered / len(fields) if len(fields) else 0.0
+                        ),
+                        mapping_size=len(
+                            {fields[i].text for cluster in merged for i in cluster},
+                        ),
+                    ),
+                )
+        return results
 
     @staticmethod
     def _mapping_to_first_member(clusters: List[List[TripletField]]) -> Dict[str, str]:
@@ -160,20 +688,261 @@ class Clustering:
             for member in set(member.text for member in cluster)
         }
 
-    def create_mappings(self, triplets: List[Triplet]) -> Mappings:
+    def _cluster_concurrently(
+        self,
+        entities: List[TripletField],
+        predicates: List[TripletField],
+    ) -> Tuple[List[List[TripletField]], List[List[TripletField]]]:
+        """Cluster entities and predicates, in two worker processes sharing the
+        cores if n_jobs > 1 and blocking is off. The embeddings of the fields
+        to cluster are created up front, so the embedding model is only loaded
+        once."""
+        # blocks are clustered in a pool of n_jobs processes, which would be
+        # nested in the two workers
+        if self.n_jobs is None or self.n_jobs < 2 or self.blocking:
+            print("Creating mappings for entities")
+            entity_clusters = self._cluster(entities)
+            print("Creating mappings for predicates")
+            predicate_clusters = self._cluster(predicates)
+            return entity_clusters, predicate_clusters
+
+        # only the samples are clustered in the workers, and the rest of the
+        # texts are assigned here with the embedding model loaded only here
+        entity_sample = self._sample(entities)
+        predicate_sample = self._sample(predicates)
+        print("Creating embeddings for entities and predicates")
+        entity_embed = self._embed_unless_stored([f.text for f in entity_sample])
+        predicate_embed = self._embed_unless_stored([f.text for f in predicate_sample])
+
+        print("Creating mappings for entities and predicates concurrently")
+        worker = copy(self)
+        worker.n_jobs = max(1, self.n_jobs // 2)
+        with spawn_pool(2) as executor:
+            entity_future = executor.submit(
+                worker._cluster_all,
+                entity_sample,
+                entity_embed,
+            )
+            predicate_future = executor.submit(
+                worker._cluster_all,
+                predicate_sample,
+                predicate_embed,
+            )
+            entity_clusters = entity_future.result()
+            predicate_clusters = predicate_future.result()
+        return (
+            self._assign_remaining(entities, entity_sample, entity_clusters),
+            self._assign_remaining(predicates, predicate_sample, predicate_clusters),
+        )
+
+    def _update_mapping(
+        self,
+        fields: List[TripletField],
+        mapping: Dict[str, str],
+        prototypes: ClusterPrototypes,
+    ) -> Tuple[Optional[Dict[str, str]], DriftReport]:
+        """Assign texts unseen by the prototypes to the most similar cluster.
+
+        Returns:
+            The extended mapping, or None if the drift is above the thresholds
+                and a full re-clustering is needed, and the drift report.
+        """
+        new_fields = [f for f in fields if f.text not in prototypes.known_texts]
+        new_texts = list({field.text: None for field in new_fields})
+        if new_texts:
+            assigned, _ = prototypes.assign(
+                self._embed(new_texts),
+                self.min_similarity,
+            )
+        else:
+            assigned = np.zeros(0, dtype=np.int64)
+        n_assigned = int((assigned >= 0).sum())
+        report = DriftReport(
+            n_new_texts=len(new_texts),
+            n_assigned=n_assigned,
+            growth=(prototypes.n_new_fields + len(new_fields))
+            / max(prototypes.n_fields, 1),
+            unassigned_ratio=1 - n_assigned / len(new_texts) if new_texts else 0.0,
+        )
+        if (
+            report.growth > self.max_growth
+            or report.unassigned_ratio > self.max_unassigned_ratio
+        ):
+            return None, report
+
+        mapping = dict(mapping)
+        for text, cluster in zip(new_texts, assigned.tolist()):
+            if cluster >= 0:
+                mapping[text] = prototypes.labels[cluster]
+        prototypes.known_texts.update(new_texts)
+        prototypes.n_new_fields += len(new_fields)
+        return mapping, report
+
+    def _create_or_update_mapping(
+        self,
+        name: str,
+        fields: List[TripletField],
+        previous: Optional[Dict[str, str]],
+        state_dir: Path,
+    ) -> Dict[str, str]:
+        path = state_dir / f"{name}.npz"
+        if previous is not None and path.exists():
+            print(f"Assigning new {name} to existing clusters")
+            prototypes = ClusterPrototypes.load(path)
+            mapping, report = self._update_mapping(fields, previous, prototypes)
+            print("Drift since last full clustering:", report)
+            if mapping is not None:
+                prototypes.save(path)
+                return mapping
+            print(f"Drift above thresholds, re-clustering {name}")
+
+        print(f"Creating mappings for {name}")
+        clusters = self._cluster(fields)
+        self._prototypes(fields, clusters).save(path)
+        return self._mapping_to_first_member(clusters)
+
+    @staticmethod
+    def _entities_and_predicates(
+        triplets: Union[List[Triplet], TripletTable],
+    ) -> Tuple[List[TripletField], List[TripletField]]:
+        """The subjects followed by the objects, and the predicates."""
+        if isinstance(triplets, TripletTable):
+            entities = triplets.fields("subject") + triplets.fields("object")
+            return entities, triplets.fields("predicate")
         subjects = [triplet.subject for triplet in triplets]
         objects = [triplet.object for triplet in triplets]
-        entities = subjects + objects
-        predicates = [triplet.predicate for triplet in triplets]
+        return subjects + objects, [triplet.predicate for triplet in triplets]
+
+    def create_mappings(
+        self,
+        triplets: Union[List[Triplet], TripletTable],
+        state_dir: Optional[Union[str, Path]] = None,
+    ) -> Mappings:
+        """Create mappings of entities and predicates from their clusters.
+
+        Args:
+            triplets: The triplets of the corpus.
+            state_dir: If given, the mappings and the cluster prototypes are
+                kept here, and later calls only assign texts that are new
+                since the last full clustering to the existing clusters. The
+                corpus is clustered from scratch when the drift is above the
+                thresholds.
+        """
+        entities, predicates = self._entities_and_predicates(triplets)
 
-        print("Creating mappings for entities")
-        entity_clusters = self._cluster(entities)
-        print("Creating mappings for predicates")
-        predicate_clusters = self._cluster(predicates)
+        if state_dir is None:
+            entity_clusters, predicate_clusters = self._cluster_concurrently(
+                entities,
+                predicates,
+            )
 
+            return Mappings(
+                entities=self._mapping_to_first_member(entity_clusters),
+                predicates=self._mapping_to_first_member(predicate_clusters),
+            )
+
+        state_dir = Path(state_dir)
+        state_dir.mkdir(parents=True, exist_ok=True)
+        mappings_path = state_dir / "mappings.json"
+        previous = (
+            Mappings.parse_file(mappings_path) if mappings_path.exists() else None
+        )
         mappings = Mappings(
-            entities=self._mapping_to_first_member(entity_clusters),
-            predicates=self._mapping_to_first_member(predicate_clusters),
+            entities=self._create_or_update_mapping(
+                "entities",
+                entities,
+                previous.entities if previous is not None else None,
+                state_dir,
+            ),
+            predicates=self._create_or_update_mapping(
+                "predicates",
+                predicates,
+                previous.predicates if previous is not None else None,
+                state_dir,
+            ),
         )
-
+        mappings_path.write_text(mappings.json())
         return mappings
+
+    def sweep(
+        self,
+        triplets: Union[List[Triplet], TripletTable],
+        min_cluster_sizes: List[int],
+        min_samples: List[int],
+    ) -> Dict[str, List[SweepResult]]:
+        """Cluster entities and predicates with every combination of the
+        thresholds, building the HDBSCAN hierarchy only once per value of
+        min_samples.
+
+        Returns:
+            The results of each setting for "entities" and "predicates".
+        """
+        entities, predicates = self._entities_and_predicates(triplets)
+
+        print("Sweeping thresholds for entities")
+        entity_results = self._sweep(entities, min_cluster_sizes, min_samples)
+        print("Sweeping thresholds for predicates")
+        predicate_results = self._sweep(predicates, min_cluster_sizes, min_samples)
+        return {"entities": entity_results, "predicates": predicate_results}
+
+    def _evaluate_sampling(
+        self,
+        fields: List[TripletField],
+        holdout_size: int,
+    ) -> SamplingReport:
+        rng = np.random.default_rng(1)
+        holdout_idxs = rng.choice(
+            len(fields),
+            min(holdout_size, len(fields)),
+            replace=False,
+        )
+        holdout = [fields[i] for i in np.sort(holdout_idxs)]
+        # sample the same fraction of the holdout as of all fields
+        sample_size = len(holdout)
+        if self.max_sample_size is not None and len(fields) > self.max_sample_size:
+            sample_size = round(len(holdout) * self.max_sample_size / len(fields))
+        sampled_clustering = copy(self)
+        sampled_clustering.max_sample_size = max(sample_size, 1)
+        sampled_clustering._model = self._model
+
+        def text_labels(clusters: List[List[TripletField]]) -> Dict[str, int]:
+            return {m.text: i for i, cluster in enumerate(clusters) for m in cluster}
+
+        full = text_labels(self._cluster_all(holdout))
+        sampled = text_labels(sampled_clustering._cluster(holdout))
+        texts = list({field.text: None for field in holdout})
+        return SamplingReport(
+            n_fields=len(holdout),
+            n_texts=len(texts),
+            sample_size=sample_size,
+            adjusted_rand_index=adjusted_rand_score(
+                [full.get(text, -i - 1) for i, text in enumerate(texts)],
+                [sampled.get(text, -i - 1) for i, text in enumerate(texts)],
+            ),
+            clustered_ratio_full=len(full) / len(texts) if texts else 0.0,
+            clustered_ratio_sampled=len(sampled) / len(texts) if texts else 0.0,
+        )
+
+    def evaluate_sampling(
+        self,
+        triplets: Union[List[Triplet], TripletTable],
+        holdout_size: int = 5000,
+    ) -> Dict[str, SamplingReport]:
+        """Compare sample-then-assign clustering with clustering all fields on
+        a held-out subset of holdout_size entity and predicate fields, sampling
+        the same fraction of the subset as max_sample_size is of all fields.
+
+        Returns:
+            The report for "entities" and "predicates".
+        """
+        entities, predicates = self._entities_and_predicates(triplets)
+        return {
+            "entities": self._evaluate_sampling(entities, holdout_size),
+            "predicates": self._evaluate_sampling(predicates, holdout_size),
+        }
+
+    def __getstate__(self):
+        # the embedding model is not sent to worker processes
+        state = self.__dict__.copy()
+        state["_model"] = None
+        return state
@@ -0,0 +1,47 @@
+import json
+from pathlib import Path
+from typing import Dict, Iterable, Tuple, Union
+
+import numpy as np
+
+from conspiracies.common.sqlite_store import SQLiteStore
+
+
+def _key(model: str, text: str) -> str:
+    return json.dumps([model, text], ensure_ascii=False)
+
+
+class EmbeddingCache:
+    """A disk-backed cache of text embeddings stored in an SQLite database.
+
+    Embeddings are stored as float32 under the name of the embedding model
+    and the text, so they can be reused between runs with the same model.
+
+    Args:
+        path: Path to the SQLite database file. It is created if it does not exist.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._store = SQLiteStore(self.path, table="embeddings")
+
+    def get_many(self, model: str, texts: Iterable[str]) -> Dict[str, np.ndarray]:
+        """Get the cached embeddings of the texts that are in the cache."""
+        keys = {_key(model, text): text for text in texts}
+        return {
+            keys[key]: np.frombuffer(embedding, dtype=np.float32)
+            for key, embedding in self._store.get_many(keys).items()
+        }
+
+    def set_many(self, model: str, items: Iterable[Tuple[str, np.ndarray]]) -> None:
+        """Store (text, embedding) pairs of a model in the cache."""
+        self._store.set_many(
+            (_key(model, text), np.asarray(embedding, dtype=np.float32).tobytes())
+            for text, embedding in items
+        )
+
+    def close(self) -> None:
+        self._store.close()
+
+    def __len__(self) -> int:
+        return len(self._store)
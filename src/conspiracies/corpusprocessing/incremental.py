@@ -0,0 +1,140 @@
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple, Union
+
+import numpy as np
+from pydantic import BaseModel
+
+from conspiracies.corpusprocessing.triplet_table import pack_strings, unpack_strings
+
+
+def normalize_rows(embeddings: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+class DriftReport(BaseModel):
+    """How much new data has arrived since the last full clustering.
+
+    growth is the number of fields with texts unseen at the last full
+    clustering relative to the number of fields it clustered, and
+    unassigned_ratio is the fraction of the new unique texts that are not
+    close enough to any cluster prototype.
+    """
+
+    n_new_texts: int
+    n_assigned: int
+    growth: float
+    unassigned_ratio: float
+
+
+class ClusterPrototypes:
+    """The prototypes of the clusters of a full clustering run, used to assign
+    new texts to the existing clusters.
+
+    Args:
+        labels: The text every member of a cluster is mapped to.
+        prototypes: The normalized mean embedding of each cluster, shape
+            (n_clusters, dim).
+        known_texts: The texts that have been clustered or assigned.
+        n_fields: The number of fields in the last full clustering.
+        n_new_fields: The number of fields with texts that were unseen at the last
+            full clustering.
+    """
+
+    def __init__(
+        self,
+        labels: List[str],
+        prototypes: np.ndarray,
+        known_texts: Iterable[str],
+        n_fields: int,
+        n_new_fields: int = 0,
+    ):
+        self.labels = list(labels)
+        self.prototypes = np.asarray(prototypes, dtype=np.float32)
+        self.known_texts = set(known_texts)
+        self.n_fields = n_fields
+        self.n_new_fields = n_new_fields
+
+    @classmethod
+    def from_clusters(
+        cls,
+        clusters: List[List[str]],
+        embeddings: Dict[str, np.ndarray],
+        known_texts: Iterable[str],
+        n_fields: int,
+    ) -> "ClusterPrototypes":
+        """Create prototypes from clusters of member texts, ranked such that
+        the first member is the label, and the embeddings of the texts."""
+        dim = len(next(iter(embeddings.values()))) if embeddings else 0
+        prototypes = np.zeros((len(clusters), dim), dtype=np.float32)
+        for i, cluster in enumerate(clusters):
+            members = normalize_rows(np.stack([embeddings[text] for text in cluster]))
+            prototypes[i] = members.mean(axis=0)
+        return cls(
+            labels=[cluster[0] for cluster in clusters],
+            prototypes=normalize_rows(prototypes),
+            known_texts=known_texts,
+            n_fields=n_fields,
+        )
+
+    def assign(
+        self,
+        embeddings: np.ndarray,
+        min_similarity: float,
+        batch_size: int = 4096,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Assign embeddings to the cluster with the most similar prototype.
+
+        Returns:
+            The index of the assigned cluster of each embedding, -1 if no
+                prototype has a cosine similarity of at least min_similarity,
+                and the similarity to the most similar prototype.
+        """
+        n = len(embeddings)
+        assigned = np.full(n, -1, dtype=np.int64)
+        similarities = np.zeros(n, dtype=np.float32)
+        if not len(self.prototypes):
+            return assigned, similarities
+        for start in range(0, n, batch_size):
+            batch = normalize_rows(np.asarray(embeddings[start : start + batch_size]))
+            scores = batch @ self.prototypes.T
+            best = scores.argmax(axis=1)
+            best_scores = scores[np.arange(len(batch)), best]
+            assigned[start : start + len(batch)] = np.where(
+                best_scores >= min_similarity,
+                best,
+                -1,
+            )
+            similarities[start : start + len(batch)] = best_scores
+        return assigned, similarities
+
+    def save(self, path: Union[str, Path]) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as f:
+            labels, label_offsets = pack_strings(self.labels)
+            known_texts, known_text_offsets = pack_strings(sorted(self.known_texts))
+            np.savez(
+                f,
+                labels=labels,
+                label_offsets=label_offsets,
+                prototypes=self.prototypes,
+                known_texts=known_texts,
+                known_text_offsets=known_text_offsets,
+                counts=np.array([self.n_fields, self.n_new_fields]),
+            )
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "ClusterPrototypes":
+        with np.load(path) as data:
+            n_fields, n_new_fields = data["counts"].tolist()
+            return cls(
+                labels=unpack_strings(data["labels"], data["label_offsets"]),
+                prototypes=data["prototypes"],
+                known_texts=unpack_strings(
+                    data["known_texts"],
+                    data["known_text_offsets"],
+                ),
+                n_fields=n_fields,
+                n_new_fields=n_new_fields,
+            )
@@ -0,0 +1,355 @@
+import json
+from array import array
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+from stop_words import get_stop_words
+
+from conspiracies.common.fileutils import iter_lines_of_files
+from conspiracies.corpusprocessing.triplet import Triplet, TripletField
+
+FIELDS = ("subject", "predicate", "object")
+# UTC offsets marking naive and missing timestamps
+NAIVE = np.iinfo(np.int16).min
+MISSING = NAIVE + 1
+EPOCH = datetime(1970, 1, 1)
+
+
+def _encode_timestamp(timestamp: Optional[datetime]) -> Tuple[int, int]:
+    """Microseconds since the epoch in UTC and the UTC offset in minutes."""
+    if timestamp is None:
+        return 0, MISSING
+    offset = timestamp.utcoffset()
+    utc = timestamp.replace(tzinfo=None) - (offset or timedelta())
+    micros = (utc - EPOCH) // timedelta(microseconds=1)
+    if offset is None:
+        return micros, NAIVE
+    return micros, offset // timedelta(minutes=1)
+
+
+def _decode_timestamp(micros: int, offset: int) -> Optional[datetime]:
+    if offset == MISSING:
+        return None
+    utc = EPOCH + timedelta(microseconds=micros)
+    if offset == NAIVE:
+        return utc
+    tz = timezone(timedelta(minutes=offset))
+    return utc.replace(tzinfo=timezone.utc).astimezone(tz)
+
+
+def isoformats(timestamps: np.ndarray, offsets: np.ndarray) -> List[Optional[str]]:
+    """Format encoded timestamps like `datetime.isoformat`, None for missing
+    timestamps."""
+    unique_offsets, offset_index = np.unique(offsets, return_inverse=True)
+    suffixes = np.array(
+        [
+            (
+                ""
+                if offset in (NAIVE, MISSING)
+                else f"{'-' if offset < 0 else '+'}"
+                f"{abs(offset) // 60:02d}:{abs(offset) % 60:02d}"
+            )
+            for offset in unique_offsets.tolist()
+        ],
+        dtype=str,
+    )
+    has_offset = (offsets != NAIVE) & (offsets != MISSING)
+    minutes = np.where(has_offset, offsets, 0).astype(np.int64)
+    local = timestamps + minutes * 60_000_000
+    strings = np.datetime_as_string(local.astype("datetime64[us]"), unit="us")
+    # like isoformat, leave out the microseconds when they are zero
+    strings = np.where(local % 1_000_000 == 0, strings.astype("U19"), strings)
+    strings = np.char.add(strings, suffixes[offset_index.reshape(-1)]).tolist()
+    for i in np.flatnonzero(offsets == MISSING).tolist():
+        strings[i] = None
+    return strings
+
+
+def pack_strings(strings: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Pack strings into one UTF-8 buffer and the offsets of the strings in it,
+    such that each string only takes up its own length."""
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def unpack_strings(buffer: np.ndarray, offsets: np.ndarray) -> List[str]:
+    data = buffer.tobytes()
+    bounds = offsets.tolist()
+    return [data[a:b].decode("utf-8") for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+class StringPool:
+    """Interns strings as integer ids."""
+
+    def __init__(self, strings: Iterable[str] = ()):
+        self.strings: List[str] = []
+        self._ids: Dict[str, int] = {}
+        for string in strings:
+            self.add(string)
+
+    def add(self, string: Optional[str]) -> int:
+        """The id of the string, -1 for None."""
+        if string is None:
+            return -1
+        id_ = self._ids.get(string)
+        if id_ is None:
+            id_ = self._ids[string] = len(self.strings)
+            self.strings.append(string)
+        return id_
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+
+class TripletTable:
+    """A columnar store of triplets.
+
+    The texts and heads of the fields are interned in one pool of strings
+    and stored as int32 ids, -1 meaning no head. Doc ids are interned in a
+    separate pool. Timestamps are stored as int64 microseconds since the
+    epoch in UTC along with the UTC offset in minutes, such that they
+    round-trip exactly.
+
+    Args:
+        strings: The interned texts and heads.
+        docs: The interned doc ids.
+        columns: The arrays "subject", "predicate", "object", "subject_head",
+            "predicate_head", "object_head", "doc", "timestamp" and "utc_offset"
+            of equal length.
+    """
+
+    columns = (
+        "subject",
+        "predicate",
+        "object",
+        "subject_head",
+        "predicate_head",
+        "object_head",
+        "doc",
+        "timestamp",
+        "utc_offset",
+    )
+
+    def __init__(
+        self,
+        strings: List[str],
+        docs: List[str],
+        **columns: np.ndarray,
+    ):
+        self.strings = strings
+        self.docs = docs
+        dtypes = {"timestamp": np.int64, "utc_offset": np.int16}
+        for column in self.columns:
+            setattr(
+                self,
+                column,
+                np.asarray(columns[column], dtype=dtypes.get(column, np.int32)),
+            )
+
+    @classmethod
+    def _from_rows(
+        cls,
+        rows: Iterable[Tuple[dict, dict, dict, Optional[str], Optional[datetime]]],
+    ) -> "TripletTable":
+        strings, docs = StringPool(), StringPool()
+        columns = {column: array("i") for column in cls.columns}
+        columns["timestamp"] = array("q")
+        columns["utc_offset"] = array("h")
+        for subject, predicate, obj, doc, timestamp in rows:
+            for name, field in zip(FIELDS, (subject, predicate, obj)):
+                columns[name].append(strings.add(field["text"]))
+                columns[f"{name}_head"].append(strings.add(field.get("head")))
+            columns["doc"].append(docs.add(doc))
+            micros, offset = _encode_timestamp(timestamp)
+            columns["timestamp"].append(micros)
+            columns["utc_offset"].append(offset)
+        return cls(strings.strings, docs.strings, **columns)
+
+    @classmethod
+    def from_triplets(cls, triplets: Iterable[Triplet]) -> "TripletTable":
+        return cls._from_rows(
+            (
+                t.subject.dict(),
+                t.predicate.dict(),
+                t.object.dict(),
+                t.doc,
+                t.timestamp,
+            )
+            for t in triplets
+        )
+
+    @classmethod
+    def from_annotated_docs(cls, path: Path) -> "TripletTable":
+        """Read the triplets of annotated docs, like
+        `Triplet.from_annotated_docs`, without creating a Triplet for each."""
+
+        def rows():
+            for line in iter_lines_of_files(path):
+                json_data = json.loads(line)
+                timestamp = json_data.get("timestamp", None)
+                if timestamp is not None:
+                    timestamp = datetime.fromisoformat(timestamp)
+                for triplet_data in json_data["semantic_triplets"]:
+                    yield (
+                        triplet_data["subject"],
+                        triplet_data["predicate"],
+                        triplet_data["object"],
+                        json_data.get("id", None),
+                        timestamp,
+                    )
+
+        return cls._from_rows(rows())
+
+    def text(self, column: str) -> np.ndarray:
+        """The strings of a column as an object array."""
+        return np.array(self.strings + [None], dtype=object)[getattr(self, column)]
+
+    def doc_ids(self) -> np.ndarray:
+        """The doc ids as an object array, None for triplets without one."""
+        return np.array(self.docs + [None], dtype=object)[self.doc]
+
+    def datetimes(self, rows: np.ndarray = None) -> List[Optional[datetime]]:
+        """The timestamps of all rows, or of the given row indices."""
+        timestamps, offsets = self.timestamp, self.utc_offset
+        if rows is not None:
+            timestamps, offsets = timestamps[rows], offsets[rows]
+        return [
+            _decode_timestamp(micros, offset)
+            for micros, offset in zip(timestamps.tolist(), offsets.tolist())
+        ]
+
+    def isoformats(self, rows: np.ndarray = None) -> List[Optional[str]]:
+        """The timestamps of all rows, or of the given row indices, formatted
+        like `datetime.isoformat` without creating datetimes."""
+        if rows is None:
+            return isoformats(self.timestamp, self.utc_offset)
+        return isoformats(self.timestamp[rows], self.utc_offset[rows])
+
+    def fields(self, name: str) -> List[TripletField]:
+        """The fields of a column. Fields with the same text and head are the
+        same object, so there is one TripletField per unique field."""
+        texts, heads = getattr(self, name), getattr(self, f"{name}_head")
+        pairs, inverse = np.unique(
+            np.stack([texts, heads], axis=1),
+            axis=0,
+            return_inverse=True,
+        )
+        unique_fields = [
+            TripletField(
+                text=self.strings[text],
+                head=self.strings[head] if head >= 0 else None,
+            )
+            for text, head in pairs.tolist()
+        ]
+        return [unique_fields[i] for i in inverse.reshape(-1).tolist()]
+
+    def iter_triplets(self) -> Iterator[Triplet]:
+        for row in zip(*(getattr(self, column).tolist() for column in self.columns)):
+            subject, predicate, obj, *heads, doc, micros, offset = row
+            yield Triplet(
+                **{
+                    name: TripletField(
+                        text=self.strings[text],
+                        head=self.strings[head] if head >= 0 else None,
+                    )
+                    for name, text, head in zip(
+                        FIELDS,
+                        (subject, predicate, obj),
+                        heads,
+                    )
+                },
+                doc=self.docs[doc] if doc >= 0 else None,
+                timestamp=_decode_timestamp(micros, offset),
+            )
+
+    def filter_on_stopwords(self, language: str) -> "TripletTable":
+        """Like `Triplet.filter_on_stopwords`: drop triplets with a field that is
+        a stopword when lowercased, and clear heads that are stopwords."""
+        stopwords = set(get_stop_words(language))
+        # one lookup per unique string, with a False for id -1 at the end
+        is_blacklisted = np.array(
+            [s.lower() in stopwords for s in self.strings] + [False],
+        )
+        is_stopword = np.array([s in stopwords for s in self.strings] + [False])
+        keep = ~(
+            is_blacklisted[self.subject]
+            | is_blacklisted[self.predicate]
+            | is_blacklisted[self.object]
+        )
+        table = self[keep]
+        for name in FIELDS:
+            heads = getattr(table, f"{name}_head")
+            heads[is_stopword[heads]] = -1
+        return table
+
+    def map(
+        self,
+        entities: Dict[str, str],
+        predicates: Dict[str, str],
+    ) -> "TripletTable":
+        """Map the texts of subjects and objects with the entity mapping, and of
+        predicates with the predicate mapping. Heads are dropped, as they do
+        not belong to the mapped texts."""
+        pool = StringPool(self.strings)
+        entity_ids = np.arange(len(self.strings), dtype=np.int32)
+        predicate_ids = entity_ids.copy()
+        for mapping, ids in [(entities, entity_ids), (predicates, predicate_ids)]:
+            for text, label in mapping.items():
+                if text in pool._ids:
+                    ids[pool._ids[text]] = pool.add(label)
+        return TripletTable(
+            pool.strings,
+            self.docs,
+            subject=entity_ids[self.subject],
+            predicate=predicate_ids[self.predicate],
+            object=entity_ids[self.object],
+            subject_head=np.full(len(self), -1, dtype=np.int32),
+            predicate_head=np.full(len(self), -1, dtype=np.int32),
+            object_head=np.full(len(self), -1, dtype=np.int32),
+            doc=self.doc,
+            timestamp=self.timestamp,
+            utc_offset=self.utc_offset,
+        )
+
+    def save(self, path: Union[str, Path]) -> None:
+        """Save the table to a compressed .npz file."""
+        strings, string_offsets = pack_strings(self.strings)
+        docs, doc_offsets = pack_strings(self.docs)
+        with open(path, "wb") as f:
+            np.savez_compressed(
+                f,
+                strings=strings,
+                string_offsets=string_offsets,
+                docs=docs,
+                doc_offsets=doc_offsets,
+                **{column: getattr(self, column) for column in self.columns},
+            )
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "TripletTable":
+        with np.load(path) as data:
+            return cls(
+                unpack_strings(data["strings"], data["string_offsets"]),
+                unpack_strings(data["docs"], data["doc_offsets"]),
+                **{column: data[column] for column in cls.columns},
+            )
+
+    def __getitem__(self, index: Union[slice, np.ndarray]) -> "TripletTable":
+        """A table of the selected rows, sharing the string pools."""
+        return TripletTable(
+            self.strings,
+            self.docs,
+            **{column: getattr(self, column)[index] for column in self.columns},
+        )
+
+    def __len__(self) -> int:
+        return len(self.subject)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, TripletTable):
+            return False
+        return list(self.iter_triplets()) == list(other.iter_triplets())
@@ -1,17 +1,31 @@
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime
+from itertools import islice
 from pathlib import Path
-from typing import List, Union, Iterable, Tuple
+from typing import (
+    Container,
+    Deque,
+    Iterator,
+    List,
+    Optional,
+    Union,
+    Iterable,
+    Tuple,
+)
 
 import jsonlines
+import numpy as np
+import srsly
 from spacy.language import Language
-from spacy.tokens import Doc
+from spacy.tokens import Doc, DocBin
+from spacy.vocab import Vocab
 
+from conspiracies.common.processes import spawn_pool
 from conspiracies.docprocessing.relationextraction.data_classes import (
+    TripletOffsets,
     install_extensions,
 )
-from conspiracies.docprocessing.relationextraction.gptprompting import (
-    DocTriplets,
-    SpanTriplet,
-)
 from conspiracies.document import Document
 
 
@@ -32,31 +46,42 @@ def _doc_to_json(
     else:
         id_ = None
         timestamp = None
-    if Doc.has_extension("relation_triplets"):
-        triplets = doc._.relation_triplets
+    if Doc.has_extension("relation_triplet_idxs"):
+        triplets = TripletOffsets.from_doc(doc)
     else:
-        triplets = []
+        triplets = TripletOffsets(doc_idxs=[], offsets=[])
     json = doc.to_json()
     if id_ is not None:
         json["id"] = id_
     if timestamp is not None:
         json["timestamp"] = timestamp
-    json["semantic_triplets"] = [
-        triplet.to_dict(include_doc=False, include_span_heads=include_span_heads)
-        for triplet in triplets
-    ]
+    if (
+        include_span_heads
+        and len(triplets)
+        and Doc.has_extension("most_common_ancestors")
+    ):
+        # find heads of all subjects and objects of the doc in one go
+        heads = doc._.most_common_ancestors(
+            [
+                doc[start:end]
+                for offsets in triplets.offsets.tolist()
+                for start, end in (offsets[0:2], offsets[4:6])
+            ],
+        )
+        triplets.heads = np.array(
+            [[head.start, head.end] for head in heads],
+            dtype=np.int32,
+        ).reshape(-1, 4)
+    json["semantic_triplets"] = triplets.to_dicts(doc)
     return json
 
 
 def _doc_from_json(json: dict, nlp: Language) -> Doc:
     doc = Doc(nlp.vocab).from_json(json)
-    triplets = [
-        SpanTriplet.from_dict(triplet_json, nlp=nlp, doc=doc)
-        for triplet_json in json["semantic_triplets"]
-    ]
+    triplets = TripletOffsets.from_dicts(json["semantic_triplets"])
     if not Doc.has_extension("relation_triplets"):
         install_extensions()
-    doc._.relation_triplets = DocTriplets(span_triplets=triplets, doc=doc)
+    doc._.relation_triplet_idxs = triplets.to_idx_tuples()
     return doc
 
 
@@ -82,24 +107,126 @@ def docs_to_jsonl(
         )
 
 
+def _keep_json(
+    json: dict,
+    ids: Optional[Container[str]],
+    start: Optional[datetime],
+    end: Optional[datetime],
+) -> bool:
+    if ids is not None and json.get("id") not in ids:
+        return False
+    if start is not None or end is not None:
+        if json.get("timestamp") is None:
+            return False
+        timestamp = datetime.fromisoformat(json["timestamp"])
+        if start is not None and timestamp < start:
+            return False
+        if end is not None and timestamp >= end:
+            return False
+    return True
+
+
+def _docs_from_json_lines(
+    lines: List[str],
+    ids: Optional[Container[str]],
+    start: Optional[datetime],
+    end: Optional[datetime],
+) -> Tuple[bytes, List[List[Tuple[Tuple[int, int], ...]]]]:
+    """Reconstruct the docs of a batch of lines in a worker process.
+
+    The docs are returned as DocBin bytes with the triplets alongside,
+    so only strings and arrays are sent back and the docs are
+    deserialized into the vocab of the reading process.
+    """
+    doc_bin = DocBin()
+    triplet_idxs = []
+    vocab = Vocab()
+    for line in lines:
+        json = srsly.json_loads(line)
+        if not _keep_json(json, ids, start, end):
+            continue
+        doc_bin.add(Doc(vocab).from_json(json))
+        triplets = TripletOffsets.from_dicts(json["semantic_triplets"])
+        triplet_idxs.append(triplets.to_idx_tuples())
+    return doc_bin.to_bytes(), triplet_idxs
+
+
+def _docs_from_batch(
+    batch: Tuple[bytes, List[List[Tuple[Tuple[int, int], ...]]]],
+    nlp: Language,
+) -> Iterator[Doc]:
+    doc_bin_bytes, triplet_idxs = batch
+    docs = DocBin().from_bytes(doc_bin_bytes).get_docs(nlp.vocab)
+    for doc, idxs in zip(docs, triplet_idxs):
+        doc._.relation_triplet_idxs = idxs
+        yield doc
+
+
+def iter_docs_from_jsonl(
+    path: Union[Path, str],
+    nlp: Language,
+    ids: Optional[Container[str]] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    n_process: int = 1,
+    batch_size: int = 256,
+) -> Iterator[Doc]:
+    """Read docs and triplets from a jsonl file one at a time.
+
+    Only a bounded number of lines is held in memory, so the memory use
+    does not depend on the size of the file. All docs share the vocab of
+    `nlp`.
+
+    Args:
+        path: path to the jsonl file.
+        nlp: a spacy language model.
+        ids: if given, only docs with an "id" in ids are read.
+        start: if given, only docs with a "timestamp" at or after start are read.
+        end: if given, only docs with a "timestamp" before end are read.
+        n_process: number of processes reconstructing docs from the JSON.
+        batch_size: number of lines sent to a process at a time if
+            n_process > 1.
+
+    Yields:
+        The docs in the order of the file, with the extension
+            `doc._.relation_triplets` set.
+    """
+    if not Doc.has_extension("relation_triplets"):
+        install_extensions(force=True)
+    if n_process <= 1:
+        with jsonlines.open(path, "r") as reader:
+            for json in reader:
+                if _keep_json(json, ids, start, end):
+                    yield _doc_from_json(json, nlp)
+        return
+
+    with open(path, encoding="utf-8") as f, spawn_pool(n_process) as pool:
+        batches = iter(lambda: list(islice(f, batch_size)), [])
+        # keep a few batches per process in flight to bound the memory use
+        in_flight: Deque[Future] = deque()
+        for batch in batches:
+            in_flight.append(
+                pool.submit(_docs_from_json_lines, batch, ids, start, end),
+            )
+            if len(in_flight) >= 2 * n_process:
+                yield from _docs_from_batch(in_flight.popleft().result(), nlp)
+        while in_flight:
+            yield from _docs_from_batch(in_flight.popleft().result(), nlp)
+
+
 def docs_from_jsonl(
     path: Union[Path, str],
     nlp: Language,
+    **kwargs,
 ) -> List[Doc]:
     """Read docs and triplets from a jsonl file.
 
     Args:
         path: path to the jsonl file.
         nlp: a spacy language model.
+        **kwargs: filters and parallelism passed to :func:`iter_docs_from_jsonl`.
 
     Returns:
         A list of docs with the extension `doc._.relation_triplets` set.
     """
-    if not Doc.has_extension("relation_triplets"):
-        install_extensions(force=True)
-    docs = []
-    with jsonlines.open(path, "r") as reader:
-        for json in reader:
-            doc = _doc_from_json(json, nlp)
-            docs.append(doc)
-    return docs
+    return list(iter_docs_from_jsonl(path, nlp, **kwargs))
@@ -1,13 +1,107 @@
 """Headwords extraction as a spaCy component."""
 
-from collections import Counter
-from typing import Union
+from typing import Dict, List, Sequence, Union
 from warnings import warn
 
+import numpy as np
+from spacy.attrs import HEAD
 from spacy.language import Language
 from spacy.tokens import Doc, Span, Token
 
 
+def absolute_heads(doc: Doc) -> np.ndarray:
+    """Get the index of the syntactic head of every token in a doc.
+
+    Args:
+        doc (Doc): The doc to get heads from.
+
+    Returns:
+        np.ndarray: An int64 array where entry i is the index of the head of token i.
+            Roots are their own heads.
+    """
+    # the HEAD column holds offsets relative to the token, stored as uint64
+    relative_heads = doc.to_array(HEAD).astype(np.int64)
+    return np.arange(len(doc), dtype=np.int64) + relative_heads
+
+
+def most_common_ancestor_indices(
+    heads: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+) -> np.ndarray:
+    """Find the most common ancestor within each of a number of spans in one
+    pass over the head column of a doc.
+
+    For every token in a span, the chain of ancestors is followed upwards and each
+    ancestor inside the span is counted. Ties are broken the same way as a
+    `Counter` over the ancestors in token order would, i.e. by the ancestor whose
+    first descendant in the span comes first.
+
+    Args:
+        heads (np.ndarray): Absolute head indices of the doc, see `absolute_heads`.
+        starts (np.ndarray): Start token indices of the spans.
+        ends (np.ndarray): End token indices (exclusive) of the spans.
+
+    Returns:
+        np.ndarray: The token index of the most common ancestor of each span, or -1
+            if none of the tokens in the span has an ancestor within the span.
+    """
+    n_tokens = len(heads)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    lengths = ends - starts
+    result = np.full(len(starts), -1, dtype=np.int64)
+    if lengths.sum() == 0:
+        return result
+
+    # one row per (span, token in span)
+    span_ids = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(
+        np.cumsum(lengths) - lengths,
+        lengths,
+    )
+    tokens = np.repeat(starts, lengths) + offsets
+    row_starts = starts[span_ids]
+    row_ends = ends[span_ids]
+
+    keys = []
+    descendants = []
+    current = heads[tokens]
+    active = current != tokens
+    # a tree has no path longer than the number of tokens
+    for _ in range(n_tokens):
+        span_ids, tokens = span_ids[active], tokens[active]
+        row_starts, row_ends = row_starts[active], row_ends[active]
+        current = current[active]
+        if len(current) == 0:
+            break
+        in_span = (current >= row_starts) & (current < row_ends)
+        keys.append(span_ids[in_span] * n_tokens + current[in_span])
+        descendants.append(tokens[in_span])
+        next_ = heads[current]
+        active = next_ != current
+        current = next_
+
+    all_keys = np.concatenate(keys) if keys else np.empty(0, dtype=np.int64)
+    if len(all_keys) == 0:
+        return result
+    unique_keys, inverse, counts = np.unique(
+        all_keys,
+        return_inverse=True,
+        return_counts=True,
+    )
+    first_descendant = np.full(len(unique_keys), n_tokens, dtype=np.int64)
+    np.minimum.at(first_descendant, inverse, np.concatenate(descendants))
+
+    key_spans = unique_keys // n_tokens
+    order = np.lexsort((first_descendant, -counts, key_spans))
+    sorted_spans = key_spans[order]
+    is_best = np.ones(len(order), dtype=bool)
+    is_best[1:] = sorted_spans[1:] != sorted_spans[:-1]
+    result[sorted_spans[is_best]] = unique_keys[order][is_best] % n_tokens
+    return result
+
+
 class HeadwordsExtractionComponent:
     """A class for extracting headwords from a given text document.
 
@@ -57,6 +151,12 @@ class HeadwordsExtractionComponent:
                 getter=self.most_common_ancestor,
                 force=force,
             )
+        if (not Doc.has_extension("most_common_ancestors")) or force:
+            Doc.set_extension(
+                "most_common_ancestors",
+                method=lambda doc, spans: self.most_common_ancestors(spans),
+                force=force,
+            )
 
     def to_entity(self, token: Token) -> Span:  # type: ignore
         """Normalize token to an entity.
@@ -122,32 +222,66 @@ class HeadwordsExtractionComponent:
         Returns:
             Span: The most common ancestor of the span.
         """
-        ancestors_in_span = Counter(
-            [
-                ancestor
-                for token in span
-                for ancestor in token.ancestors
-                if ancestor in span
-            ],
-        )
-        most_common_ancestors = ancestors_in_span.most_common()
-        if most_common_ancestors:
-            most_common_ancestor = most_common_ancestors[0][0]
-        else:  # fall back is to simply take the first token
-            most_common_ancestor = span[0]
-
-        normalized_token = self.to_span(most_common_ancestor)
-
-        if len(normalized_token) != 1:
-            error_message = (
-                f"None of the tokens in the span ({span}) contains an"
-                + " ancestor within this span."
+        return self.most_common_ancestors([span], raise_error=raise_error)[0]
+
+    def most_common_ancestors(
+        self,
+        spans: Sequence[Union[Doc, Span]],
+        raise_error: bool = False,
+    ) -> List[Span]:
+        """Find the most common ancestor of many spans at once.
+
+        The head column of each doc is read once and the ancestors of all spans
+        belonging to that doc are counted in a single vectorized pass.
+
+        Args:
+           spans(Sequence[Union[Doc, Span]]): The spans to find the most common
+            ancestors of. They may belong to different docs.
+           raise_error(bool): Raises warning message if no ancestor is found within a
+            span.
+
+        Returns:
+            List[Span]: The most common ancestor of each span, in the order of the
+                input spans.
+        """
+        spans = [span[:] if isinstance(span, Doc) else span for span in spans]
+
+        # group spans by the doc they belong to
+        docs: Dict[int, Doc] = {}
+        span_indices: Dict[int, List[int]] = {}
+        for i, span in enumerate(spans):
+            docs[id(span.doc)] = span.doc
+            span_indices.setdefault(id(span.doc), []).append(i)
+
+        ancestors: List[Token] = [None] * len(spans)  # type: ignore
+        for doc_id, indices in span_indices.items():
+            doc = docs[doc_id]
+            starts = np.array([spans[i].start for i in indices], dtype=np.int64)
+            ends = np.array([spans[i].end for i in indices], dtype=np.int64)
+            ancestor_indices = most_common_ancestor_indices(
+                absolute_heads(doc),
+                starts,
+                ends,
             )
+            for i, start, ancestor_i in zip(indices, starts, ancestor_indices):
+                # fall back is to simply take the first token
+                ancestors[i] = doc[int(ancestor_i) if ancestor_i != -1 else start]
+
+        normalized_tokens = []
+        for span, ancestor in zip(spans, ancestors):
+            normalized_token = self.to_span(ancestor)
+
+            if len(normalized_token) != 1:
+                error_message = (
+                    f"None of the tokens in the span ({span}) contains an"
+                    + " ancestor within this span."
+                )
 
-            if raise_error:
-                warn(error_message)
+                if raise_error:
+                    warn(error_message)
+            normalized_tokens.append(normalized_token)
 
-        return normalized_token
+        return normalized_tokens
 
     def __call__(self, doc: Doc):
         """Run the pipeline component."""
@@ -1,16 +1,16 @@
 """Pydantic data classes for the relation extraction using prompt-based
 models."""
 
-from copy import copy
-from difflib import SequenceMatcher
-from functools import partial
+from functools import lru_cache, partial
 from typing import (
     Any,
     Dict,
+    Hashable,
     Iterable,
     Iterator,
     List,
     Literal,
+    NamedTuple,
     Optional,
     Sequence,
     Tuple,
@@ -20,6 +20,7 @@ from typing import (
 import numpy as np
 import spacy
 from pydantic import BaseModel, Extra
+from scipy.optimize import linear_sum_assignment
 from spacy import displacy
 from spacy.tokens import Doc, Span, Token
 
@@ -92,6 +93,108 @@ def subspan_of_span(
     return potential_spans
 
 
+def _normalize_tokens(
+    tokens: Iterable[Token],
+    lowercase: bool,
+    ignore_spaces: bool,
+) -> Tuple[List[str], List[int]]:
+    """Get the normalized texts of the tokens as compared by `subspan_of_span`
+    along with their indices in the doc."""
+    keys, idxs = [], []
+    for token in tokens:
+        key = token.text.strip() if ignore_spaces else token.text_with_ws
+        if ignore_spaces and key == "":
+            continue
+        keys.append(key.lower() if lowercase else key)
+        idxs.append(token.i)
+    return keys, idxs
+
+
+class SpanIndex:
+    """An index of the normalized tokens of a doc for finding the spans which
+    are string-equal to a subspan, as `subspan_of_span` does, without scanning
+    the doc for every subspan.
+
+    The index maps each normalized token text to its positions, and the
+    candidates starting with the first token of a subspan are compared with
+    the remaining tokens. The tables are built lazily for each combination
+    of lowercase and ignore_spaces.
+
+    Args:
+        doc: The doc, or a span of the doc, to index.
+    """
+
+    def __init__(self, doc: Union[Doc, Span]):
+        self.span = doc
+        self.doc = doc.doc if isinstance(doc, Span) else doc
+        self._tables: Dict[
+            Tuple[bool, bool],
+            Tuple[List[str], List[int], Dict[str, List[int]]],
+        ] = {}
+        self._sents: Optional[List[Span]] = None
+
+    @property
+    def sents(self) -> List[Span]:
+        """The sentences of the indexed doc or span."""
+        if self._sents is None:
+            self._sents = list(self.span.sents)
+        return self._sents
+
+    def _table(
+        self,
+        lowercase: bool,
+        ignore_spaces: bool,
+    ) -> Tuple[List[str], List[int], Dict[str, List[int]]]:
+        key = (lowercase, ignore_spaces)
+        if key not in self._tables:
+            keys, idxs = _normalize_tokens(self.doc, lowercase, ignore_spaces)
+            positions: Dict[str, List[int]] = {}
+            for position, token_key in enumerate(keys):
+                positions.setdefault(token_key, []).append(position)
+            self._tables[key] = (keys, idxs, positions)
+        return self._tables[key]
+
+    def find(
+        self,
+        subspan: Union[Span, Doc],
+        span: Union[Span, Doc],
+        lowercase: bool = False,
+        ignore_spaces: bool = False,
+    ) -> List[Span]:
+        """Find the spans within span which are string-equal to the subspan.
+
+        Args:
+            subspan: The span to search for, typically from another doc.
+            span: A span of the indexed doc to search within.
+            lowercase: whether to compare lowercased texts.
+            ignore_spaces: whether to ignore whitespace tokens and trailing
+                whitespace.
+
+        Returns:
+            The matching spans in the order of the doc, as `subspan_of_span`.
+        """
+        if not span:
+            return []
+        if isinstance(span, Doc):
+            span = span[:]
+        sub_keys, _ = _normalize_tokens(subspan, lowercase, ignore_spaces)
+        n_tokens = len(sub_keys)
+        if n_tokens == 0:
+            return []
+
+        keys, idxs, positions = self._table(lowercase, ignore_spaces)
+        matches = []
+        for position in positions.get(sub_keys[0], []):
+            if idxs[position] < span.start:
+                continue
+            last = position + n_tokens - 1
+            if last >= len(keys) or idxs[last] >= span.end:
+                break
+            if keys[position : last + 1] == sub_keys:
+                matches.append(self.doc[idxs[position] : idxs[last] + 1])
+        return matches
+
+
 class StringTriplet(BaseModel):
     class Config:
         extra = Extra.forbid
@@ -136,10 +239,89 @@ class StringTriplet(BaseModel):
         return False
 
 
+@lru_cache(maxsize=None)
+def _blank_nlp(lang: str) -> spacy.Language:
+    """A blank pipeline for tokenizing triplets, created once per language."""
+    nlp = spacy.blank(lang)
+    nlp.add_pipe("sentencizer")
+    return nlp
+
+
+def _match_masks(b: Iterable[Hashable]) -> Dict[Hashable, int]:
+    """Bit masks of the positions of each element in b, i.e. bit j of the mask
+    of x is set if b[j] == x."""
+    masks: Dict[Hashable, int] = {}
+    for j, x in enumerate(b):
+        masks[x] = masks.get(x, 0) | 1 << j
+    return masks
+
+
+def _lcs_size_from_masks(a: Iterable[Hashable], masks: Dict[Hashable, int]) -> int:
+    """The size of the longest common substring of a and the sequence b with
+    the match masks `masks`.
+
+    Bit-parallel over the positions of b: runs[k] holds the positions of b
+    at which a common substring of length k + 1 ends in the current
+    position of a, so each element of a costs one shift and AND per run
+    length still alive.
+    """
+    longest = 0
+    runs: List[int] = []
+    for x in a:
+        mask = masks.get(x, 0)
+        if not mask:
+            runs = []
+            continue
+        extended = [mask]
+        for run in runs:
+            run = mask & run << 1
+            if not run:
+                break
+            extended.append(run)
+        runs = extended
+        longest = max(longest, len(runs))
+    return longest
+
+
 def _lcs_size(a: Sequence, b: Sequence) -> int:
-    """Return the size of the longest common subsequence."""
-    s = SequenceMatcher(None, a, b)
-    return s.find_longest_match().size
+    """Return the size of the longest common substring, i.e. of the longest
+    contiguous run of elements shared by a and b."""
+    if len(a) < len(b):
+        a, b = b, a
+    return _lcs_size_from_masks(a, _match_masks(b))
+
+
+def lcs_sizes(pairs: Iterable[Tuple[Sequence, Sequence]]) -> List[int]:
+    """The size of the longest common substring of many pairs of sequences.
+
+    The match masks are computed once for each unique second sequence,
+    so the pairs are best grouped by their second sequence, as in
+    `lcs_size_matrix`. The sequences may be unhashable, e.g. lists of
+    tokens.
+    """
+    masks: Dict[Hashable, Dict[Hashable, int]] = {}
+    sizes = []
+    for a, b in pairs:
+        key = b if isinstance(b, str) else tuple(b)
+        if key not in masks:
+            masks[key] = _match_masks(b)
+        sizes.append(_lcs_size_from_masks(a, masks[key]))
+    return sizes
+
+
+def lcs_size_matrix(a: Sequence[Sequence], b: Sequence[Sequence]) -> np.ndarray:
+    """The size of the longest common substring of each pair of sequences in
+    a and b.
+
+    Returns:
+        An integer array of shape (len(a), len(b)).
+    """
+    sizes = np.zeros((len(a), len(b)), dtype=np.int64)
+    for j, b_j in enumerate(b):
+        masks = _match_masks(b_j)
+        for i, a_i in enumerate(a):
+            sizes[i, j] = _lcs_size_from_masks(a_i, masks)
+    return sizes
 
 
 class SpanTriplet(BaseModel):
@@ -273,7 +455,22 @@ class SpanTriplet(BaseModel):
         span = doc[json["start"] : json["end"]]
         return span
 
-    def to_dict(self, include_doc=True, include_span_heads=False) -> Dict[str, Any]:
+    def to_dict(
+        self,
+        include_doc=True,
+        include_span_heads=False,
+        span_heads: Optional[Tuple[Span, Span]] = None,
+    ) -> Dict[str, Any]:
+        """Convert the triplet to a JSON serializable dict.
+
+        Args:
+            include_doc: whether to include the JSON of the doc.
+            include_span_heads: whether to include the heads of the subject and
+                object.
+            span_heads: precomputed heads of the subject and object, e.g. from
+                `doc._.most_common_ancestors`. If None and include_span_heads is
+                True, they are found using the `most_common_ancestor` extension.
+        """
         if include_doc:
             data = self.span.doc.to_json()
         else:
@@ -281,11 +478,16 @@ class SpanTriplet(BaseModel):
         data["subject"] = self.span_to_json(self.subject)
         data["predicate"] = self.span_to_json(self.predicate)
         data["object"] = self.span_to_json(self.object)
-        if include_span_heads and Span.has_extension("most_common_ancestor"):
-            subject_head = self.subject._.most_common_ancestor.text
-            data["subject"]["head"] = subject_head
-            object_head = self.object._.most_common_ancestor.text
-            data["object"]["head"] = object_head
+        if include_span_heads and span_heads is None:
+            if Span.has_extension("most_common_ancestor"):
+                span_heads = (
+                    self.subject._.most_common_ancestor,
+                    self.object._.most_common_ancestor,
+                )
+        if include_span_heads and span_heads is not None:
+            subject_head, object_head = span_heads
+            data["subject"]["head"] = subject_head.text
+            data["object"]["head"] = object_head.text
 
         return data
 
@@ -439,6 +641,7 @@ class SpanTriplet(BaseModel):
         span: Union[Span, Doc],
         lowercase: Optional[bool] = None,
         ignore_spaces: Optional[bool] = True,
+        span_index: Optional[SpanIndex] = None,
     ) -> Optional["SpanTriplet"]:
         """Checks if the triplet contained within the doc based on overlap of
         span tokens.
@@ -454,6 +657,8 @@ class SpanTriplet(BaseModel):
             ignore_spaces: Whether to ignore spaces when comparing
                 spans. Defaults to True. If None it will first try to match the triplet
                 with spaces and then fallback to ignoring spaces.
+            span_index: An index of the doc of the span. If given, it is used to
+                find the subspans instead of scanning the span.
 
         Returns:
             Optional[SpanTriplet]: A SpanTriplet object. Returns None if the triplet is
@@ -468,6 +673,7 @@ class SpanTriplet(BaseModel):
                 span,
                 lowercase=lowercase,
                 ignore_spaces=False,
+                span_index=span_index,
             )
             if spantriplet is not None:
                 return spantriplet
@@ -476,12 +682,14 @@ class SpanTriplet(BaseModel):
                 span,
                 lowercase=lowercase,
                 ignore_spaces=True,
+                span_index=span_index,
             )
         if lowercase is None:
             spantriplet = SpanTriplet.span_triplet_from_span_triplet(
                 triplet,
                 span,
                 lowercase=False,
+                span_index=span_index,
             )
             if spantriplet is not None:
                 return spantriplet
@@ -489,10 +697,11 @@ class SpanTriplet(BaseModel):
                 triplet,
                 span,
                 lowercase=True,
+                span_index=span_index,
             )
 
         _subspan_of_span = partial(
-            subspan_of_span,
+            subspan_of_span if span_index is None else span_index.find,
             lowercase=lowercase,
             ignore_spaces=ignore_spaces,
         )
@@ -561,6 +770,7 @@ class SpanTriplet(BaseModel):
         method: Optional[Literal["span", "text"]] = None,
         lowercase: Optional[bool] = None,
         ignore_spaces: Optional[bool] = True,
+        span_index: Optional[SpanIndex] = None,
     ) -> Optional["SpanTriplet"]:
         """Converts the StringTriplet to a SpanTriplet. First checks if the
         span is contained within a singular sentence, then it checks if the
@@ -581,6 +791,9 @@ class SpanTriplet(BaseModel):
             ignore_spaces: Whether to ignore spaces when comparing spans. Defaults to
                 True. If None it will first try to match the triplet with spaces and
                 then fallback to ignoring spaces.
+            span_index: A SpanIndex of the doc. When converting many triplets of the
+                same doc, pass the same index to avoid scanning the doc for every
+                triplet.
 
         Returns:
             A SpanTriplet object. Returns None if the triplet is not contained in the
@@ -609,6 +822,7 @@ class SpanTriplet(BaseModel):
                 method="span",
                 lowercase=lowercase,
                 ignore_spaces=ignore_spaces,
+                span_index=span_index,
             )
             if span_triplet is not None:
                 return span_triplet
@@ -619,14 +833,14 @@ class SpanTriplet(BaseModel):
                 method="text",
                 lowercase=lowercase,
                 ignore_spaces=ignore_spaces,
+                span_index=span_index,
             )
         if nlp is None:
             if isinstance(doc, Span):
                 lang = doc.doc.lang_
             else:
                 lang = doc.lang_
-            nlp = spacy.blank(lang)
-            nlp.add_pipe("sentencizer")
+            nlp = _blank_nlp(lang)
 
         if method == "span":
             triplet = tuple([doc[:] for doc in nlp.pipe(triplet)])  # type: ignore
@@ -637,13 +851,15 @@ class SpanTriplet(BaseModel):
             "span": partial(
                 SpanTriplet.span_triplet_from_span_triplet,
                 ignore_spaces=ignore_spaces,
+                span_index=span_index,
             ),
             "text": SpanTriplet.span_triplet_from_text_triplet,
         }
 
         span_triplet_from = span_triplet_from_mapping[method]
 
-        for sent in doc.sents:  # type: ignore
+        sents = doc.sents if span_index is None else span_index.sents
+        for sent in sents:  # type: ignore
             span_triplet = span_triplet_from(
                 triplet,
                 sent,
@@ -705,6 +921,166 @@ class SpanTriplet(BaseModel):
         return triplet_is_equal
 
 
+class RelationArrays(NamedTuple):
+    """The span triplets of a doc as arrays, which are cheap to score and to
+    send to other processes.
+
+    Attributes:
+        offsets: The token start and end of the subject, predicate and object of
+            each triplet, shape (n_triplets, 3, 2).
+        texts: The texts of the subject, predicate and object of each triplet.
+        doc_ids: Identifies the Doc object of each triplet.
+        doc_text_ids: Identifies the text of the doc of each triplet.
+    """
+
+    offsets: np.ndarray
+    texts: List[Tuple[str, str, str]]
+    doc_ids: np.ndarray
+    doc_text_ids: np.ndarray
+
+
+def relation_arrays(
+    reference: List[SpanTriplet],
+    predicted: List[SpanTriplet],
+) -> Tuple[RelationArrays, RelationArrays]:
+    """Convert reference and predicted span triplets to arrays for
+    `score_relation_arrays`."""
+    doc_ids: Dict[int, int] = {}
+    doc_text_ids: Dict[str, int] = {}
+
+    def to_arrays(triplets: List[SpanTriplet]) -> RelationArrays:
+        offsets = np.array(
+            [[(span.start, span.end) for span in t.triplet] for t in triplets],
+            dtype=np.int64,
+        ).reshape(-1, 3, 2)
+        docs = [t.doc for t in triplets]
+        return RelationArrays(
+            offsets=offsets,
+            texts=[tuple(span.text for span in t.triplet) for t in triplets],
+            doc_ids=np.array(
+                [doc_ids.setdefault(id(doc), len(doc_ids)) for doc in docs],
+                dtype=np.int64,
+            ),
+            doc_text_ids=np.array(
+                [doc_text_ids.setdefault(doc.text, len(doc_text_ids)) for doc in docs],
+                dtype=np.int64,
+            ),
+        )
+
+    return to_arrays(reference), to_arrays(predicted)
+
+
+def _string_overlap_matrix(
+    reference_texts: List[Tuple[str, str, str]],
+    predicted_texts: List[Tuple[str, str, str]],
+) -> np.ndarray:
+    """The normalized string overlap of each pair of reference and predicted
+    triplets, computed once for each pair of unique element texts."""
+    overlaps = np.zeros((len(reference_texts), len(predicted_texts)))
+    if not reference_texts or not predicted_texts:
+        return overlaps
+    for element in range(3):
+        ref_unique, ref_inverse = np.unique(
+            [texts[element] for texts in reference_texts],
+            return_inverse=True,
+        )
+        pred_unique, pred_inverse = np.unique(
+            [texts[element] for texts in predicted_texts],
+            return_inverse=True,
+        )
+        ref_unique, pred_unique = ref_unique.tolist(), pred_unique.tolist()
+        sizes = lcs_size_matrix(ref_unique, pred_unique)
+        lengths = np.array([max(len(text), 1) for text in ref_unique])
+        overlaps += (sizes / lengths[:, None])[np.ix_(ref_inverse, pred_inverse)]
+    return overlaps / 3
+
+
+def score_relation_arrays(
+    reference: RelationArrays,
+    predicted: RelationArrays,
+) -> Dict[str, Any]:
+    """Score predicted relations against reference relations.
+
+    The overlaps of all pairs of relations are computed at once, and the
+    relations are paired using an optimal assignment which maximizes the
+    number of exact span matches, then the number of exact string matches
+    and then the normalized string overlap.
+
+    Args:
+        reference: The reference relations, see `relation_arrays`.
+        predicted: The predicted relations.
+
+    Returns:
+        The number of exact span and string matches, the summed normalized
+            span and string overlaps of the paired relations, and the number of
+            predicted and reference relations.
+    """
+    n_ref, n_pred = len(reference.texts), len(predicted.texts)
+    score = {
+        "exact_span_match": 0,
+        "exact_string_match": 0,
+        "normalized_span_overlap": 0.0,
+        "normalized_string_overlap": 0.0,
+        "length_self": n_pred,
+        "length_reference": n_ref,
+    }
+    if n_ref == 0 or n_pred == 0:
+        return score
+
+    ref_starts = reference.offsets[:, None, :, 0]
+    ref_ends = reference.offsets[:, None, :, 1]
+    pred_starts = predicted.offsets[None, :, :, 0]
+    pred_ends = predicted.offsets[None, :, :, 1]
+
+    # tokens are only equal within the same Doc object, so spans of different
+    # docs do not overlap
+    same_doc = reference.doc_ids[:, None] == predicted.doc_ids[None, :]
+    intersection = np.clip(
+        np.minimum(ref_ends, pred_ends) - np.maximum(ref_starts, pred_starts),
+        0,
+        None,
+    )
+    ref_lengths = np.maximum(ref_ends - ref_starts, 1)
+    span_overlap = (intersection / ref_lengths).mean(axis=2) * same_doc
+
+    text_ids: Dict[str, int] = {}
+    ref_text_ids = np.array(
+        [[text_ids.setdefault(t, len(text_ids)) for t in ts] for ts in reference.texts],
+    )
+    pred_text_ids = np.array(
+        [[text_ids.setdefault(t, len(text_ids)) for t in ts] for ts in predicted.texts],
+    )
+    string_match = (ref_text_ids[:, None, :] == pred_text_ids[None, :, :]).all(axis=2)
+    span_match = (
+        string_match
+        & (reference.doc_text_ids[:, None] == predicted.doc_text_ids[None, :])
+        & (ref_starts == pred_starts).all(axis=2)
+        & (ref_ends == pred_ends).all(axis=2)
+    )
+    string_overlap = np.where(
+        string_match,
+        1.0,
+        _string_overlap_matrix(reference.texts, predicted.texts),
+    )
+    span_overlap = np.where(span_match, 1.0, span_overlap)
+
+    # weights prioritizing span matches over any number of string matches, and
+    # string matches over any sum of string overlaps
+    n_pairs = min(n_ref, n_pred)
+    string_weight = n_pairs + 1
+    span_weight = string_weight * (n_pairs + 1)
+    weights = span_weight * span_match + string_weight * string_match + string_overlap
+    ref_idxs, pred_idxs = linear_sum_assignment(weights, maximize=True)
+
+    score["exact_span_match"] = int(span_match[ref_idxs, pred_idxs].sum())
+    score["exact_string_match"] = int(string_match[ref_idxs, pred_idxs].sum())
+    score["normalized_span_overlap"] = float(span_overlap[ref_idxs, pred_idxs].sum())
+    score["normalized_string_overlap"] = float(
+        string_overlap[ref_idxs, pred_idxs].sum(),
+    )
+    return score
+
+
 class DocTriplets(BaseModel):
     """A class containing the relations of a documents."""
 
@@ -721,99 +1097,29 @@ class DocTriplets(BaseModel):
         triplets: List[StringTriplet],
     ) -> "DocTriplets":
         span_triplets = []
+        # index the doc once for all triplets
+        span_index = SpanIndex(doc)
         for triplet in triplets:
-            span_triplet = SpanTriplet.from_doc(triplet=triplet, doc=doc)
+            span_triplet = SpanTriplet.from_doc(
+                triplet=triplet,
+                doc=doc,
+                span_index=span_index,
+            )
             if span_triplet is not None:
                 span_triplets.append(span_triplet)
         return DocTriplets(span_triplets=span_triplets, doc=doc)
 
     def score_relations(self, reference: "DocTriplets") -> Dict[str, Any]:
         """Score the relations of the doctriplet against the relations of the
-        current doctriplet."""
-        self_relations = list(self)
-        reference_relations = list(reference)
-        self_relations.sort(key=lambda x: x.subject.text)
-        reference_relations.sort(key=lambda x: x.subject.text)
-
-        score = {
-            "exact_span_match": 0,
-            "exact_string_match": 0,
-            "normalized_span_overlap": 0.0,
-            "normalized_string_overlap": 0.0,
-            "length_self": len(self_relations),
-            "length_reference": len(reference_relations),
-        }
-
-        if score["length_reference"] == 0:
-            return score
-
-        _self_relations = copy(self_relations)
-        missing_matches = {}
-
-        for ref_i, ref_rel in enumerate(reference_relations):
-            span_norm_overlap = []
-            string_norm_overlap = []
-            span_match_found = False
-            string_match_found = False
-
-            if not _self_relations:
-                break
-
-            for self_i, self_rel in enumerate(_self_relations):
-                if self_rel == ref_rel:
-                    span_match_found = True
-                    break
-
-                if self_rel.is_string_match(ref_rel):
-                    string_match_found = True
-                    s_norm_overlap = ref_rel.normalized_span_overlap(self_rel)
-
-                if not string_match_found:
-                    str_norm_overlap = ref_rel.normalized_string_overlap(self_rel)
-                    s_norm_overlap = ref_rel.normalized_span_overlap(self_rel)
-                    string_norm_overlap.append(str_norm_overlap)
-                    span_norm_overlap.append(s_norm_overlap)
-
-            if span_match_found:
-                score["exact_span_match"] += 1
-                score["exact_string_match"] += 1
-                score["normalized_string_overlap"] += 1
-                score["normalized_span_overlap"] += 1
-                _self_relations.pop(self_i)
-                continue
-            if string_match_found:
-                score["exact_string_match"] += 1
-                score["normalized_string_overlap"] += 1
-                score["normalized_span_overlap"] += s_norm_overlap
-                _self_relations.pop(self_i)
-                continue
-            # if not match then just record the best match
-            which_max = np.argmax(string_norm_overlap)
-            missing_matches[ref_i] = {
-                "span_norm_overlap": span_norm_overlap[which_max],
-                "string_norm_overlap": string_norm_overlap[which_max],
-                "self_i": which_max,
-            }
+        current doctriplet.
 
-        if missing_matches and _self_relations:
-            # if there are missing matches and there are still self relations
-            # then we can try to match them
-
-            # sort the missing matches by the string norm overlap
-            _missing_matches = [
-                (k, v)
-                for k, v in sorted(
-                    missing_matches.items(),
-                    key=lambda item: item[1]["string_norm_overlap"],  # type: ignore
-                )
-            ]
-
-            while _missing_matches and _self_relations:
-                ref_i, match = _missing_matches.pop()
-                score["normalized_string_overlap"] += match["string_norm_overlap"]
-                score["normalized_span_overlap"] += match["span_norm_overlap"]
-                _self_relations.pop()  # just pop any self relation
-        return score
+        The relations are paired using an optimal assignment which
+        maximizes the number of exact span matches, then the number of
+        exact string matches and then the normalized string overlap.
+        """
+        return score_relation_arrays(
+            *relation_arrays(list(reference), list(self)),
+        )
 
     def __getitem__(self, index: int) -> SpanTriplet:
         return self.span_triplets[index]
@@ -844,6 +1150,219 @@ class DocTriplets(BaseModel):
         return True
 
 
+class TripletOffsets:
+    """A compact, array-backed representation of the triplets of one or more
+    docs for bulk processing.
+
+    Unlike SpanTriplet, it holds no spaCy objects, so it is cheap to create,
+    copy, send to other processes and serialize. Convert to SpanTriplets
+    with `to_span_triplets` when Span objects are needed.
+
+    Attributes:
+        doc_idxs: The index of the doc of each triplet, shape (n_triplets,).
+        offsets: The token start and end of the subject, predicate and object of
+            each triplet, shape (n_triplets, 6).
+        confidences: The confidence of each triplet, NaN if unknown.
+        heads: The token start and end of the heads of the subject and object of
+            each triplet, shape (n_triplets, 4), -1 if unknown.
+    """
+
+    __slots__ = ("doc_idxs", "offsets", "confidences", "heads")
+
+    def __init__(
+        self,
+        doc_idxs: Union[Sequence[int], np.ndarray],
+        offsets: Union[Sequence[Sequence[int]], np.ndarray],
+        confidences: Optional[Union[Sequence[float], np.ndarray]] = None,
+        heads: Optional[Union[Sequence[Sequence[int]], np.ndarray]] = None,
+    ):
+        self.offsets = np.asarray(offsets, dtype=np.int32).reshape(-1, 6)
+        n_triplets = len(self.offsets)
+        self.doc_idxs = np.asarray(doc_idxs, dtype=np.int64).reshape(n_triplets)
+        if confidences is None:
+            self.confidences = np.full(n_triplets, np.nan, dtype=np.float32)
+        else:
+            self.confidences = np.asarray(confidences, dtype=np.float32).reshape(
+                n_triplets,
+            )
+        if heads is None:
+            self.heads = np.full((n_triplets, 4), -1, dtype=np.int32)
+        else:
+            self.heads = np.asarray(heads, dtype=np.int32).reshape(n_triplets, 4)
+
+    @staticmethod
+    def concatenate(triplets: Sequence["TripletOffsets"]) -> "TripletOffsets":
+        """Concatenate the triplets of several TripletOffsets."""
+        if not triplets:
+            return TripletOffsets(doc_idxs=[], offsets=[])
+        return TripletOffsets(
+            doc_idxs=np.concatenate([t.doc_idxs for t in triplets]),
+            offsets=np.concatenate([t.offsets for t in triplets]),
+            confidences=np.concatenate([t.confidences for t in triplets]),
+            heads=np.concatenate([t.heads for t in triplets]),
+        )
+
+    @staticmethod
+    def from_idx_tuples(
+        idx_tuples: Sequence[Tuple[Tuple[int, int], ...]],
+        doc_idx: int = 0,
+        confidences: Optional[Sequence[float]] = None,
+    ) -> "TripletOffsets":
+        """Create from index tuples as stored in `doc._.relation_triplet_idxs`."""
+        return TripletOffsets(
+            doc_idxs=np.full(len(idx_tuples), doc_idx),
+            offsets=np.array(idx_tuples, dtype=np.int32).reshape(-1, 6),
+            confidences=confidences,
+        )
+
+    @staticmethod
+    def from_doc(doc: Doc, doc_idx: int = 0) -> "TripletOffsets":
+        """Create from the triplets of a doc without creating any Spans.
+
+        The confidences are taken from `doc._.relation_confidence` if it
+        holds a confidence for each triplet.
+        """
+        idx_tuples = doc._.relation_triplet_idxs
+        confidences = doc._.relation_confidence
+        if confidences is None or np.ndim(confidences) != 1:
+            confidences = None
+        elif len(confidences) != len(idx_tuples):
+            confidences = None
+        return TripletOffsets.from_idx_tuples(idx_tuples, doc_idx, confidences)
+
+    @staticmethod
+    def from_docs(docs: Iterable[Doc]) -> "TripletOffsets":
+        """Create from the triplets of several docs, indexed by their order."""
+        return TripletOffsets.concatenate(
+            [TripletOffsets.from_doc(doc, doc_idx=i) for i, doc in enumerate(docs)],
+        )
+
+    @staticmethod
+    def from_span_triplets(
+        triplets: Sequence[SpanTriplet],
+        doc_idx: int = 0,
+        confidences: Optional[Sequence[float]] = None,
+        heads: Optional[Sequence[Tuple[Span, Span]]] = None,
+    ) -> "TripletOffsets":
+        """Create from span triplets of a single doc.
+
+        Args:
+            triplets: The span triplets.
+            doc_idx: The index of their doc.
+            confidences: The confidence of each triplet.
+            heads: The heads of the subject and object of each triplet.
+        """
+        return TripletOffsets(
+            doc_idxs=np.full(len(triplets), doc_idx),
+            offsets=[
+                [i for span in triplet.triplet for i in (span.start, span.end)]
+                for triplet in triplets
+            ],
+            confidences=confidences,
+            heads=(
+                None
+                if heads is None
+                else [[s.start, s.end, o.start, o.end] for s, o in heads]
+            ),
+        )
+
+    def to_idx_tuples(self) -> List[Tuple[Tuple[int, int], ...]]:
+        """Convert to index tuples as stored in `doc._.relation_triplet_idxs`."""
+        return [
+            ((s_start, s_end), (p_start, p_end), (o_start, o_end))
+            for s_start, s_end, p_start, p_end, o_start, o_end in self.offsets.tolist()
+        ]
+
+    def to_span_triplets(self, docs: Sequence[Doc]) -> List[SpanTriplet]:
+        """Convert to span triplets.
+
+        Args:
+            docs: The docs the doc indices refer to.
+        """
+        return [
+            SpanTriplet.from_tuple(
+                (
+                    docs[doc_idx][s_start:s_end],
+                    docs[doc_idx][p_start:p_end],
+                    docs[doc_idx][o_start:o_end],
+                ),
+            )
+            for doc_idx, (s_start, s_end, p_start, p_end, o_start, o_end) in zip(
+                self.doc_idxs.tolist(),
+                self.offsets.tolist(),
+            )
+        ]
+
+    def to_dicts(self, doc: Doc) -> List[Dict[str, Any]]:
+        """Convert to the JSON serializable dicts of `SpanTriplet.to_dict` with
+        include_doc=False. Heads are included where they are known.
+
+        Args:
+            doc: The doc of the triplets.
+        """
+        dicts = []
+        for offsets, heads in zip(self.offsets.tolist(), self.heads.tolist()):
+            data = {
+                key: {
+                    "text": doc[start:end].text,
+                    "start": start,
+                    "end": end,
+                }
+                for key, start, end in zip(
+                    ("subject", "predicate", "object"),
+                    offsets[::2],
+                    offsets[1::2],
+                )
+            }
+            if heads[0] != -1:
+                data["subject"]["head"] = doc[heads[0] : heads[1]].text
+            if heads[2] != -1:
+                data["object"]["head"] = doc[heads[2] : heads[3]].text
+            dicts.append(data)
+        return dicts
+
+    @staticmethod
+    def from_dicts(
+        dicts: Sequence[Dict[str, Any]],
+        doc_idx: int = 0,
+    ) -> "TripletOffsets":
+        """Create from the dicts of `SpanTriplet.to_dict`."""
+        return TripletOffsets(
+            doc_idxs=np.full(len(dicts), doc_idx),
+            offsets=[
+                [
+                    data[key][i]
+                    for key in ("subject", "predicate", "object")
+                    for i in ("start", "end")
+                ]
+                for data in dicts
+            ],
+        )
+
+    def __getitem__(self, index: Union[int, slice, np.ndarray]) -> "TripletOffsets":
+        if isinstance(index, (int, np.integer)):
+            index = slice(index, index + 1 if index != -1 else None)
+        return TripletOffsets(
+            doc_idxs=self.doc_idxs[index],
+            offsets=self.offsets[index],
+            confidences=self.confidences[index],
+            heads=self.heads[index],
+        )
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, TripletOffsets):
+            return False
+        return (
+            np.array_equal(self.doc_idxs, other.doc_idxs)
+            and np.array_equal(self.offsets, other.offsets)
+            and np.array_equal(self.confidences, other.confidences, equal_nan=True)
+            and np.array_equal(self.heads, other.heads)
+        )
+
+
 def span_to_idx(span: Span) -> Tuple[int, int]:
     return span.start, span.end
 
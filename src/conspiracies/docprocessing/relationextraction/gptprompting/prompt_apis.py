@@ -1,14 +1,62 @@
-import random
+import asyncio
+import logging
 import time
-from typing import Any, Dict, List
-
-from spacy.tokens import Doc
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
 
+from conspiracies.docprocessing.relationextraction.gptprompting.prompt_cache import (
+    PromptResponseCache,
+)
 from conspiracies.docprocessing.relationextraction.gptprompting.prompt_templates import (
     PromptTemplate,
 )
+from conspiracies.docprocessing.relationextraction.gptprompting.rate_limiting import (
+    TokenBucket,
+    send_concurrently,
+)
 from conspiracies.registry import registry
 
+# the number of tokens in the context window of OpenAI models, matched on the
+# longest prefix of the model name
+MODEL_CONTEXT_WINDOWS = {
+    "text-davinci-002": 4097,
+    "text-davinci-003": 4097,
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+
+
+def get_max_prompt_tokens(
+    model_name: str,
+    api_kwargs: Dict[Any, Any],
+) -> Optional[int]:
+    """Get the maximum number of tokens of a prompt for a model, i.e. the size
+    of its context window minus the tokens reserved for the completion.
+
+    Returns:
+        The maximum number of prompt tokens, or None if the context window of
+            the model is unknown.
+    """
+    prefixes = [name for name in MODEL_CONTEXT_WINDOWS if model_name.startswith(name)]
+    if not prefixes:
+        return None
+    context_window = MODEL_CONTEXT_WINDOWS[max(prefixes, key=len)]
+    return context_window - api_kwargs.get("max_tokens", 0)
+
+
+def _import_openai():
+    try:
+        import openai
+    except ImportError:
+        raise ImportError(
+            "The OpenAI API requires the openai package to be installed. "
+            "You can install the requirements for this module using "
+            "`pip install conspiracies[openai]`.",
+        )
+    return openai
+
 
 @registry.prompt_apis.register("conspiracies/openai_gpt3_api")
 def create_openai_gpt3_prompt_api(
@@ -19,15 +67,7 @@ def create_openai_gpt3_prompt_api(
 ):
     def openai_prompt(targets: List[str]) -> List[str]:
         """"""
-        try:
-            import openai
-        except ImportError:
-            raise ImportError(
-                "The OpenAI API requires the openai package to be installed. "
-                "You can install the requirements for this module using "
-                "`pip install conspiracies[openai]`.",
-            )
-
+        openai = _import_openai()
         openai.api_key = api_key
 
         responses: List[str] = []
@@ -44,12 +84,14 @@ def create_openai_gpt3_prompt_api(
                     break
 
                 except openai.error.InvalidRequestError as e:
-                    print("Invalid request got error: ", e)
-                    print("Retrying with fewer examples...")
-                    # Randomly select an example to drop
-                    current_examples: List[Doc] = list(prompt_template.examples)
-                    current_examples.pop(random.randrange(len(current_examples)))
-                    prompt_template.set_examples(current_examples)  # type: ignore
+                    logging.warning(
+                        "Invalid request for target %s: %s",
+                        repr(target),
+                        e,
+                    )
+                    responses.append("")
+                    break
+
                 except openai.error.APIConnectionError:
                     print("Connection reset, waiting 20 sec then retrying...")
                     time.sleep(20)
@@ -68,15 +110,7 @@ def create_openai_chatgpt_prompt_api(
 ):
     def openai_prompt(targets: List[str]) -> List[str]:
         """"""
-        try:
-            import openai
-        except ImportError:
-            raise ImportError(
-                "The OpenAI API requires the openai package to be installed. "
-                "You can install the requirements for this module using "
-                "`pip install conspiracies[openai]`.",
-            )
-
+        openai = _import_openai()
         openai.api_key = api_key
         message_example = prompt_template.create_prompt("test")
         assert isinstance(message_example, list) and isinstance(
@@ -97,17 +131,432 @@ def create_openai_chatgpt_prompt_api(
                     responses.append(response["choices"][0]["message"]["content"])
                     break
 
-                except openai.error.InvalidRequestError:
-                    # Randomly select an example to drop
-                    current_examples = prompt_template.examples
-                    current_examples.pop(random.randrange(len(current_examples)))
-                    examples = current_examples
-                    prompt_template.set_examples(examples)  # type: ignore
+                except openai.error.InvalidRequestError as e:
+                    logging.warning(
+                        "Invalid request for target %s: %s",
+                        repr(target),
+                        e,
+                    )
+                    responses.append("")
+                    break
 
-                except openai.error.ConnectionResetError:
+                except openai.error.APIConnectionError:
                     print("Connection reset, waiting 20 sec then retrying...")
                     time.sleep(20)
 
         return responses
 
     return openai_prompt
+
+
+def _create_openai_async_prompt_api(
+    create_request: Callable[[str], Awaitable[str]],
+    max_concurrency: int,
+    requests_per_minute: Optional[float],
+    max_retries: int,
+    base_delay: float,
+    max_delay: float,
+) -> Callable[[List[str]], List[str]]:
+    openai = _import_openai()
+    import aiohttp  # installed along with openai
+
+    retry_on = (
+        openai.error.RateLimitError,
+        openai.error.APIConnectionError,
+        openai.error.ServiceUnavailableError,
+        openai.error.APIError,
+        openai.error.Timeout,
+        openai.error.TryAgain,
+    )
+    rate_limiter = (
+        TokenBucket.from_requests_per_minute(requests_per_minute)
+        if requests_per_minute
+        else None
+    )
+
+    async def send_request(target: str) -> str:
+        try:
+            return await create_request(target)
+        except openai.error.InvalidRequestError as e:
+            # retrying will not help, and the shared template must not be changed
+            # while other requests are in flight
+            logging.warning("Invalid request for target %s: %s", repr(target), e)
+            return ""
+
+    async def prompt_all(targets: List[str]) -> List[str]:
+        async with aiohttp.ClientSession() as session:
+            openai.aiosession.set(session)
+            return await send_concurrently(
+                targets,
+                send_request,
+                max_concurrency=max_concurrency,
+                rate_limiter=rate_limiter,
+                retry_on=retry_on,
+                max_retries=max_retries,
+                base_delay=base_delay,
+                max_delay=max_delay,
+            )
+
+    def openai_prompt(targets: List[str]) -> List[str]:
+        if not targets:
+            return []
+        return asyncio.run(prompt_all(targets))
+
+    return openai_prompt
+
+
+@registry.prompt_apis.register("conspiracies/openai_gpt3_async_api")
+def create_openai_gpt3_async_prompt_api(
+    prompt_template: PromptTemplate,
+    api_key: str,
+    model_name: str,
+    api_kwargs: Dict[Any, Any],
+    max_concurrency: int = 8,
+    requests_per_minute: Optional[float] = None,
+    max_retries: int = 6,
+    base_delay: float = 1.0,
+    max_delay: float = 60.0,
+    api_base: Optional[str] = None,
+):
+    """Creates a prompt function which sends the requests for all targets
+    concurrently using asyncio.
+
+    Args:
+        prompt_template: The template used to create the prompt for each target.
+        api_key: The OpenAI API key.
+        model_name: The name of the completion model.
+        api_kwargs: Extra keyword arguments for the completion request.
+        max_concurrency: Maximum number of requests in flight.
+        requests_per_minute: Maximum number of requests sent per minute. If None,
+            requests are only limited by max_concurrency.
+        max_retries: Maximum number of retries of a request on rate limit, connection
+            or server errors. Retries use exponential backoff with jitter.
+        base_delay: Base delay in seconds for the backoff between retries.
+        max_delay: Maximum delay in seconds between retries.
+        api_base: Base URL of the API, e.g. to use a proxy or a mock server.
+    """
+    openai = _import_openai()
+
+    async def create_request(target: str) -> str:
+        response = await openai.Completion.acreate(
+            model=model_name,
+            prompt=prompt_template.create_prompt(target),
+            api_key=api_key,
+            api_base=api_base,
+            **api_kwargs,
+        )
+        return response["choices"][0]["text"]
+
+    return _create_openai_async_prompt_api(
+        create_request,
+        max_concurrency=max_concurrency,
+        requests_per_minute=requests_per_minute,
+        max_retries=max_retries,
+        base_delay=base_delay,
+        max_delay=max_delay,
+    )
+
+
+@registry.prompt_apis.register("conspiracies/openai_chatgpt_async_api")
+def create_openai_chatgpt_async_prompt_api(
+    prompt_template: PromptTemplate,
+    api_key: str,
+    model_name: str,
+    api_kwargs: Dict[Any, Any],
+    max_concurrency: int = 8,
+    requests_per_minute: Optional[float] = None,
+    max_retries: int = 6,
+    base_delay: float = 1.0,
+    max_delay: float = 60.0,
+    api_base: Optional[str] = None,
+):
+    """Creates a prompt function which sends the chat completion requests for
+    all targets concurrently using asyncio.
+
+    See `create_openai_gpt3_async_prompt_api` for a description of the
+    arguments.
+    """
+    openai = _import_openai()
+    message_example = prompt_template.create_prompt("test")
+    assert isinstance(message_example, list) and isinstance(
+        message_example[0],
+        dict,
+    ), "ChatGPT requires a list of message dicts. Consider using chatGPTPromptTemplate as template."  # noqa: E501
+
+    async def create_request(target: str) -> str:
+        response = await openai.ChatCompletion.acreate(
+            model=model_name,
+            messages=prompt_template.create_prompt(target),
+            api_key=api_key,
+            api_base=api_base,
+            **api_kwargs,
+        )
+        return response["choices"][0]["message"]["content"]
+
+    return _create_openai_async_prompt_api(
+        create_request,
+        max_concurrency=max_concurrency,
+        requests_per_minute=requests_per_minute,
+        max_retries=max_retries,
+        base_delay=base_delay,
+        max_delay=max_delay,
+    )
+
+
+# OpenAI completion arguments which have no equivalent in generate
+_UNSUPPORTED_API_KWARGS = {
+    "frequency_penalty",
+    "presence_penalty",
+    "n",
+    "stop",
+    "logprobs",
+    "best_of",
+    "logit_bias",
+    "user",
+}
+
+
+def _to_generate_kwargs(api_kwargs: Dict[Any, Any]) -> Dict[Any, Any]:
+    """Map OpenAI style API arguments to arguments for the generate method of
+    Hugging Face models.
+
+    max_tokens is mapped to max_new_tokens and a temperature of 0 to
+    greedy decoding. Arguments without an equivalent are dropped, and
+    all other arguments are passed on as is.
+    """
+    generate_kwargs = {}
+    for key, value in api_kwargs.items():
+        if key in _UNSUPPORTED_API_KWARGS:
+            logging.debug("Ignoring unsupported API argument %s.", key)
+        elif key == "max_tokens":
+            generate_kwargs["max_new_tokens"] = value
+        elif key == "temperature":
+            generate_kwargs["do_sample"] = value > 0
+            if value > 0:
+                generate_kwargs["temperature"] = value
+        else:
+            generate_kwargs[key] = value
+    if not generate_kwargs.get("do_sample", False):
+        generate_kwargs.pop("top_p", None)
+    return generate_kwargs
+
+
+def _messages_to_text(messages: List[Dict[str, str]]) -> str:
+    """Flatten chat messages into a single prompt for models without a chat
+    format."""
+    text = "\n\n".join(
+        f"{message['role']}: {message['content']}" for message in messages
+    )
+    return text + "\n\nassistant:"
+
+
+@registry.prompt_apis.register("conspiracies/huggingface_local_api")
+def create_huggingface_local_prompt_api(
+    prompt_template: PromptTemplate,
+    api_key: str,
+    model_name: str,
+    api_kwargs: Dict[Any, Any],
+    batch_size: int = 8,
+    device: str = "cpu",
+    max_input_length: Optional[int] = None,
+):
+    """Creates a prompt function which runs a local Hugging Face seq2seq or
+    causal language model and generates the responses for batches of
+    targets.
+
+    Args:
+        prompt_template: The template used to create the prompt for each target.
+            Prompts consisting of chat messages are flattened into a single text.
+        api_key: Not used, but required for consistency with the other backends.
+        model_name: The name or path of the model on the Hugging Face hub.
+        api_kwargs: Arguments for the generation in the format of the OpenAI API,
+            e.g. {"max_tokens": 500, "temperature": 0}. Other arguments are
+            passed on to the generate method of the model.
+        batch_size: Number of targets to generate responses for at a time.
+        device: The device to run the model on.
+        max_input_length: Maximum number of tokens of a prompt. Longer prompts are
+            truncated from the left, such that the target is kept. Defaults to the
+            maximum length of the model, minus max_tokens for causal models.
+    """
+    import torch
+    from transformers import (
+        AutoConfig,
+        AutoModelForCausalLM,
+        AutoModelForSeq2SeqLM,
+        AutoTokenizer,
+    )
+
+    config = AutoConfig.from_pretrained(model_name)
+    is_encoder_decoder = config.is_encoder_decoder
+    if is_encoder_decoder:
+        model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_name)
+    model.to(device)
+    model.eval()
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer.truncation_side = "left"
+    if not is_encoder_decoder:
+        # generation continues from the end of the prompt
+        tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    generate_kwargs = _to_generate_kwargs(api_kwargs)
+    if max_input_length is None:
+        max_input_length = min(
+            tokenizer.model_max_length,
+            getattr(config, "max_position_embeddings", tokenizer.model_max_length),
+        )
+        if not is_encoder_decoder:
+            # the prompt and the generated tokens share the positions
+            max_input_length -= generate_kwargs.get("max_new_tokens", 0)
+
+    def create_prompt(target: str) -> str:
+        prompt = prompt_template.create_prompt(target)
+        if isinstance(prompt, list):
+            return _messages_to_text(prompt)
+        return prompt
+
+    def huggingface_prompt(targets: List[str]) -> List[str]:
+        prompts = [create_prompt(target) for target in targets]
+        # batch prompts of similar length to reduce padding
+        order = sorted(range(len(prompts)), key=lambda i: len(prompts[i]))
+        responses = [""] * len(prompts)
+        for start in range(0, len(order), batch_size):
+            batch_idxs = order[start : start + batch_size]
+            inputs = tokenizer(
+                [prompts[i] for i in batch_idxs],
+                return_tensors="pt",
+                padding=True,
+                truncation=True,
+                max_length=max_input_length,
+                return_token_type_ids=False,
+            ).to(device)
+            with torch.no_grad():
+                outputs = model.generate(
+                    **inputs,
+                    pad_token_id=tokenizer.pad_token_id,
+                    **generate_kwargs,
+                )
+            if not is_encoder_decoder:
+                outputs = outputs[:, inputs["input_ids"].shape[1] :]
+            decoded = tokenizer.batch_decode(outputs, skip_special_tokens=True)
+            for i, response in zip(batch_idxs, decoded):
+                responses[i] = response
+        return responses
+
+    return huggingface_prompt
+
+
+class CachedPromptAPI:
+    """A prompt function which looks up the responses in a persistent cache
+    and only sends the targets missing from the cache to the wrapped prompt
+    function.
+
+    Attributes:
+        hits: Number of targets answered from the cache.
+        misses: Number of targets not found in the cache.
+    """
+
+    def __init__(
+        self,
+        prompt_template: PromptTemplate,
+        model_name: str,
+        api_kwargs: Dict[Any, Any],
+        backend: str,
+        cache: PromptResponseCache,
+        prompt_fn: Optional[Callable[[List[str]], List[str]]] = None,
+    ):
+        self.prompt_template = prompt_template
+        self.model_name = model_name
+        self.api_kwargs = api_kwargs
+        self.backend = backend
+        self.cache = cache
+        self.prompt_fn = prompt_fn
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache_only(self) -> bool:
+        return self.prompt_fn is None
+
+    def create_key(self, target: str) -> str:
+        return self.cache.create_key(
+            backend=self.backend,
+            model_name=self.model_name,
+            api_kwargs=self.api_kwargs,
+            prompt=self.prompt_template.create_prompt(target),
+            target=target,
+        )
+
+    def __call__(self, targets: List[str]) -> List[str]:
+        keys = [self.create_key(target) for target in targets]
+        responses = self.cache.get_many(keys)
+        # send duplicated targets only once
+        missing = {key: target for key, target in zip(keys, targets)}
+        for key in responses:
+            missing.pop(key)
+        n_missing = sum(key not in responses for key in keys)
+        self.hits += len(keys) - n_missing
+        self.misses += n_missing
+
+        if missing and self.cache_only:
+            logging.warning(
+                "%d targets are not in the cache and are given empty responses.",
+                len(missing),
+            )
+        elif missing:
+            new_responses = self.prompt_fn(list(missing.values()))  # type: ignore
+            new_items = list(zip(missing.keys(), new_responses))
+            self.cache.set_many(new_items)
+            responses.update(new_items)
+        return [responses.get(key, "") for key in keys]
+
+
+@registry.prompt_apis.register("conspiracies/cached_api")
+def create_cached_prompt_api(
+    prompt_template: PromptTemplate,
+    api_key: str,
+    model_name: str,
+    api_kwargs: Dict[Any, Any],
+    backend: str,
+    cache_path: Union[str, Path],
+    cache_only: bool = False,
+    **backend_kwargs: Any,
+) -> CachedPromptAPI:
+    """Wraps a prompt API with a persistent cache of the responses, such that
+    re-running the extraction on the same corpus only pays for targets which
+    have not been prompted before.
+
+    Responses are keyed by the backend, model name, API arguments, rendered
+    prompt and target, so changing any of them leads to new requests.
+
+    Args:
+        prompt_template: The template used to create the prompt for each target.
+        api_key: The API key passed on to the wrapped backend.
+        model_name: The name of the model.
+        api_kwargs: Extra keyword arguments for the requests.
+        backend: The name of the wrapped prompt API in registry.prompt_apis.
+        cache_path: Path to the SQLite database storing the responses.
+        cache_only: If True, no requests are sent and targets missing from the cache
+            get an empty response.
+        backend_kwargs: Extra keyword arguments for the wrapped backend.
+    """
+    prompt_fn = None
+    if not cache_only:
+        prompt_fn = registry.prompt_apis.get(backend)(
+            prompt_template,
+            api_key,
+            model_name,
+            api_kwargs,
+            **backend_kwargs,
+        )
+    return CachedPromptAPI(
+        prompt_template=prompt_template,
+        model_name=model_name,
+        api_kwargs=api_kwargs,
+        backend=backend,
+        cache=PromptResponseCache(cache_path),
+        prompt_fn=prompt_fn,
+    )
@@ -0,0 +1,167 @@
+"""Offline batch jobs for prompt relation extraction.
+
+The prompts are written to JSONL request files in the format of the
+OpenAI Batch API, and the responses are read from the JSONL result
+files of the batch jobs.
+"""
+
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Union
+
+Prompt = Union[str, List[Dict[str, str]]]
+
+
+def create_custom_id(target: str) -> str:
+    """Create a custom id of the request for a target.
+
+    The id only depends on the target, such that it is stable between
+    runs and identical targets share a request.
+    """
+    return "target-" + hashlib.sha256(target.encode("utf-8")).hexdigest()[:32]
+
+
+def create_batch_request(
+    custom_id: str,
+    prompt: Prompt,
+    model_name: str,
+    api_kwargs: Dict[Any, Any],
+) -> Dict[str, Any]:
+    """Create a request in the format of the OpenAI Batch API.
+
+    Prompts consisting of chat messages are sent to the chat completion
+    endpoint, and other prompts to the completion endpoint.
+    """
+    if isinstance(prompt, list):
+        url = "/v1/chat/completions"
+        body = {"model": model_name, "messages": prompt, **api_kwargs}
+    else:
+        url = "/v1/completions"
+        body = {"model": model_name, "prompt": prompt, **api_kwargs}
+    return {"custom_id": custom_id, "method": "POST", "url": url, "body": body}
+
+
+def write_batch_requests(
+    requests: Iterable[Dict[str, Any]],
+    path: Union[str, Path],
+    max_requests_per_file: int = 50_000,
+    max_bytes_per_file: int = 100 * 1024**2,
+) -> List[Path]:
+    """Write requests to JSONL files, starting a new file whenever a file would
+    exceed the size limits. Requests with a custom id which has already been
+    written are skipped.
+
+    Args:
+        requests: The requests to write.
+        path: The path of the request files. The files are named
+            {stem}-00000{suffix}, {stem}-00001{suffix} etc.
+        max_requests_per_file: Maximum number of requests in a file.
+        max_bytes_per_file: Maximum size of a file in bytes.
+
+    Returns:
+        The paths of the written files.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    paths: List[Path] = []
+    written_ids = set()
+    n_requests = n_bytes = 0
+    file = None
+    try:
+        for request in requests:
+            if request["custom_id"] in written_ids:
+                continue
+            written_ids.add(request["custom_id"])
+            line = (json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8")
+            if (
+                file is None
+                or n_requests >= max_requests_per_file
+                or n_bytes + len(line) > max_bytes_per_file
+            ):
+                if file is not None:
+                    file.close()
+                paths.append(
+                    path.with_name(f"{path.stem}-{len(paths):05d}{path.suffix}"),
+                )
+                file = paths[-1].open("wb")
+                n_requests = n_bytes = 0
+            file.write(line)
+            n_requests += 1
+            n_bytes += len(line)
+    finally:
+        if file is not None:
+            file.close()
+    return paths
+
+
+def read_batch_results(paths: Iterable[Union[str, Path]]) -> Dict[str, str]:
+    """Read the responses from JSONL result files of the OpenAI Batch API.
+
+    Returns:
+        The content of the response to each request by custom id. Failed
+            requests are left out.
+    """
+    responses = {}
+    n_failed = 0
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    n_failed += 1
+                    continue
+                choice = response["body"]["choices"][0]
+                if "message" in choice:
+                    responses[result["custom_id"]] = choice["message"]["content"]
+                else:
+                    responses[result["custom_id"]] = choice["text"]
+    if n_failed:
+        logging.warning("%d requests of the batch results failed.", n_failed)
+    return responses
+
+
+def execute_batch_requests(
+    request_paths: Iterable[Union[str, Path]],
+    results_path: Union[str, Path],
+    complete_fn: Callable[[List[Prompt]], List[str]],
+) -> Path:
+    """Execute batch request files locally and write the results file in the
+    format of the OpenAI Batch API. Stands in for the Batch API, e.g. in
+    tests.
+
+    Args:
+        request_paths: The request files written by `write_batch_requests`.
+        results_path: The path of the results file.
+        complete_fn: A function which returns the completions of a list of
+            prompts, i.e. of the prompts or chat messages of the requests.
+
+    Returns:
+        The path of the results file.
+    """
+    results_path = Path(results_path)
+    results_path.parent.mkdir(parents=True, exist_ok=True)
+    with results_path.open("w", encoding="utf-8") as results_file:
+        for request_path in request_paths:
+            with open(request_path, encoding="utf-8") as f:
+                requests = [json.loads(line) for line in f if line.strip()]
+            prompts = [
+                request["body"].get("messages", request["body"].get("prompt"))
+                for request in requests
+            ]
+            for request, completion in zip(requests, complete_fn(prompts)):
+                if "messages" in request["body"]:
+                    choice = {"message": {"role": "assistant", "content": completion}}
+                else:
+                    choice = {"text": completion}
+                result = {
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": {"choices": [choice]}},
+                    "error": None,
+                }
+                results_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+    return results_path
@@ -0,0 +1,83 @@
+"""A persistent cache of prompt responses."""
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Tuple, Union
+
+from conspiracies.common.sqlite_store import SQLiteStore
+
+
+def _sha256(data: str) -> str:
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class PromptResponseCache:
+    """A disk-backed cache of prompt responses stored in an SQLite database.
+
+    Responses are stored under a key derived from everything that
+    determines the response: the backend, the model name, the API
+    arguments, the rendered prompt and the target. Empty responses are
+    never cached, as they are typically caused by a failed request, and the
+    target should be prompted again on the next run.
+
+    Args:
+        path: Path to the SQLite database file. It is created if it does not exist.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._store = SQLiteStore(self.path, table="responses")
+
+    @staticmethod
+    def create_key(
+        backend: str,
+        model_name: str,
+        api_kwargs: Dict[Any, Any],
+        prompt: Union[str, List[Dict[str, str]]],
+        target: str,
+    ) -> str:
+        """Create the cache key of a request.
+
+        Args:
+            backend: The name of the prompt API in registry.prompt_apis.
+            model_name: The name of the model.
+            api_kwargs: The keyword arguments for the API.
+            prompt: The rendered prompt from `PromptTemplate.create_prompt`.
+            target: The target of the prompt.
+
+        Returns:
+            A hex digest identifying the request.
+        """
+        prompt_hash = _sha256(json.dumps(prompt, sort_keys=True, ensure_ascii=False))
+        key_data = {
+            "backend": backend,
+            "model_name": model_name,
+            "api_kwargs": api_kwargs,
+            "prompt": prompt_hash,
+            "target": target,
+        }
+        return _sha256(
+            json.dumps(key_data, sort_keys=True, ensure_ascii=False, default=str),
+        )
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, str]:
+        """Get the cached non-empty responses of the keys that are in the
+        cache."""
+        # caches written by earlier versions may contain empty responses
+        return {
+            key: response
+            for key, response in self._store.get_many(keys).items()
+            if response
+        }
+
+    def set_many(self, items: Iterable[Tuple[str, str]]) -> None:
+        """Store (key, response) pairs in the cache, skipping empty
+        responses."""
+        self._store.set_many((key, response) for key, response in items if response)
+
+    def close(self) -> None:
+        self._store.close()
+
+    def __len__(self) -> int:
+        return len(self._store)
@@ -1,24 +1,80 @@
 """A relation extraction component for spaCy using prompt-based relation
 extraction."""
 
-from typing import Any, Dict, Iterable, List, Optional
+import logging
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 from spacy.language import Language
-from spacy.tokens import Doc
+from spacy.tokens import Doc, Span
 from spacy.training.example import Example
+from spacy.util import minibatch
 
+from conspiracies.common.processes import spawn_pool
 from conspiracies.registry import registry
 from conspiracies.docprocessing.relationextraction.data_classes import (
     DocTriplets,
+    RelationArrays,
     SpanTriplet,
     install_extensions,
+    relation_arrays,
+    score_relation_arrays,
 )
-from .prompt_apis import create_openai_chatgpt_prompt_api  # noqa: F401
+from .prompt_apis import (
+    create_openai_chatgpt_prompt_api,  # noqa: F401
+    get_max_prompt_tokens,
+)
+from .prompt_batch import (
+    create_batch_request,
+    create_custom_id,
+    read_batch_results,
+    write_batch_requests,
+)
+from .prompt_templates import count_tokens
+
+
+def group_by_token_budget(token_counts: List[int], budget: int) -> List[List[int]]:
+    """Greedily group consecutive items such that the token count of each
+    group is within the budget. Items exceeding the budget get a group of
+    their own.
+
+    Args:
+        token_counts: The token count of each item.
+        budget: The maximum token count of a group.
+
+    Returns:
+        The indices of the items in each group.
+    """
+    groups: List[List[int]] = []
+    group_tokens = 0
+    for i, n_tokens in enumerate(token_counts):
+        if groups and group_tokens + n_tokens <= budget:
+            groups[-1].append(i)
+            group_tokens += n_tokens
+        else:
+            groups.append([i])
+            group_tokens = n_tokens
+    return groups
+
+
+def _score_relation_arrays(arrays: Tuple[RelationArrays, RelationArrays]):
+    return score_relation_arrays(*arrays)
+
 
+def score_open_relations(
+    examples: Iterable[Example],
+    n_process: int = 1,
+    chunksize: int = 64,
+) -> Dict[str, Any]:
+    """Score the predicted relations against the gold relations.
 
-def score_open_relations(examples: Iterable[Example]) -> Dict[str, Any]:
-    """Score the predicted relations against the gold relations."""
+    Args:
+        examples: The examples to score.
+        n_process: The number of processes to score the examples in. The relations
+            are converted to arrays before they are sent to the processes.
+        chunksize: The number of examples sent to a process at a time.
+    """
     keys = [
         "exact_span_match",
         "exact_string_match",
@@ -28,15 +84,23 @@ def score_open_relations(examples: Iterable[Example]) -> Dict[str, Any]:
     hits = {key: 0 for key in keys}
     n_pred = 0
     n_ref = 0
-    sample_scores = []
 
-    for example in examples:
-        gold_doc_triplets = example.reference._.relation_triplets
-        pred_doc_triplets = example.predicted._.relation_triplets
-
-        _score = pred_doc_triplets.score_relations(gold_doc_triplets)
-        sample_scores.append(_score)
+    arrays = [
+        relation_arrays(
+            list(example.reference._.relation_triplets),
+            list(example.predicted._.relation_triplets),
+        )
+        for example in examples
+    ]
+    if n_process > 1:
+        with spawn_pool(n_process) as executor:
+            sample_scores = list(
+                executor.map(_score_relation_arrays, arrays, chunksize=chunksize),
+            )
+    else:
+        sample_scores = [_score_relation_arrays(a) for a in arrays]
 
+    for _score in sample_scores:
         hits["exact_span_match"] += _score["exact_span_match"]
         hits["exact_string_match"] += _score["exact_string_match"]
         hits["normalized_span_overlap"] += _score["normalized_span_overlap"]
@@ -90,28 +154,37 @@ class PromptRelationExtractionComponent:
         api_kwargs: Dict[Any, Any],
         split_doc_fn: Optional[str],
         force: bool,
+        backend_kwargs: Optional[Dict[str, Any]] = None,
+        packing_token_budget: Optional[int] = None,
+        max_prompt_tokens: Optional[int] = None,
     ):
         """Initialise components."""
         self.name = name
         self.nlp = nlp
         p_template = registry.get("prompt_templates", prompt_template)
 
+        if max_prompt_tokens is None:
+            max_prompt_tokens = get_max_prompt_tokens(model_name, api_kwargs)
         self.prompt_template = p_template(
             task_description=task_description,
             examples=examples,
+            max_prompt_tokens=max_prompt_tokens,
         )
 
         # create prompt function using the desired API
+        self.backend_kwargs = backend_kwargs or {}
         self.prompt_fn = registry.get("prompt_apis", backend)(
             self.prompt_template,
             api_key,
             model_name,
             api_kwargs,
+            **self.backend_kwargs,
         )
         self.model_name = model_name
         self.backend = backend
         self.api_key = api_key
         self.api_kwargs = api_kwargs
+        self.packing_token_budget = packing_token_budget
         if split_doc_fn is not None:
             self.split_doc_fn = registry.get("split_doc_functions", split_doc_fn)()
         else:
@@ -166,16 +239,170 @@ class PromptRelationExtractionComponent:
         """
         return score_open_relations(examples)
 
+    def split_doc(self, doc: Doc) -> List[Span]:
+        """Split the doc into the targets to prompt for, e.g. tweets."""
+        if self.split_doc_fn is not None:
+            return self.split_doc_fn(doc)
+        return [doc[:]]
+
+    def prompt(self, targets: List[str]) -> List[str]:
+        """Get the prompt responses for the targets.
+
+        If packing_token_budget is set and the prompt template supports
+        packing, consecutive targets are packed into a single prompt as long
+        as their combined token count is within the budget, and the response
+        is split into the responses for each target. Targets without an answer
+        in the response of their packed prompt, or whose answer yields no
+        triplets, are prompted for individually.
+        """
+        if (
+            self.packing_token_budget is None
+            or not self.prompt_template.supports_packing
+        ):
+            return self.prompt_fn(targets)
+
+        groups = group_by_token_budget(
+            [count_tokens(target) for target in targets],
+            self.packing_token_budget,
+        )
+        packed_targets = [
+            (
+                targets[group[0]]
+                if len(group) == 1
+                else self.prompt_template.pack_targets([targets[i] for i in group])
+            )
+            for group in groups
+        ]
+        responses: List[Optional[str]] = [None] * len(targets)
+        for group, response in zip(groups, self.prompt_fn(packed_targets)):
+            if len(group) == 1:
+                responses[group[0]] = response
+                continue
+            unpacked = self.prompt_template.unpack_parsed_response(
+                response,
+                [targets[i] for i in group],
+            )
+            for i, target_response in zip(group, unpacked):
+                responses[i] = target_response
+
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if missing:
+            logging.info(
+                "%d of %d packed targets were not answered with any triplets and "
+                "are prompted for individually.",
+                len(missing),
+                len(targets),
+            )
+            missing_responses = self.prompt_fn([targets[i] for i in missing])
+            for i, response in zip(missing, missing_responses):
+                responses[i] = response
+        return responses  # type: ignore
+
+    def pipe(self, stream: Iterable[Doc], batch_size: int = 128) -> Iterator[Doc]:
+        """Run the pipeline component on a stream of docs.
+
+        The targets of all docs in a batch are passed to the prompt API in a
+        single call, such that backends which send requests concurrently, e.g.
+        "conspiracies/openai_chatgpt_async_api", can keep many requests in
+        flight.
+
+        Args:
+            stream (Iterable[Doc]): A stream of docs.
+            batch_size (int): The number of docs to prompt for at a time.
+
+        Yields:
+            Doc: The docs with relation triplets set.
+        """
+        for docs in minibatch(stream, size=batch_size):
+            doc_spans = [self.split_doc(doc) for doc in docs]
+            responses = self.prompt(
+                [span.text for spans in doc_spans for span in spans],
+            )
+            i = 0
+            for doc, spans in zip(docs, doc_spans):
+                yield self.set_annotation(doc, spans, responses[i : i + len(spans)])
+                i += len(spans)
+
+    def write_batch_requests(
+        self,
+        docs: Iterable[Doc],
+        path: Union[str, Path],
+        max_requests_per_file: int = 50_000,
+        max_bytes_per_file: int = 100 * 1024**2,
+    ) -> List[Path]:
+        """Write the prompts for the docs to JSONL request files for the
+        OpenAI Batch API. This is the first phase of running the component
+        as an offline batch job, see `read_batch_results` for the second.
+
+        Each target gets a request with a custom id derived from the target,
+        so the ids are stable between runs and identical targets are only
+        requested once.
+
+        Args:
+            docs (Iterable[Doc]): The docs to prompt for.
+            path (Union[str, Path]): The path of the request files. The requests are
+                sharded into files named {stem}-00000{suffix}, {stem}-00001{suffix}
+                etc.
+            max_requests_per_file (int): Maximum number of requests in a file.
+            max_bytes_per_file (int): Maximum size of a file in bytes.
+
+        Returns:
+            List[Path]: The paths of the request files.
+        """
+        requests = (
+            create_batch_request(
+                create_custom_id(span.text),
+                self.prompt_template.create_prompt(span.text),
+                self.model_name,
+                self.api_kwargs,
+            )
+            for doc in docs
+            for span in self.split_doc(doc)
+        )
+        return write_batch_requests(
+            requests,
+            path,
+            max_requests_per_file=max_requests_per_file,
+            max_bytes_per_file=max_bytes_per_file,
+        )
+
+    def read_batch_results(
+        self,
+        docs: Iterable[Doc],
+        results_paths: Iterable[Union[str, Path]],
+    ) -> Iterator[Doc]:
+        """Set the relation triplets of the docs from the JSONL result files
+        of a batch job for the requests written by `write_batch_requests`.
+        Targets without a result get no triplets.
+
+        Args:
+            docs (Iterable[Doc]): The docs the requests were written for.
+            results_paths (Iterable[Union[str, Path]]): The result files.
+
+        Yields:
+            Doc: The docs with relation triplets set.
+        """
+        responses = read_batch_results(results_paths)
+        n_missing = 0
+        for doc in docs:
+            doc_spans = self.split_doc(doc)
+            ids = [create_custom_id(span.text) for span in doc_spans]
+            n_missing += sum(custom_id not in responses for custom_id in ids)
+            yield self.set_annotation(
+                doc,
+                doc_spans,
+                [responses.get(custom_id, "") for custom_id in ids],
+            )
+        if n_missing:
+            logging.warning("%d targets have no batch result.", n_missing)
+
     def __call__(self, doc: Doc):
         """Run the pipeline component."""
         # split into tweets
-        if self.split_doc_fn is not None:
-            doc_spans = self.split_doc_fn(doc)
-        else:
-            doc_spans = [doc]
+        doc_spans = self.split_doc(doc)
 
         # prompt
-        responses = self.prompt_fn([span.text for span in doc_spans])
+        responses = self.prompt([span.text for span in doc_spans])
         doc = self.set_annotation(doc, doc_spans, responses)
         return doc
 
@@ -189,6 +416,9 @@ class PromptRelationExtractionComponent:
         "model_name": "text-davinci-002",
         "backend": "conspiracies/openai_gpt3_api",
         "split_doc_fn": None,
+        "backend_kwargs": {},
+        "packing_token_budget": None,
+        "max_prompt_tokens": None,
         "api_kwargs": {
             "max_tokens": 500,
             "temperature": 0.7,
@@ -211,6 +441,9 @@ def create_prompt_relation_extraction_component(
     api_kwargs: Dict[Any, Any],
     split_doc_fn: Optional[str],
     force: bool,
+    backend_kwargs: Dict[str, Any],
+    packing_token_budget: Optional[int],
+    max_prompt_tokens: Optional[int],
 ) -> PromptRelationExtractionComponent:
     """Allows PromptRelationExtractionComponent to be added to a spaCy pipe
     using nlp.add_pipe("conspiracies/prompt_relation_extraction").
@@ -230,6 +463,18 @@ def create_prompt_relation_extraction_component(
             "text-davinci-002".
         backend (Literal["openai", "huggingface"]): The backend to use for the prompt.
         force (bool): Whether to force the extension to be added to the Doc.
+        backend_kwargs (Dict[str, Any]): Extra keyword arguments for creating the
+            backend, e.g. {"max_concurrency": 16, "requests_per_minute": 3000} for
+            "conspiracies/openai_chatgpt_async_api".
+        packing_token_budget (Optional[int]): If set, several targets are packed
+            into one prompt as long as their combined token count is within the
+            budget, which saves resending the examples for every target. Only used
+            with templates supporting packing, e.g. "conspiracies/xml_style_template"
+            and "conspiracies/chatgpt_style_template". Defaults to None.
+        max_prompt_tokens (Optional[int]): The maximum number of tokens of a prompt.
+            Each prompt includes the largest number of examples which fit within
+            it. Defaults to None, in which case it is the context window of the
+            model minus the max_tokens of the completion, if the model is known.
 
     Returns:
         PromptRelationExtractionComponent: A spaCy component for prompt-based relation
@@ -260,4 +505,7 @@ def create_prompt_relation_extraction_component(
         api_kwargs=api_kwargs,
         split_doc_fn=split_doc_fn,
         force=force,
+        backend_kwargs=backend_kwargs,
+        packing_token_budget=packing_token_budget,
+        max_prompt_tokens=max_prompt_tokens,
     )
@@ -1,8 +1,11 @@
 """PromptTemplate abstract class along with the instances of the class."""
 
+import logging
+import math
 import re
 from abc import abstractmethod
 from collections import defaultdict
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 from confection import registry
@@ -14,6 +17,43 @@ from conspiracies.docprocessing.relationextraction.data_classes import (
 )
 
 
+@lru_cache(maxsize=None)
+def _get_tiktoken_encoding():
+    try:
+        import tiktoken
+    except ImportError:
+        logging.warning(
+            "tiktoken is not installed, so the number of tokens of prompts is "
+            "overestimated from their length. You can install it using "
+            "`pip install conspiracies[openai]`.",
+        )
+        return None
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(prompt: Union[str, List[Dict[str, str]]]) -> int:
+    """Count the number of tokens in a prompt.
+
+    Uses the cl100k_base encoding of tiktoken if it is installed, and
+    otherwise conservatively estimates two characters per token plus
+    one, as non-English text, emojis and handles often take more than
+    the four characters per token of English text. For a list of chat
+    messages the contents are counted along with a few tokens of
+    overhead per message.
+    """
+    if isinstance(prompt, list):
+        return sum(count_tokens(message["content"]) + 4 for message in prompt)
+    encoding = _get_tiktoken_encoding()
+    if encoding is None:
+        return math.ceil(len(prompt) / 2) + 1
+    return len(encoding.encode(prompt))
+
+
+# stands in for the target when rendering prompts which are cached
+_PLACEHOLDER = "\x00target\x00"
+_PACKED_PLACEHOLDER = "<tweet-1>" + _PLACEHOLDER
+
+
 class PromptTemplate:
     """Abstract class for template classes.
 
@@ -22,18 +62,25 @@ class PromptTemplate:
     such as GPT-3 and chatGPT.
     """
 
+    # whether create_prompt handles targets packed using pack_targets
+    supports_packing = False
+
     def __init__(
         self,
         examples: List[Doc],
         task_description: Optional[str] = None,
+        max_prompt_tokens: Optional[int] = None,
     ):
         """
         Args:
             examples: A tuple of a spacy Docs
             task_description: A description of the task
+            max_prompt_tokens: The maximum number of tokens of a prompt. If set,
+                each prompt only includes as many examples as fit within it.
         """
 
         self.examples = examples
+        self.max_prompt_tokens = max_prompt_tokens
         if task_description:
             self.task_description = task_description
         else:
@@ -41,12 +88,101 @@ class PromptTemplate:
 (Subject - predicate - object) from the following tweet. \
 First, you will see a few examples."
 
+    @property
+    def examples(self) -> List[Doc]:
+        return self._examples
+
+    @examples.setter
+    def examples(self, examples: List[Doc]):
+        self._examples = examples
+        self._rendered_prompts: Dict[Tuple[str, Tuple[int, ...], bool], Any] = {}
+        self._example_tokens: Optional[List[int]] = None
+
     @abstractmethod
-    def create_prompt(self, target: str) -> Union[str, List[Dict[str, str]]]:
-        """Create a prompt based on the task description and examples and
-        target."""
+    def render_prompt(
+        self,
+        target: str,
+        examples: List[Doc],
+    ) -> Union[str, List[Dict[str, str]]]:
+        """Render a prompt based on the task description, the given examples
+        and the target."""
         pass
 
+    def _render_cached(
+        self,
+        example_idxs: Tuple[int, ...],
+        placeholder: str = _PLACEHOLDER,
+    ) -> Union[str, List[Dict[str, str]]]:
+        key = (self.task_description, example_idxs, placeholder == _PACKED_PLACEHOLDER)
+        if key not in self._rendered_prompts:
+            self._rendered_prompts[key] = self.render_prompt(
+                placeholder,
+                [self.examples[i] for i in example_idxs],
+            )
+        return self._rendered_prompts[key]
+
+    def _insert_target(
+        self,
+        example_idxs: Tuple[int, ...],
+        target: str,
+    ) -> Union[str, List[Dict[str, str]]]:
+        placeholder = _PACKED_PLACEHOLDER if self.is_packed(target) else _PLACEHOLDER
+        prompt = self._render_cached(example_idxs, placeholder)
+        if isinstance(prompt, str):
+            return prompt.replace(placeholder, target, 1)
+        return [
+            {**message, "content": message["content"].replace(placeholder, target, 1)}
+            for message in prompt
+        ]
+
+    def create_prompt(self, target: str = "") -> Union[str, List[Dict[str, str]]]:
+        """Create a prompt based on the task description and examples and
+        target.
+
+        Only the examples selected by `select_examples` are included. The
+        rendering of the prompt without the target is cached for each
+        selection of examples.
+        """
+        return self._insert_target(self.select_examples(target), target)
+
+    @property
+    def example_tokens(self) -> List[int]:
+        """The number of tokens each example adds to a prompt."""
+        if self._example_tokens is None:
+            n_base_tokens = count_tokens(self._render_cached(()))
+            self._example_tokens = [
+                count_tokens(self._render_cached((i,))) - n_base_tokens
+                for i in range(len(self.examples or []))
+            ]
+        return self._example_tokens
+
+    def select_examples(self, target: str) -> Tuple[int, ...]:
+        """Select the examples to include in the prompt for a target.
+
+        If max_prompt_tokens is set, the largest number of examples for
+        which the prompt fits within max_prompt_tokens is selected,
+        preferring shorter examples. Otherwise all examples are
+        selected.
+
+        Returns:
+            The indices of the selected examples in their original order.
+        """
+        n_examples = len(self.examples or [])
+        if self.max_prompt_tokens is None:
+            return tuple(range(n_examples))
+
+        n_available = self.max_prompt_tokens - count_tokens(
+            self._insert_target((), target),
+        )
+        example_tokens = self.example_tokens
+        selected = []
+        for i in sorted(range(n_examples), key=lambda i: example_tokens[i]):
+            if example_tokens[i] > n_available:
+                break
+            n_available -= example_tokens[i]
+            selected.append(i)
+        return tuple(sorted(selected))
+
     @abstractmethod
     def parse_prompt(self, prompt: str, target_tweet: str) -> List[StringTriplet]:
         """Parse a prompt into a target tweet and triplets."""
@@ -56,6 +192,74 @@ First, you will see a few examples."
         """Updates examples."""
         self.examples = examples
 
+    @staticmethod
+    def pack_targets(targets: List[str]) -> str:
+        """Pack several targets into a single target with each target enclosed
+        in numbered tags, i.e. <tweet-1>{target 1}</tweet-1> <tweet-2>...
+
+        Templates supporting packing ask for the answer to each target
+        to be enclosed in the same tags, such that the response can be
+        split using `unpack_response`.
+        """
+        return "\n".join(
+            f"<tweet-{n}>{target}</tweet-{n}>" for n, target in enumerate(targets, 1)
+        )
+
+    @staticmethod
+    def is_packed(target: str) -> bool:
+        """Whether the target was created by `pack_targets`."""
+        return target.startswith("<tweet-1>")
+
+    @staticmethod
+    def unpack_response(response: str, n_targets: int) -> List[Optional[str]]:
+        """Split the response to a packed prompt into the responses for each
+        target.
+
+        Args:
+            response: The response to the prompt of the packed targets.
+            n_targets: The number of packed targets.
+
+        Returns:
+            The response for each target, or None for targets without an answer
+                enclosed in their tags.
+        """
+        segments: Dict[int, str] = {}
+        for match in re.finditer(r"<tweet-(\d+)>(.*?)</tweet-\1>", response, re.DOTALL):
+            n = int(match.group(1))
+            if 1 <= n <= n_targets and n not in segments:
+                segments[n] = match.group(2).strip("\n")
+        return [segments.get(n) for n in range(1, n_targets + 1)]
+
+    def unpack_parsed_response(
+        self,
+        response: str,
+        targets: List[str],
+    ) -> List[Optional[str]]:
+        """Split the response to a packed prompt into the responses for each
+        target, keeping only the responses from which `parse_prompt` extracts
+        triplets.
+
+        Args:
+            response: The response to the prompt of the packed targets.
+            targets: The packed targets.
+
+        Returns:
+            The response for each target, or None for targets without an answer
+                enclosed in their tags or whose answer yields no triplets, e.g.
+                as it is malformed.
+        """
+        return [
+            (
+                segment
+                if segment is not None and self.parse_prompt(segment, target)
+                else None
+            )
+            for segment, target in zip(
+                self.unpack_response(response, len(targets)),
+                targets,
+            )
+        ]
+
 
 @registry.prompt_templates("conspiracies/template_1")
 class PromptTemplate1(PromptTemplate):
@@ -63,17 +267,23 @@ class PromptTemplate1(PromptTemplate):
         self,
         examples: List[Doc],
         task_description: Optional[str] = None,
+        max_prompt_tokens: Optional[int] = None,
     ):
-        super().__init__(task_description=task_description, examples=examples)
+        super().__init__(
+            task_description=task_description,
+            examples=examples,
+            max_prompt_tokens=max_prompt_tokens,
+        )
         if not task_description:
             self.task_description = """Extract semantic triplets from the following tweet. 
 The semantic triplets should be on the form (Subject - Verb Phrase - Object), where the verb phrase includes all particles and modifyers. 
 There should always be exactly three elements in a triplet, no more no less. 
 They should be presented with each element in parentheses as shown below:"""  # noqa: E501
 
-    def create_prompt(
+    def render_prompt(
         self,
-        target: str = "",
+        target: str,
+        examples: List[Doc],
     ) -> str:
         """Create a prompt template on the form
 
@@ -93,7 +303,7 @@ They should be presented with each element in parentheses as shown below:"""  #
             target: The tweet to be annotated.
         """
         examples_str = "---\n\n"
-        for tweet in self.examples:
+        for tweet in examples:
             triplets = tweet._.relation_triplets
             examples_str += f"Tweet: {tweet.text}\n"
 
@@ -113,8 +323,7 @@ They should be presented with each element in parentheses as shown below:"""  #
                         examples_str += f"\t{triplet_str}\n"
 
             examples_str += "---\n"
-            tweet_string = f"{self.task_description}\n\n{examples_str}\nTweet: "
-            prompt = tweet_string
+        prompt = f"{self.task_description}\n\n{examples_str}\nTweet: "
 
         return prompt + f"{target}\nTriplets:"
 
@@ -158,17 +367,23 @@ class PromptTemplate2(PromptTemplate):
         self,
         examples: List[Doc],
         task_description: Optional[str] = None,
+        max_prompt_tokens: Optional[int] = None,
     ):
-        super().__init__(task_description=task_description, examples=examples)
+        super().__init__(
+            task_description=task_description,
+            examples=examples,
+            max_prompt_tokens=max_prompt_tokens,
+        )
         if not task_description:
             self.task_description = """Extract semantic triplets from the following tweet. 
 The semantic triplets should be on the form (Subject - Verb Phrase - Object), where the verb phrase includes all particles and modifyers. 
 There should always be exactly three elements in a triplet, no more no less. 
 They should be presented with each element in parentheses as shown below:"""  # noqa: E501
 
-    def create_prompt(
+    def render_prompt(
         self,
-        target: str = "",
+        target: str,
+        examples: List[Doc],
     ) -> str:
         """Create a prompt template on the form '''.
 
@@ -187,7 +402,7 @@ They should be presented with each element in parentheses as shown below:"""  #
         '''
         """
         tweets_block = "---\n\n"
-        tweets = self.examples
+        tweets = examples
         tweet_triplets = [tweet._.relation_triplets for tweet in tweets]
         for tweet in tweets:
             tweets_block += f"Tweet: {tweet.text}\n\n"
@@ -253,17 +468,23 @@ class MarkdownPromptTemplate1(PromptTemplate):
         self,
         examples: List[Doc],
         task_description: Optional[str] = None,
+        max_prompt_tokens: Optional[int] = None,
     ):
-        super().__init__(task_description=task_description, examples=examples)
+        super().__init__(
+            task_description=task_description,
+            examples=examples,
+            max_prompt_tokens=max_prompt_tokens,
+        )
         if not task_description:
             self.task_description = """Extract semantic triplets from the following tweet. 
 The semantic triplets should be on the form (Subject - Verb Phrase - Object), where the verb phrase includes all particles and modifyers. 
 There should always be exactly three elements in a triplet, no more no less. 
 They should be put in a markdown table as shown below:"""  # noqa: E501
 
-    def create_prompt(
+    def render_prompt(
         self,
-        target: str = "",
+        target: str,
+        examples: List[Doc],
     ) -> str:
         """Create a prompt template on the form
 
@@ -281,7 +502,7 @@ They should be put in a markdown table as shown below:"""  # noqa: E501
         ```
         """
         tweet_string = f"{self.task_description}\n| Tweet | Subject | Predicate | Object |\n| --- | --- | --- | --- |"  # noqa: E501
-        for example in self.examples:
+        for example in examples:
             triplets = example._.relation_triplets
             if len(triplets) == 0:
                 tweet_string += f"\n| {example} | | | |"
@@ -342,17 +563,23 @@ class MarkdownPromptTemplate2(PromptTemplate):
         self,
         examples: List[Doc],
         task_description: Optional[str] = None,
+        max_prompt_tokens: Optional[int] = None,
     ):
-        super().__init__(task_description=task_description, examples=examples)
+        super().__init__(
+            task_description=task_description,
+            examples=examples,
+            max_prompt_tokens=max_prompt_tokens,
+        )
         if not task_description:
             self.task_description = """Extract semantic triplets from the following tweet. 
 The semantic triplets should be on the form (Subject - Verb Phrase - Object), where the verb phrase includes all particles and modifyers. 
 There should always be exactly three elements in a triplet, no more no less. 
 They should be put in a markdown table as shown below:"""  # noqa: E501
 
-    def create_prompt(
+    def render_prompt(
         self,
-        target: str = "",
+        target: str,
+        examples: List[Doc],
     ) -> str:
         """Create a prompt template on the form.
 
@@ -383,7 +610,7 @@ They should be put in a markdown table as shown below:"""  # noqa: E501
         header = "| Subject | Predicate | Object |\n| --- | --- | --- |"
 
         tweet_string = f"{self.task_description}\n\n"
-        for example in self.examples:
+        for example in examples:
             triplets = example._.relation_triplets
             tweet_string += example.text + "\n\n" + header
             if len(triplets) == 0:
@@ -440,13 +667,20 @@ They should be put in a markdown table as shown below:"""  # noqa: E501
 
 @registry.prompt_templates("conspiracies/xml_style_template")
 class XMLStylePromptTemplate(PromptTemplate):
+    supports_packing = True
+
     def __init__(
         self,
         examples: List[Doc],
         task_description: Optional[str] = None,
         tags: List[str] = ["subject", "predicate", "object"],
+        max_prompt_tokens: Optional[int] = None,
     ):
-        super().__init__(task_description=task_description, examples=examples)
+        super().__init__(
+            task_description=task_description,
+            examples=examples,
+            max_prompt_tokens=max_prompt_tokens,
+        )
         self.tags = tags
         if not task_description:
             self.task_description = """Tag the following tweet with triplets using HTML tags.
@@ -490,9 +724,10 @@ The triplets should be tagged in the tweet as shown below:"""  # noqa: E501
             result_string += d.text_with_ws
         return result_string
 
-    def create_prompt(
+    def render_prompt(
         self,
-        target: str = "",
+        target: str,
+        examples: List[Doc],
     ) -> str:
         """Create a prompt template on the form.
 
@@ -508,12 +743,22 @@ The triplets should be tagged in the tweet as shown below:"""  # noqa: E501
         {xml_tagged tweet n}
 
         {target tweet}
+        ```
+
+        If the target is packed using `pack_targets`, the model is asked to
+        tag each of the tweets and keep the numbered tweet tags around them.
         """
         prompt = f"{self.task_description}\n\n"
-        for doc in self.examples:
+        for doc in examples:
             triplets = doc._.relation_triplets
             prompt += doc.text + "\n" + self.create_xml_example(doc, triplets) + "\n\n"
 
+        if self.is_packed(target):
+            prompt += (
+                "Tag each of the following tweets in the same way. The tweets are "
+                "enclosed in numbered <tweet-n> tags, which should be kept around "
+                "each tagged tweet.\n\n"
+            )
         return prompt + target + "\n"
 
     @staticmethod
@@ -659,19 +904,26 @@ The triplets should be tagged in the tweet as shown below:"""  # noqa: E501
 
 @registry.prompt_templates("conspiracies/chatgpt_style_template")
 class chatGPTPromptTemplate(PromptTemplate):
+    supports_packing = True
+
     def __init__(
         self,
         examples: List[Doc],
         task_description: Optional[str] = None,
+        max_prompt_tokens: Optional[int] = None,
     ):
-        super().__init__(task_description=task_description, examples=examples)
+        super().__init__(
+            task_description=task_description,
+            examples=examples,
+            max_prompt_tokens=max_prompt_tokens,
+        )
         if not task_description:
             self.task_description = """I need you to extract semantic triplets from tweets. 
 The semantic triplets should be on the form (Subject - Verb Phrase - Object), where the verb phrase includes all particles and modifyers. 
 There should always be exactly three elements in a triplet, no more no less, and they should be presented in a markdown table.
 First, I will provide you with a few examples."""  # noqa: E501
 
-    def create_prompt(self, target: str) -> List[Dict[str, str]]:
+    def render_prompt(self, target: str, examples: List[Doc]) -> List[Dict[str, str]]:
         """Create a prompt for the chatGPT model. Form is:
         [
         {"role": "system",
@@ -705,6 +957,9 @@ First, I will provide you with a few examples."""  # noqa: E501
          "content": 'All right, now you try. The tweet is:\n{target}\nWhat are the triplets?'
         },
         ]
+
+        If the target is packed using `pack_targets`, the last message asks for
+        the triplets of each tweet enclosed in the numbered tweet tags.
         """  # noqa: E501
         message_dicts = [
             {
@@ -730,7 +985,7 @@ who is also an expert linguist. ",
 Let me try the first example!",
             },
         ]
-        for i, example in enumerate(self.examples):
+        for i, example in enumerate(examples):
             triplets = example._.relation_triplets
             if i == 0:
                 message_dicts.append(
@@ -757,10 +1012,18 @@ Let me try the first example!",
                     "content": message_string,
                 },
             )
+        if self.is_packed(target):
+            content = (
+                f"The tweets are:\n{target}\nExtract the triplets of each tweet in "
+                "the same way, and write them between the numbered <tweet-n> tags "
+                "of the tweet.\n"
+            )
+        else:
+            content = f"The tweet is:\n{target}\n"
         message_dicts.append(
             {
                 "role": "user",
-                "content": f"The tweet is:\n{target}\n",
+                "content": content,
             },
         )
         return message_dicts
@@ -0,0 +1,124 @@
+"""Helpers for sending many prompt requests concurrently while respecting the
+rate limits of an API."""
+
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, List, Optional, Tuple, Type
+
+
+class TokenBucket:
+    """An asyncio token bucket rate limiter.
+
+    Tokens are refilled continuously at `rate` tokens per second up to
+    `capacity`. Acquiring a token when the bucket is empty reserves a
+    future token and sleeps until it is available, so waiting callers
+    are served in the order they arrived.
+
+    Args:
+        rate: Number of tokens refilled per second.
+        capacity: Maximum number of tokens in the bucket, i.e. the largest burst
+            allowed. Defaults to max(1, rate).
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError(f"rate must be positive, got {rate}")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+
+    @classmethod
+    def from_requests_per_minute(cls, requests_per_minute: float) -> "TokenBucket":
+        return cls(rate=requests_per_minute / 60)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity,
+            self._tokens + (now - self._last_refill) * self.rate,
+        )
+        self._last_refill = now
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        """Wait until `tokens` tokens are available and consume them."""
+        # no awaits between refilling and reserving, so no lock is needed
+        self._refill()
+        self._tokens -= tokens
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+def backoff_delay(
+    attempt: int,
+    base_delay: float = 1.0,
+    max_delay: float = 60.0,
+) -> float:
+    """Exponential backoff with full jitter.
+
+    Args:
+        attempt: The number of the failed attempt, starting from 0.
+        base_delay: The delay ceiling after the first failed attempt in seconds.
+        max_delay: The maximum delay ceiling in seconds.
+
+    Returns:
+        A delay drawn uniformly between 0 and min(max_delay, base_delay * 2^attempt).
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+async def send_concurrently(
+    targets: List[str],
+    send_request: Callable[[str], Awaitable[str]],
+    max_concurrency: int = 8,
+    rate_limiter: Optional[TokenBucket] = None,
+    retry_on: Tuple[Type[Exception], ...] = (),
+    max_retries: int = 6,
+    base_delay: float = 1.0,
+    max_delay: float = 60.0,
+) -> List[str]:
+    """Send a request for each target with a bounded number of requests in
+    flight and return the responses in the order of the targets.
+
+    Args:
+        targets: The targets to send requests for.
+        send_request: A coroutine function sending the request for a single target
+            and returning the response.
+        max_concurrency: Maximum number of requests in flight at any time.
+        rate_limiter: An optional token bucket that every request (including
+            retries) must acquire a token from before being sent.
+        retry_on: Exception types after which a request is retried.
+        max_retries: Maximum number of retries per target before the exception is
+            raised.
+        base_delay: Base delay for the exponential backoff between retries.
+        max_delay: Maximum delay between retries.
+
+    Returns:
+        The responses in the order of the targets.
+    """
+
+    async def send_with_retries(target: str, semaphore: asyncio.Semaphore) -> str:
+        async with semaphore:
+            for attempt in range(max_retries + 1):
+                if rate_limiter is not None:
+                    await rate_limiter.acquire()
+                try:
+                    return await send_request(target)
+                except retry_on as e:
+                    if attempt == max_retries:
+                        raise
+                    delay = backoff_delay(attempt, base_delay, max_delay)
+                    logging.warning(
+                        "Request failed with %s, retrying in %.1f seconds.",
+                        repr(e),
+                        delay,
+                    )
+                    await asyncio.sleep(delay)
+        raise AssertionError("unreachable")
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    return await asyncio.gather(
+        *(send_with_retries(target, semaphore) for target in targets),
+    )
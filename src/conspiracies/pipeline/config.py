@@ -48,6 +48,11 @@ class CorpusProcessingConfig(StepConfig):
     n_neighbors: int = 15
     embedding_model: str = None
     thresholds: ClusteringThresholds = None
+    incremental: bool = False
+    n_jobs: int = None
+    max_sample_size: int = None
+    blocking: bool = False
+    max_docs: int = None
 
 
 class PipelineConfig(BaseModel):
@@ -7,6 +7,7 @@ from conspiracies.common.fileutils import iter_lines_of_files
 from conspiracies.corpusprocessing.aggregation import TripletAggregator
 from conspiracies.corpusprocessing.clustering import Clustering
 from conspiracies.corpusprocessing.triplet import Triplet
+from conspiracies.corpusprocessing.triplet_table import TripletTable
 from conspiracies.docprocessing.docprocessor import DocProcessor
 from conspiracies.document import Document
 from conspiracies.pipeline.config import PipelineConfig, ClusteringThresholds
@@ -99,9 +100,14 @@ class Pipeline:
     def corpusprocessing(self):
         # TODO: make into logging messages or progress bars instead
         print("Collecting triplets.")
-        triplets = Triplet.from_annotated_docs(self.output_path / "annotations.ndjson")
-        triplets = Triplet.filter_on_stopwords(triplets, self.config.base.language)
-        Triplet.write_jsonl(self.output_path / "triplets.ndjson", triplets)
+        triplets = TripletTable.from_annotated_docs(
+            self.output_path / "annotations.ndjson",
+        )
+        triplets = triplets.filter_on_stopwords(self.config.base.language)
+        Triplet.write_jsonl(
+            self.output_path / "triplets.ndjson",
+            triplets.iter_triplets(),
+        )
 
         if self.config.corpusprocessing.thresholds is None:
             thresholds = ClusteringThresholds.estimate_from_n_triplets(len(triplets))
@@ -114,13 +120,27 @@ class Pipeline:
             n_neighbors=self.config.corpusprocessing.n_neighbors,
             min_cluster_size=thresholds.min_cluster_size,
             min_samples=thresholds.min_samples,
+            cache_dir=self.output_path / "cache",
+            n_jobs=self.config.corpusprocessing.n_jobs,
+            max_sample_size=self.config.corpusprocessing.max_sample_size,
+            blocking=self.config.corpusprocessing.blocking,
+        )
+        mappings = clustering.create_mappings(
+            triplets,
+            state_dir=(
+                self.output_path / "incremental"
+                if self.config.corpusprocessing.incremental
+                else None
+            ),
         )
-        mappings = clustering.create_mappings(triplets)
         with open(self.output_path / "mappings.json", "w") as out:
             out.write(mappings.json())
 
         print("Aggregating triplets, entities and predicates and outputting stats.")
-        aggregator = TripletAggregator(mappings=mappings)
+        aggregator = TripletAggregator(
+            mappings=mappings,
+            max_docs=self.config.corpusprocessing.max_docs,
+        )
         triplet_stats = aggregator.aggregate(triplets)
         with open(self.output_path / "triplet_stats.json", "w") as out:
             json.dump(triplet_stats.entries(), out)
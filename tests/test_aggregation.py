@@ -0,0 +1,155 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from conspiracies.corpusprocessing.aggregation import (
+    PartialTripletStats,
+    StatsDict,
+    TripletAggregator,
+    TripletStats,
+)
+from conspiracies.corpusprocessing.clustering import Mappings
+from conspiracies.corpusprocessing.triplet import Triplet, TripletField
+
+
+def random_triplets(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    words = [f"word {i}" for i in range(12)]
+    # the same instants in different time zones tie, but format differently
+    timestamps = [None] + [
+        datetime(2020, 1, 1, hour, tzinfo=timezone(timedelta(hours=hours)))
+        for hour in range(3)
+        for hours in range(-2, 3)
+    ]
+    return [
+        Triplet(
+            subject=TripletField(text=rng.choice(words)),
+            predicate=TripletField(text=rng.choice(words[:4])),
+            object=TripletField(text=rng.choice(words)),
+            doc=rng.choice([None, "", "doc 1", "doc 2", "doc 3", "doc 4"]),
+            timestamp=rng.choice(timestamps),
+        )
+        for _ in range(n)
+    ]
+
+
+def reference_aggregate(triplets, mappings: Mappings):
+    """Aggregation with StatsDict.from_iterable over Triplet objects."""
+    triplets = [
+        Triplet(
+            subject=TripletField(text=mappings.map_entity(t.subject.text)),
+            predicate=TripletField(text=mappings.map_predicate(t.predicate.text)),
+            object=TripletField(text=mappings.map_entity(t.object.text)),
+            doc=t.doc,
+            timestamp=t.timestamp,
+        )
+        for t in triplets
+    ]
+    triplets = [t for t in triplets if t.subject.text != t.object.text]
+    return TripletStats(
+        triplets=StatsDict.from_iterable(
+            (
+                (
+                    (t.subject.text, t.predicate.text, t.object.text),
+                    t.doc,
+                    t.timestamp,
+                )
+                for t in triplets
+            ),
+        ),
+        entities=StatsDict.from_iterable(
+            (
+                (field.text, t.doc, t.timestamp)
+                for t in triplets
+                for field in [t.subject, t.object]
+            ),
+            mappings.entity_alt_labels(),
+        ),
+        predicates=StatsDict.from_iterable(
+            ((t.predicate.text, t.doc, t.timestamp) for t in triplets),
+            mappings.predicate_alt_labels(),
+        ),
+    )
+
+
+def sorted_docs(stats: TripletStats):
+    for statsdict in (stats.triplets, stats.entities, stats.predicates):
+        for entry in statsdict.values():
+            if entry["docs"] is not None:
+                entry["docs"].sort()
+    return stats
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_aggregate_matches_from_iterable(seed):
+    triplets = random_triplets(500, seed)
+    mappings = Mappings(
+        entities={"word 1": "word 0", "word 2": "word 0", "word 5": "word 4"},
+        predicates={"word 3": "word 2"},
+    )
+
+    stats = TripletAggregator(mappings).aggregate(triplets)
+    expected = reference_aggregate(triplets, mappings)
+
+    assert sorted_docs(stats) == sorted_docs(expected)
+    # keys are in order of first occurrence
+    for name in ("triplets", "entities", "predicates"):
+        assert list(getattr(stats, name)) == list(getattr(expected, name))
+
+
+def test_aggregate_without_mappings():
+    stats = TripletAggregator().aggregate(random_triplets(50))
+    assert sum(entry["frequency"] for entry in stats.predicates.values()) <= 50
+    assert TripletAggregator().aggregate([]).entries() == {
+        "triplets": [],
+        "entities": [],
+        "predicates": [],
+    }
+
+
+def test_combine_partial_aggregates(tmp_path):
+    triplets = random_triplets(600, seed=3)
+    mappings = Mappings(entities={"word 1": "word 0"}, predicates={})
+    aggregator = TripletAggregator(mappings)
+    shards = [triplets[:250], triplets[250:260], [], triplets[260:]]
+    partials = [aggregator.aggregate_partial(shard) for shard in shards]
+
+    combined = PartialTripletStats.combine(partials)
+    assert aggregator.finalize(combined) == aggregator.aggregate(triplets)
+
+    # partials can be saved, and extended when a new shard arrives
+    PartialTripletStats.combine(partials[:2]).save(tmp_path / "partial.npz")
+    loaded = PartialTripletStats.load(tmp_path / "partial.npz")
+    extended = loaded.merge(partials[2]).merge(partials[3])
+    assert aggregator.finalize(extended) == aggregator.finalize(combined)
+    assert list(extended.triplets.keys) == list(combined.triplets.keys)
+
+
+def test_max_docs():
+    triplets = random_triplets(300, seed=4)
+    for i, t in enumerate(triplets):
+        t.doc = f"doc {i % 40}"
+    full = TripletAggregator().aggregate(triplets)
+    capped = TripletAggregator(max_docs=3).aggregate(triplets)
+
+    for name in ("triplets", "entities", "predicates"):
+        for key, entry in getattr(capped, name).items():
+            full_entry = getattr(full, name)[key]
+            assert entry["n_docs"] == full_entry["n_docs"] == len(full_entry["docs"])
+            assert len(entry["docs"]) == min(entry["n_docs"], 3)
+            assert set(entry["docs"]) <= set(full_entry["docs"])
+            entry["docs"], entry["n_docs"] = full_entry["docs"], full_entry["n_docs"]
+    assert capped == full
+    assert any(entry["n_docs"] > 3 for entry in full.entities.values())
+
+    # the samples do not depend on how the corpus is sharded
+    aggregator = TripletAggregator(max_docs=3)
+    partials = [
+        aggregator.aggregate_partial(triplets[:100]),
+        aggregator.aggregate_partial(triplets[100:]),
+    ]
+    sharded = aggregator.finalize(PartialTripletStats.combine(partials[::-1]))
+    for key, entry in sharded.entities.items():
+        expected = aggregator.aggregate(triplets).entities[key]["docs"]
+        assert sorted(entry["docs"]) == sorted(expected)
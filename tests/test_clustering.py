@@ -1,4 +1,14 @@
-from conspiracies.corpusprocessing.clustering import Clustering
+import inspect
+import zlib
+
+import numpy as np
+import pytest
+from hdbscan import HDBSCAN
+
+from conspiracies.common.processes import spawn_pool
+from conspiracies.corpusprocessing.clustering import Clustering, DisjointSet
+from conspiracies.corpusprocessing.incremental import ClusterPrototypes
+from conspiracies.corpusprocessing.triplet import Triplet, TripletField
 
 
 class TestCombineClusters:
@@ -29,3 +39,432 @@ class TestCombineClusters:
             Clustering._combine_clusters(clusters, get_combine_key=lambda x: x[1])
             == expected
         )
+
+
+class CountingEncoder:
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, texts, show_progress_bar=False):
+        self.encoded.extend(texts)
+        return np.array([[len(text), ord(text[0])] for text in texts], dtype=np.float32)
+
+
+class GroupEncoder:
+    """Embeds texts close to a center given by their first word."""
+
+    centers = {"dog": [10, 0], "cat": [0, 10], "car": [-10, 0]}
+
+    def encode(self, texts, show_progress_bar=False):
+        rng = np.random.default_rng(len(texts))
+        centers = np.array([self.centers[text.split()[0]] for text in texts])
+        return (centers + rng.normal(scale=0.5, size=centers.shape)).astype(
+            np.float32,
+        )
+
+
+def grouped_fields():
+    return [
+        TripletField(text=f"{group} {i}", head=group)
+        for i in range(10)
+        for group in GroupEncoder.centers
+    ]
+
+
+class TestEmbed:
+    @staticmethod
+    def clustering(encoder, **kwargs):
+        clustering = Clustering(language="en", embedding_model="test-model", **kwargs)
+        clustering._get_embedding_model = lambda: encoder
+        return clustering
+
+    def test_encodes_unique_texts_once(self):
+        encoder = CountingEncoder()
+        texts = ["regeringen", "ministeren", "regeringen", "regeringen"]
+        embeddings = self.clustering(encoder)._embed(texts)
+        assert encoder.encoded == ["regeringen", "ministeren"]
+        assert embeddings.shape == (4, 2)
+        assert np.array_equal(embeddings[0], embeddings[3])
+        assert embeddings[1].tolist() == [10, ord("m")]
+
+    def test_cache_persists_between_runs(self, tmp_path):
+        encoder = CountingEncoder()
+        first = self.clustering(encoder, cache_dir=tmp_path)._embed(["a", "bb", "a"])
+
+        encoder = CountingEncoder()
+        second = self.clustering(encoder, cache_dir=tmp_path)._embed(
+            ["bb", "ccc", "a"],
+        )
+        assert encoder.encoded == ["ccc"]
+        assert np.array_equal(second[[2, 0]], first[[0, 1]])
+
+        # the cache is keyed by the embedding model
+        encoder = CountingEncoder()
+        other = Clustering(language="en", embedding_model="other", cache_dir=tmp_path)
+        other._get_embedding_model = lambda: encoder
+        other._embed(["a"])
+        assert encoder.encoded == ["a"]
+
+
+def test_disjoint_set():
+    components = DisjointSet(6)
+    components.union(4, 1)
+    components.union(5, 2)
+    components.union(2, 4)
+    assert components.find(5) == components.find(1) == 1
+    assert components.groups() == [[0], [1, 2, 4, 5], [3]]
+
+
+def test_combine_clusters_transitive_order():
+    # merged clusters are ordered by their first cluster, members by cluster
+    clusters = [["a"], ["x"], ["b", "c"], ["c", "x"], ["y"], ["b"]]
+    expected = [["a"], ["x", "b", "c", "c", "x", "b"], ["y"]]
+    assert Clustering._combine_clusters(clusters) == expected
+
+
+def test_rank_members():
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(50, 4)).astype(np.float32)
+    clusters = [list(range(0, 20)), [], [45, 30, 31], list(range(20, 30)), [49]]
+
+    ranked = Clustering._rank_members(embeddings, clusters)
+
+    # same result as sorting each cluster by the inner product with its mean
+    for cluster, ranked_cluster in zip(clusters, ranked):
+        mean = np.mean(embeddings[cluster], axis=0) if cluster else None
+        expected = sorted(
+            cluster,
+            key=lambda i: np.inner(embeddings[i], mean),
+            reverse=True,
+        )
+        assert ranked_cluster == expected
+    assert Clustering._rank_members(embeddings, [[], []]) == [[], []]
+
+
+def test_cluster():
+    clustering = Clustering(language="en", min_cluster_size=3, min_samples=2)
+    clustering._get_embedding_model = GroupEncoder
+    clusters = clustering._cluster(grouped_fields())
+
+    groups = sorted(tuple({field.head for field in cluster}) for cluster in clusters)
+    assert groups == [("car",), ("cat",), ("dog",)]
+
+
+def test_cluster_reuses_stored_arrays(tmp_path):
+    fields = grouped_fields()
+    clustering = Clustering(
+        language="en",
+        n_dimensions=2,
+        n_neighbors=5,
+        min_cluster_size=3,
+        min_samples=2,
+        cache_dir=tmp_path,
+    )
+    clustering._get_embedding_model = GroupEncoder
+    clusters = clustering._cluster(fields)
+    stored = sorted(path.name.split("-")[0] for path in tmp_path.glob("arrays/*"))
+    assert stored == ["raw", "scaled", "umap"]
+
+    # a rerun with other thresholds goes straight to the stored reduced embeddings
+    def fail(texts):
+        raise AssertionError("embeddings should not be recomputed")
+
+    rerun = Clustering(
+        language="en",
+        n_dimensions=2,
+        n_neighbors=5,
+        min_cluster_size=4,
+        min_samples=2,
+        cache_dir=tmp_path,
+    )
+    rerun._embed = fail
+    embeddings = rerun._reduced_embeddings([field.text for field in fields])
+    assert isinstance(embeddings, np.memmap)
+    assert len(rerun._cluster(fields)) == len(clusters)
+
+
+def test_sweep_matches_separate_clusterings():
+    triplets = [
+        Triplet(subject=subject, predicate=predicate, object=obj)
+        for subject, predicate, obj in zip(
+            grouped_fields(),
+            grouped_fields()[::-1],
+            grouped_fields()[1:] + grouped_fields()[:1],
+        )
+    ]
+    clustering = Clustering(language="en")
+    clustering._get_embedding_model = GroupEncoder
+
+    results = clustering.sweep(triplets, min_cluster_sizes=[3, 25], min_samples=[2])
+
+    assert [r.min_cluster_size for r in results["entities"]] == [3, 25]
+    for result in results["entities"] + results["predicates"]:
+        clustering.min_cluster_size = result.min_cluster_size
+        clustering.min_samples = result.min_samples
+        clusters = clustering._cluster(
+            (
+                [t.subject for t in triplets] + [t.object for t in triplets]
+                if result in results["entities"]
+                else [t.predicate for t in triplets]
+            ),
+        )
+        assert result.n_clusters == len(clusters)
+        assert result.mapping_size == len(
+            Clustering._mapping_to_first_member(clusters),
+        )
+    small, large = results["entities"]
+    assert small.n_clusters > large.n_clusters
+    assert 0 <= small.noise_ratio <= 1
+
+
+def test_create_mappings_incremental(tmp_path):
+    def triplets_of(fields):
+        return [Triplet(subject=f, predicate=f, object=f) for f in fields]
+
+    clustering = Clustering(
+        language="en",
+        min_cluster_size=3,
+        min_samples=2,
+        min_similarity=0.9,
+    )
+    clustering._get_embedding_model = GroupEncoder
+    mappings = clustering.create_mappings(
+        triplets_of(grouped_fields()),
+        state_dir=tmp_path,
+    )
+    assert (tmp_path / "entities.npz").exists()
+
+    # new texts are assigned to the existing clusters without re-clustering
+    def fail(fields):
+        raise AssertionError("should not re-cluster")
+
+    clustering._cluster = fail
+    new_fields = [TripletField(text="dog new"), TripletField(text="cat new")]
+    updated = clustering.create_mappings(
+        triplets_of(grouped_fields() + new_fields),
+        state_dir=tmp_path,
+    )
+    assert updated.entities["dog new"].startswith("dog")
+    assert updated.entities["cat new"].startswith("cat")
+    assert updated.entities.items() >= mappings.entities.items()
+
+    # lots of new data triggers a full re-clustering
+    clustering.max_growth = 0.01
+    with pytest.raises(AssertionError, match="re-cluster"):
+        clustering.create_mappings(
+            triplets_of(grouped_fields() + [TripletField(text="car new")]),
+            state_dir=tmp_path,
+        )
+
+
+def test_cluster_prototypes_save_load(tmp_path):
+    prototypes = ClusterPrototypes(
+        labels=["hund", "kæledyr 🐈"],
+        prototypes=np.eye(2, 3),
+        known_texts=["hund", "kæledyr 🐈", "a much longer text than the others", ""],
+        n_fields=10,
+        n_new_fields=2,
+    )
+    prototypes.save(tmp_path / "entities.npz")
+    with np.load(tmp_path / "entities.npz") as data:
+        # texts are not padded to the length of the longest text
+        assert data["known_texts"].dtype == np.uint8
+    loaded = ClusterPrototypes.load(tmp_path / "entities.npz")
+    assert loaded.labels == prototypes.labels
+    assert loaded.known_texts == prototypes.known_texts
+    np.testing.assert_array_equal(loaded.prototypes, prototypes.prototypes)
+    assert (loaded.n_fields, loaded.n_new_fields) == (10, 2)
+
+
+def test_create_mappings_concurrently():
+    triplets = [
+        Triplet(subject=subject, predicate=predicate, object=obj)
+        for subject, predicate, obj in zip(
+            grouped_fields(),
+            grouped_fields()[::-1],
+            grouped_fields()[1:] + grouped_fields()[:1],
+        )
+    ]
+    mappings = []
+    for n_jobs in [None, 2]:
+        clustering = Clustering(
+            language="en",
+            embedding_model="test-model",
+            min_cluster_size=3,
+            min_samples=2,
+            n_jobs=n_jobs,
+        )
+        # the embedding model is loaded once and used for both
+        clustering._model = GroupEncoder()
+        mappings.append(clustering.create_mappings(triplets))
+    assert mappings[0] == mappings[1]
+    assert len(mappings[0].entities) > 0
+
+
+def test_cluster_sampled():
+    fields = [
+        TripletField(text=f"{group} {i}", head=group)
+        for i in range(30)
+        for group in GroupEncoder.centers
+    ]
+    clustering = Clustering(
+        language="en",
+        embedding_model="test-model",
+        min_cluster_size=3,
+        min_samples=2,
+        min_similarity=0.5,
+        max_sample_size=45,
+        assign_batch_size=7,
+    )
+    clustering._model = GroupEncoder()
+
+    clusters = clustering._cluster(fields)
+    assert sum(len(cluster) for cluster in clusters) > 45
+    for cluster in clusters:
+        assert len({field.head for field in cluster}) == 1
+
+    triplets = [Triplet(subject=f, predicate=f, object=f) for f in fields]
+    reports = clustering.evaluate_sampling(triplets, holdout_size=60)
+    assert reports["predicates"].n_fields == 60
+    assert reports["predicates"].sample_size == 30
+    assert -1 <= reports["entities"].adjusted_rand_index <= 1
+
+
+@pytest.mark.parametrize("n_jobs", [None, 2])
+def test_cluster_blocked(n_jobs):
+    fields = [
+        TripletField(text=f"{group} {i}", head=group)
+        for i in range(20)
+        for group in GroupEncoder.centers
+    ]
+    # a second block of dogs, merged with the first by their centroids
+    fields += [TripletField(text=f"dog {i}", head="Hound!") for i in range(20, 40)]
+    fields += [TripletField(text=f"cat {i}") for i in range(20, 23)]
+    clustering = Clustering(
+        language="en",
+        embedding_model="test-model",
+        min_cluster_size=5,
+        min_samples=2,
+        blocking=True,
+        min_block_size=10,
+        n_jobs=n_jobs,
+    )
+    clustering._model = GroupEncoder()
+
+    blocks = clustering._blocks(fields)
+    assert [len(block) for block in blocks] == [20, 20, 20, 20, 3]
+
+    clusters = clustering._cluster(fields)
+    for cluster in clusters:
+        assert len({field.text.split()[0] for field in cluster}) == 1
+    dog_clusters = [c for c in clusters if c[0].text.startswith("dog")]
+    assert len(dog_clusters) == 1
+    assert {field.head for field in dog_clusters[0]} == {"dog", "Hound!"}
+
+
+def test_blocked_pools_are_not_nested(monkeypatch):
+    from conspiracies.corpusprocessing import clustering as clustering_module
+
+    pool_sizes = []
+
+    def recording_spawn_pool(max_workers):
+        pool_sizes.append(max_workers)
+        return spawn_pool(max_workers)
+
+    monkeypatch.setattr(clustering_module, "spawn_pool", recording_spawn_pool)
+    fields = [
+        TripletField(text=f"{group} {i}", head=group)
+        for i in range(20)
+        for group in GroupEncoder.centers
+    ]
+    clustering = Clustering(
+        language="en",
+        embedding_model="test-model",
+        min_cluster_size=5,
+        min_samples=2,
+        blocking=True,
+        min_block_size=10,
+        n_jobs=2,
+    )
+    clustering._model = GroupEncoder()
+    clustering.create_mappings(
+        [Triplet(subject=f, predicate=f, object=f) for f in fields],
+    )
+    # one pool per blocked clustering, none for clustering concurrently
+    assert pool_sizes == [2, 2]
+
+
+class BatchRecordingEncoder(GroupEncoder):
+    """Embeds each text the same way in any batch, and records the batch sizes."""
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def encode(self, texts, show_progress_bar=False):
+        self.batch_sizes.append(len(texts))
+        return np.array(
+            [
+                self.centers[text.split()[0]]
+                + np.random.default_rng(zlib.crc32(text.encode())).normal(
+                    scale=0.5,
+                    size=2,
+                )
+                for text in texts
+            ],
+            dtype=np.float32,
+        ).reshape(-1, 2)
+
+
+def test_create_mappings_concurrently_sampled(tmp_path):
+    fields = [
+        TripletField(text=f"{group} {i}", head=group)
+        for i in range(30)
+        for group in GroupEncoder.centers
+    ]
+    triplets = [Triplet(subject=f, predicate=f, object=f) for f in fields]
+    mappings = []
+    runs = [(None, tmp_path / "a"), (2, tmp_path / "b"), (2, tmp_path / "b")]
+    for n_jobs, cache_dir in runs:
+        clustering = Clustering(
+            language="en",
+            embedding_model="test-model",
+            min_cluster_size=3,
+            min_samples=2,
+            min_similarity=0.5,
+            max_sample_size=45,
+            assign_batch_size=7,
+            n_jobs=n_jobs,
+            cache_dir=cache_dir,
+        )
+        encoder = BatchRecordingEncoder()
+        clustering._model = encoder
+        mappings.append(clustering.create_mappings(triplets))
+        # only the samples are embedded as a whole, the rest in batches, and
+        # the workers never load the embedding model themselves
+        assert max(encoder.batch_sizes, default=0) <= 45
+    # the rerun starts from the stored reduced embeddings of the samples
+    assert mappings[0] == mappings[1] == mappings[2]
+    assert len(mappings[0].entities) > 45
+
+
+def test_tree_to_labels_signature():
+    # sweep relies on this private function of hdbscan, see the pin in pyproject
+    from hdbscan.hdbscan_ import _tree_to_labels
+
+    parameters = list(inspect.signature(_tree_to_labels).parameters)
+    assert parameters[:3] == [
+        "X",
+        "single_linkage_tree",
+        "min_cluster_size",
+    ], "hdbscan.hdbscan_._tree_to_labels changed, update Clustering._sweep"
+    assert "allow_single_cluster" in parameters
+
+    embeddings = GroupEncoder().encode([f.text for f in grouped_fields()])
+    model = HDBSCAN(min_cluster_size=3, min_samples=2).fit(embeddings)
+    labels, probabilities, *_ = _tree_to_labels(
+        embeddings,
+        model.single_linkage_tree_.to_numpy(),
+        min_cluster_size=3,
+    )
+    assert np.array_equal(labels, model.labels_)
+    assert np.allclose(probabilities, model.probabilities_)
@@ -1,3 +1,6 @@
+from difflib import SequenceMatcher
+
+import numpy as np
 import pytest
 import spacy
 from spacy import Vocab
@@ -8,7 +11,11 @@ from conspiracies.docprocessing.relationextraction.gptprompting import (
     StringTriplet,
 )
 from conspiracies.docprocessing.relationextraction import data_classes
+from conspiracies.docprocessing.relationextraction.gptprompting import (
+    score_open_relations,
+)
 from spacy.tokens import Doc
+from spacy.training import Example
 
 
 def test_relationextraction_doc_extension():
@@ -135,6 +142,45 @@ class TestSpanTriplet:
         assert triplet.predicate.text == str_triplet[1]
         assert triplet.object.text == str_triplet[2]
 
+    @pytest.mark.parametrize("lowercase", [True, False])
+    @pytest.mark.parametrize("ignore_spaces", [True, False])
+    def test_span_index_find(self, nlp, lowercase, ignore_spaces):
+        doc = nlp("Kenneth er glad i   dag. kenneth er GLAD i dag, og er glad")
+        span_index = data_classes.SpanIndex(doc)
+        for text in ["Kenneth", "er glad", "glad i dag", "i   dag", "er", "nej"]:
+            subspan = nlp(text)
+            for span in [doc, doc[2:10], doc[5:], doc[3:3]]:
+                expected = data_classes.subspan_of_span(
+                    subspan,
+                    span,
+                    lowercase=lowercase,
+                    ignore_spaces=ignore_spaces,
+                )
+                found = span_index.find(
+                    subspan,
+                    span,
+                    lowercase=lowercase,
+                    ignore_spaces=ignore_spaces,
+                )
+                assert found == expected
+
+    def test_from_doc_with_span_index(self, nlp):
+        doc = nlp("Kenneth er glad i   dag. Han er glad for is. Jeg er sur.")
+        span_index = data_classes.SpanIndex(doc)
+        str_triplets = [
+            ["Kenneth", "er", "glad i   dag"],
+            ["Han", "er glad", "for is"],
+            ["jeg", "er", "sur"],
+            ["Kenneth", "er", "sur"],
+            ["Han", "er", "ikke her"],
+        ]
+        for str_triplet in str_triplets:
+            assert SpanTriplet.from_doc(
+                str_triplet,
+                doc=doc,
+                span_index=span_index,
+            ) == SpanTriplet.from_doc(str_triplet, doc=doc)
+
 
 class TestDocTriplet:
     def test_init(self, span_triplets):
@@ -217,3 +263,166 @@ class TestDocTriplet:
         scores["exact_text_match"] = 0
         scores["normalized_span_overlap"] = 0
         scores["normalized_char_overlap"] = 0.8
+
+    def test_score_relations_optimal_assignment(self, nlp: spacy.Language):
+        doc = nlp("this is a test . the test seems cool")
+        gold = DocTriplets(
+            span_triplets=[
+                SpanTriplet(subject=doc[0:1], predicate=doc[1:2], object=doc[2:4]),
+                SpanTriplet(subject=doc[5:7], predicate=doc[7:8], object=doc[8:9]),
+            ],
+            doc=doc,
+        )
+        pred_triplets = [
+            SpanTriplet(subject=doc[5:7], predicate=doc[7:8], object=doc[8:9]),
+            SpanTriplet(subject=doc[0:1], predicate=doc[1:2], object=doc[3:4]),
+            SpanTriplet(subject=doc[5:7], predicate=doc[7:8], object=doc[6:7]),
+        ]
+
+        scores = []
+        for order in [[0, 1, 2], [2, 1, 0], [1, 2, 0]]:
+            pred = DocTriplets(
+                span_triplets=[pred_triplets[i] for i in order],
+                doc=doc,
+            )
+            scores.append(pred.score_relations(gold))
+
+        # the result does not depend on the order of the predictions
+        assert all(score == scores[0] for score in scores)
+        score = scores[0]
+        assert score["exact_span_match"] == 1
+        assert score["exact_string_match"] == 1
+        assert score["normalized_span_overlap"] == pytest.approx(1 + 2.5 / 3)
+        assert score["normalized_string_overlap"] == pytest.approx(1 + (2 + 4 / 6) / 3)
+        assert score["length_self"] == 3
+        assert score["length_reference"] == 2
+
+        # spans of a different doc object with the same text only overlap when the
+        # triplets are equal
+        other_doc = nlp(doc.text)
+        pred = DocTriplets(
+            span_triplets=[
+                SpanTriplet(
+                    subject=other_doc[5:7],
+                    predicate=other_doc[7:8],
+                    object=other_doc[8:9],
+                ),
+                SpanTriplet(
+                    subject=other_doc[0:1],
+                    predicate=other_doc[1:2],
+                    object=other_doc[3:4],
+                ),
+            ],
+            doc=other_doc,
+        )
+        score = pred.score_relations(gold)
+        assert score["exact_span_match"] == 1
+        assert score["normalized_span_overlap"] == 1
+
+    def test_score_open_relations_parallel(self, nlp: spacy.Language):
+        data_classes.install_extensions(force=True)
+        examples = []
+        for text in ["this is a test", "the test seems cool", "I am happy today"]:
+            reference = nlp(text)
+            predicted = nlp(text)
+            reference._.relation_triplets = [
+                SpanTriplet(
+                    subject=reference[0:1],
+                    predicate=reference[1:2],
+                    object=reference[2:4],
+                ),
+            ]
+            predicted._.relation_triplets = [
+                SpanTriplet(
+                    subject=predicted[0:1],
+                    predicate=predicted[1:2],
+                    object=predicted[3:4],
+                ),
+            ]
+            examples.append(Example(predicted, reference))
+
+        scores = score_open_relations(examples)
+        parallel_scores = score_open_relations(examples, n_process=2, chunksize=1)
+        assert scores == parallel_scores
+        assert scores["n_predictions"] == scores["n_references"] == 3
+
+
+def test_triplet_offsets(nlp):
+    data_classes.install_extensions(force=True)
+    doc = nlp("this is a test . the test seems cool")
+    triplets = [
+        SpanTriplet.from_tuple((doc[0:1], doc[1:2], doc[2:4])),
+        SpanTriplet.from_tuple((doc[5:7], doc[7:8], doc[8:9])),
+    ]
+    doc._.relation_triplets = triplets
+    doc._.relation_confidence = [0.5, 0.9]
+    other_doc = nlp("I am happy today")
+    other_doc._.relation_triplets = [
+        SpanTriplet.from_tuple((other_doc[0:1], other_doc[1:2], other_doc[2:3])),
+    ]
+
+    offsets = data_classes.TripletOffsets.from_docs([doc, other_doc])
+    assert len(offsets) == 3
+    assert offsets.doc_idxs.tolist() == [0, 0, 1]
+    assert offsets.offsets[1].tolist() == [5, 7, 7, 8, 8, 9]
+    assert offsets.confidences[:2].tolist() == [0.5, pytest.approx(0.9)]
+    assert np.isnan(offsets.confidences[2])
+
+    # conversions
+    assert offsets.to_span_triplets([doc, other_doc])[:2] == triplets
+    assert offsets[:2].to_idx_tuples() == doc._.relation_triplet_idxs
+    assert offsets[:2] == data_classes.TripletOffsets.from_span_triplets(
+        triplets,
+        confidences=[0.5, 0.9],
+    )
+    assert offsets == data_classes.TripletOffsets.concatenate(
+        [offsets[0], offsets[1:]],
+    )
+
+    # serialization matches SpanTriplet.to_dict
+    heads = [(doc[0:1], doc[3:4]), (doc[6:7], doc[8:9])]
+    with_heads = data_classes.TripletOffsets.from_span_triplets(triplets, heads=heads)
+    dicts = with_heads.to_dicts(doc)
+    assert dicts == [
+        triplet.to_dict(include_doc=False, include_span_heads=True, span_heads=h)
+        for triplet, h in zip(triplets, heads)
+    ]
+    assert data_classes.TripletOffsets.from_dicts(dicts) == (
+        data_classes.TripletOffsets(doc_idxs=[0, 0], offsets=offsets.offsets[:2])
+    )
+
+
+@pytest.mark.parametrize(
+    "a, b",
+    [
+        ("", "abc"),
+        ("abc", "abc"),
+        ("the test seems cool", "a test seemed cool"),
+        ("aaaa", "aa"),
+        ("abcxabcdy", "zabcdabc"),
+        ([1, 2, 3, 4], [0, 2, 3, 5, 2, 3, 4]),
+    ],
+)
+def test_lcs_size(a, b):
+    reference = SequenceMatcher(None, a, b).find_longest_match().size
+    assert data_classes._lcs_size(a, b) == reference
+    assert data_classes._lcs_size(b, a) == reference
+
+
+def test_lcs_size_batched():
+    rng = np.random.default_rng(0)
+    texts = ["".join(rng.choice(list("abc "), size=n)) for n in rng.integers(0, 30, 40)]
+    pairs = [(a, b) for a in texts[:20] for b in texts[20:]]
+    expected = [SequenceMatcher(None, a, b).find_longest_match().size for a, b in pairs]
+
+    assert data_classes.lcs_sizes(pairs) == expected
+    matrix = data_classes.lcs_size_matrix(texts[:20], texts[20:])
+    assert matrix.ravel().tolist() == expected
+
+    # unhashable sequences, e.g. lists of tokens, are accepted too
+    list_pairs = [(list(a), list(b)) for a, b in pairs]
+    assert data_classes.lcs_sizes(list_pairs) == expected
+
+    # token sequences of spans work as well
+    doc = spacy.blank("en")("the test seems cool and the test is fun")
+    assert data_classes._lcs_size(doc[0:4], doc[1:8]) == 3
@@ -1,4 +1,8 @@
+import spacy
+from spacy.tokens import Doc
+
 import conspiracies  # noqa F401
+import conspiracies.docprocessing.headwordextraction  # noqa F401
 
 from .utils import nlp_en  # noqa F401
 
@@ -30,3 +34,29 @@ def test_most_common_ancestor(nlp_en):  # noqa F811
     )  # Single token Span
     assert doc[0:2]._.most_common_ancestor.text == "Mette Frederiksen"  # Span
     assert doc._.most_common_ancestor.text == "is"  # Doc
+
+
+def test_most_common_ancestors_batch():
+    nlp = spacy.blank("en")
+    nlp.add_pipe(
+        "heads_extraction",
+        config={"normalize_to_entity": False, "normalize_to_noun_chunk": False},
+    )
+    doc = Doc(
+        nlp.vocab,
+        words=["Mette", "Frederiksen", "is", "the", "Danish", "politician", "."],
+        heads=[1, 2, 2, 5, 5, 2, 2],
+        deps=["flat", "nsubj", "ROOT", "det", "amod", "attr", "punct"],
+    )
+    spans = [doc[0:1], doc[0:2], doc[3:6], doc[3:5], doc[:]]
+
+    heads = doc._.most_common_ancestors(spans)
+
+    assert [head.text for head in heads] == [
+        "Mette",
+        "Frederiksen",
+        "politician",
+        "the",  # no ancestor within the span, falls back to the first token
+        "is",
+    ]
+    assert heads == [span._.most_common_ancestor for span in spans]
@@ -0,0 +1,102 @@
+import pytest
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import (
+    BartConfig,
+    BartForConditionalGeneration,
+    GPT2Config,
+    GPT2LMHeadModel,
+    PreTrainedTokenizerFast,
+)
+
+from conspiracies.docprocessing.relationextraction.gptprompting import (
+    XMLStylePromptTemplate,
+    chatGPTPromptTemplate,
+)
+from conspiracies.docprocessing.relationextraction.gptprompting.prompt_apis import (
+    _to_generate_kwargs,
+    create_huggingface_local_prompt_api,
+)
+
+from .test_data.prompt_data import load_examples, test_tweet
+
+
+def create_tokenizer() -> PreTrainedTokenizerFast:
+    special_tokens = ["<pad>", "<s>", "</s>", "<unk>"]
+    words = "this is a test tweet user1 user2 subject predicate object".split()
+    vocab = {token: i for i, token in enumerate(special_tokens + words)}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        pad_token="<pad>",
+        bos_token="<s>",
+        eos_token="</s>",
+        unk_token="<unk>",
+        model_max_length=256,
+    )
+
+
+@pytest.fixture(scope="module")
+def tiny_models(tmp_path_factory):
+    """Save tiny randomly initialized causal and seq2seq models."""
+    tokenizer = create_tokenizer()
+    size = dict(vocab_size=len(tokenizer), max_position_embeddings=256)
+    models = {
+        "gpt2": GPT2LMHeadModel(
+            GPT2Config(n_embd=16, n_layer=1, n_head=2, n_positions=256, **size),
+        ),
+        "bart": BartForConditionalGeneration(
+            BartConfig(
+                d_model=16,
+                encoder_layers=1,
+                decoder_layers=1,
+                encoder_attention_heads=2,
+                decoder_attention_heads=2,
+                encoder_ffn_dim=16,
+                decoder_ffn_dim=16,
+                pad_token_id=0,
+                bos_token_id=1,
+                eos_token_id=2,
+                decoder_start_token_id=2,
+                **size,
+            ),
+        ),
+    }
+    paths = {}
+    for name, model in models.items():
+        path = tmp_path_factory.mktemp(name)
+        model.save_pretrained(path)
+        tokenizer.save_pretrained(path)
+        paths[name] = str(path)
+    return paths
+
+
+@pytest.mark.parametrize("model", ["gpt2", "bart"])
+@pytest.mark.parametrize("template", [XMLStylePromptTemplate, chatGPTPromptTemplate])
+def test_huggingface_local_api(tiny_models, model, template):
+    prompt_fn = create_huggingface_local_prompt_api(
+        template(examples=load_examples()),
+        api_key="",
+        model_name=tiny_models[model],
+        api_kwargs={"max_tokens": 5, "temperature": 0, "frequency_penalty": 0},
+        batch_size=2,
+    )
+    targets = [test_tweet, "this is a test", "user1 user2", "tweet"]
+
+    responses = prompt_fn(targets)
+
+    assert len(responses) == len(targets)
+    assert all(isinstance(response, str) for response in responses)
+    assert all(len(response.split()) <= 5 for response in responses)
+    # greedy decoding is deterministic
+    assert prompt_fn(targets) == responses
+
+
+def test_to_generate_kwargs():
+    assert _to_generate_kwargs(
+        {"max_tokens": 500, "temperature": 0.7, "top_p": 1, "presence_penalty": 0},
+    ) == {"max_new_tokens": 500, "do_sample": True, "temperature": 0.7, "top_p": 1}
+    assert _to_generate_kwargs({"temperature": 0, "top_p": 1, "num_beams": 2}) == {
+        "do_sample": False,
+        "num_beams": 2,
+    }
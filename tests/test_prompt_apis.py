@@ -0,0 +1,189 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from confection import registry
+
+from conspiracies.docprocessing.relationextraction.gptprompting import (
+    XMLStylePromptTemplate,
+    chatGPTPromptTemplate,
+)
+from conspiracies.docprocessing.relationextraction.gptprompting.prompt_apis import (
+    get_max_prompt_tokens,
+)
+from conspiracies.docprocessing.relationextraction.gptprompting.rate_limiting import (
+    TokenBucket,
+    backoff_delay,
+    send_concurrently,
+)
+
+pytest.importorskip("openai")
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    """A local server mimicking the OpenAI completion endpoints.
+
+    The first request for every target is answered with a rate limit
+    error. The response echoes the last line of the prompt.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, delay: float = 0.05):
+        super().__init__(("127.0.0.1", 0), MockOpenAIHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.n_requests = 0
+        self.seen = set()
+
+    @property
+    def api_base(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server: MockOpenAIServer = self.server  # type: ignore
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if "messages" in body:
+            prompt = body["messages"][-1]["content"]
+        else:
+            prompt = body["prompt"]
+        key = prompt.strip().split("\n")[-1]
+
+        with server.lock:
+            server.n_requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            first_attempt = key not in server.seen
+            server.seen.add(key)
+        time.sleep(server.delay)
+        with server.lock:
+            server.in_flight -= 1
+
+        if first_attempt:
+            status = 429
+            response = {"error": {"message": "Rate limit", "type": "requests"}}
+        elif "messages" in body:
+            status = 200
+            response = {
+                "object": "chat.completion",
+                "choices": [{"message": {"role": "assistant", "content": key}}],
+            }
+        else:
+            status = 200
+            response = {"object": "text_completion", "choices": [{"text": key}]}
+
+        data = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def mock_server():
+    server = MockOpenAIServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize(
+    "backend, template",
+    [
+        ("conspiracies/openai_gpt3_async_api", XMLStylePromptTemplate),
+        ("conspiracies/openai_chatgpt_async_api", chatGPTPromptTemplate),
+    ],
+)
+def test_openai_async_api(mock_server, backend, template):
+    prompt_fn = registry.get("prompt_apis", backend)(
+        template(examples=[]),
+        "test-key",
+        "test-model",
+        {"max_tokens": 10},
+        max_concurrency=4,
+        base_delay=0.01,
+        api_base=mock_server.api_base,
+    )
+    targets = [f"tweet number {i}" for i in range(12)]
+
+    responses = prompt_fn(targets)
+
+    assert all(target in response for target, response in zip(targets, responses))
+    assert len(responses) == len(targets)
+    # every target was rate limited once and retried
+    assert mock_server.n_requests == 2 * len(targets)
+    assert 1 < mock_server.max_in_flight <= 4
+
+
+def test_send_concurrently_retries_and_keeps_order():
+    attempts = {}
+
+    async def send_request(target: str) -> str:
+        attempts[target] = attempts.get(target, 0) + 1
+        await asyncio.sleep(0.01 * (5 - int(target)))
+        if attempts[target] < 3:
+            raise ConnectionError()
+        return target
+
+    targets = [str(i) for i in range(5)]
+    responses = asyncio.run(
+        send_concurrently(
+            targets,
+            send_request,
+            retry_on=(ConnectionError,),
+            base_delay=0.001,
+        ),
+    )
+
+    assert responses == targets
+    assert all(n == 3 for n in attempts.values())
+
+    attempts.clear()
+    with pytest.raises(ConnectionError):
+        asyncio.run(
+            send_concurrently(
+                targets,
+                send_request,
+                retry_on=(ConnectionError,),
+                max_retries=0,
+            ),
+        )
+
+
+def test_token_bucket():
+    async def acquire_all(bucket: TokenBucket, n: int) -> float:
+        start = time.monotonic()
+        for _ in range(n):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    # a burst of capacity tokens is served immediately, the rest at the rate
+    elapsed = asyncio.run(acquire_all(TokenBucket(rate=50, capacity=5), 10))
+    assert 0.08 < elapsed < 0.5
+
+
+def test_backoff_delay():
+    delays = [
+        backoff_delay(attempt, base_delay=1, max_delay=10) for attempt in range(8)
+    ]
+    assert all(0 <= delay <= 10 for delay in delays)
+    assert backoff_delay(0, base_delay=1) <= 1
+
+
+def test_get_max_prompt_tokens():
+    assert get_max_prompt_tokens("gpt-4", {"max_tokens": 500}) == 8192 - 500
+    assert get_max_prompt_tokens("gpt-3.5-turbo-16k-0613", {}) == 16384
+    assert get_max_prompt_tokens("unknown-model", {"max_tokens": 500}) is None
@@ -0,0 +1,126 @@
+from typing import List
+
+from conspiracies.docprocessing.relationextraction.gptprompting import (
+    XMLStylePromptTemplate,
+)
+from conspiracies.docprocessing.relationextraction.gptprompting.prompt_apis import (
+    create_cached_prompt_api,
+)
+from conspiracies.docprocessing.relationextraction.gptprompting.prompt_cache import (
+    PromptResponseCache,
+)
+from conspiracies.registry import registry
+
+sent_targets: List[str] = []
+
+
+@registry.prompt_apis.register("test_counting_api")
+def create_counting_api(prompt_template, api_key, model_name, api_kwargs):
+    def prompt_fn(targets: List[str]) -> List[str]:
+        sent_targets.extend(targets)
+        return [f"response to {target}" for target in targets]
+
+    return prompt_fn
+
+
+def test_cached_prompt_api(tmp_path):
+    sent_targets.clear()
+    cache_path = tmp_path / "cache.db"
+    kwargs = dict(
+        prompt_template=XMLStylePromptTemplate(examples=[]),
+        api_key="",
+        model_name="test-model",
+        api_kwargs={"max_tokens": 10},
+        backend="test_counting_api",
+        cache_path=cache_path,
+    )
+    targets = ["a", "b", "a", "c"]
+
+    prompt_fn = create_cached_prompt_api(**kwargs)
+    responses = prompt_fn(targets)
+    assert responses == [f"response to {target}" for target in targets]
+    assert sent_targets == ["a", "b", "c"]
+    assert (prompt_fn.hits, prompt_fn.misses) == (0, 4)
+
+    assert prompt_fn(targets) == responses
+    assert len(sent_targets) == 3
+    assert (prompt_fn.hits, prompt_fn.misses) == (4, 4)
+
+    # the cache persists between runs, and only new targets are sent
+    prompt_fn = create_cached_prompt_api(**kwargs)
+    assert prompt_fn(["d", "b"]) == ["response to d", "response to b"]
+    assert sent_targets == ["a", "b", "c", "d"]
+    assert (prompt_fn.hits, prompt_fn.misses) == (1, 1)
+
+    # changing the api kwargs invalidates the cached responses
+    prompt_fn = create_cached_prompt_api(**{**kwargs, "api_kwargs": {}})
+    prompt_fn(["a"])
+    assert sent_targets[-1] == "a"
+    assert prompt_fn.misses == 1
+
+    # cache-only mode never sends requests
+    prompt_fn = create_cached_prompt_api(**kwargs, cache_only=True)
+    assert prompt_fn(["a", "e"]) == ["response to a", ""]
+    assert len(sent_targets) == 5
+    assert (prompt_fn.hits, prompt_fn.misses) == (1, 1)
+
+
+@registry.prompt_apis.register("test_failing_api")
+def create_failing_api(prompt_template, api_key, model_name, api_kwargs):
+    def prompt_fn(targets: List[str]) -> List[str]:
+        sent_targets.extend(targets)
+        # the first request for a target fails with an empty response
+        return [
+            f"response to {target}" if sent_targets.count(target) > 1 else ""
+            for target in targets
+        ]
+
+    return prompt_fn
+
+
+def test_cached_prompt_api_retries_empty_responses(tmp_path):
+    sent_targets.clear()
+    prompt_fn = create_cached_prompt_api(
+        prompt_template=XMLStylePromptTemplate(examples=[]),
+        api_key="",
+        model_name="test-model",
+        api_kwargs={},
+        backend="test_failing_api",
+        cache_path=tmp_path / "cache.db",
+    )
+    assert prompt_fn(["a", "b"]) == ["", ""]
+    assert len(prompt_fn.cache) == 0
+
+    assert prompt_fn(["a", "b"]) == ["response to a", "response to b"]
+    assert sent_targets == ["a", "b", "a", "b"]
+    assert (prompt_fn.hits, prompt_fn.misses) == (0, 4)
+
+    assert prompt_fn(["a"]) == ["response to a"]
+    assert len(sent_targets) == 4
+
+
+def test_cache_ignores_stored_empty_responses(tmp_path):
+    cache = PromptResponseCache(tmp_path / "cache.db")
+    # caches written by earlier versions may contain empty responses
+    cache._store.set_many([("a", ""), ("b", "x")])
+    assert cache.get_many(["a", "b"]) == {"b": "x"}
+    cache.close()
+
+
+def test_cache_key_depends_on_prompt():
+    key = PromptResponseCache.create_key("api", "model", {"n": 1}, "prompt", "t")
+    assert key == PromptResponseCache.create_key(
+        "api",
+        "model",
+        {"n": 1},
+        "prompt",
+        "t",
+    )
+    assert key != PromptResponseCache.create_key("api", "model", {"n": 1}, "other", "t")
+    assert key != PromptResponseCache.create_key(
+        "api",
+        "model",
+        {"n": 2},
+        "prompt",
+        "t",
+    )
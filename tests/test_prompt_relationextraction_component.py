@@ -1,3 +1,4 @@
+import re
 from typing import List
 
 import pytest
@@ -6,6 +7,12 @@ from conspiracies.docprocessing.relationextraction.gptprompting import (
     SpanTriplet,
     StringTriplet,
 )
+from conspiracies.docprocessing.relationextraction.gptprompting.prompt_batch import (
+    execute_batch_requests,
+)
+from conspiracies.docprocessing.relationextraction.gptprompting.prompt_templates import (
+    count_tokens,
+)
 from spacy.language import Language
 
 from .test_prompt_template_parse_prompt import (
@@ -114,3 +121,144 @@ def test_create_pipeline():
         last=True,
         config=config,
     )
+
+
+def test_prompt_relation_extraction_pipe():
+    calls = []
+
+    @registry.prompt_apis.register("test_batch_api")  # type: ignore
+    def create_test_batch_api(prompt_template, api_key, model_name, api_kwargs):
+        def test_api(targets):
+            calls.append(targets)
+            return ["(This) (is) (a test tweet)" for _ in targets]
+
+        return test_api
+
+    nlp = spacy.blank("da")
+    nlp.add_pipe("sentencizer")
+    nlp.add_pipe(
+        "conspiracies/prompt_relation_extraction",
+        config={"backend": "test_batch_api", "api_key": ""},
+    )
+    texts = ["This is a test tweet", "Also this is a test tweet", "Nothing here"]
+
+    docs = list(nlp.pipe(texts, batch_size=2))
+
+    # all targets of a batch are passed to the prompt api at once
+    assert calls == [texts[:2], texts[2:]]
+    assert [len(doc._.relation_triplets) for doc in docs] == [1, 1, 0]
+    assert docs[1]._.relation_triplets[0].object.text == "a test tweet"
+
+
+@pytest.mark.parametrize("second_answer", [None, "<subject-1>Also</subject-1> is"])
+def test_prompt_relation_extraction_packing(second_answer):
+    calls = []
+
+    def tag_tweet(tweet: str) -> str:
+        subject, predicate, obj = tweet.split(" ", 2)
+        return (
+            f"<subject-1>{subject}</subject-1> <predicate-1>{predicate}</predicate-1> "
+            f"<object-1>{obj}</object-1>"
+        )
+
+    @registry.prompt_apis.register("test_packing_api")  # type: ignore
+    def create_test_packing_api(prompt_template, api_key, model_name, api_kwargs):
+        def test_api(targets):
+            calls.append(targets)
+            responses = []
+            for target in targets:
+                if not prompt_template.is_packed(target):
+                    responses.append(tag_tweet(target))
+                    continue
+                tweets = re.findall(r"<tweet-(\d+)>(.*?)</tweet-\1>", target)
+                answers = {n: tag_tweet(tweet) for n, tweet in tweets}
+                # the answer for the second tweet is missing from the response or
+                # has no complete triplet
+                answers["2"] = second_answer
+                responses.append(
+                    "\n".join(
+                        f"<tweet-{n}>{answer}</tweet-{n}>"
+                        for n, answer in answers.items()
+                        if answer is not None
+                    ),
+                )
+            return responses
+
+        return test_api
+
+    texts = [
+        "This is a test tweet",
+        "Also this is a test tweet",
+        "They are here",
+        "We are testing a somewhat longer tweet, which gets a prompt on its own",
+    ]
+    nlp = spacy.blank("da")
+    nlp.add_pipe("sentencizer")
+    nlp.add_pipe(
+        "conspiracies/prompt_relation_extraction",
+        config={
+            "prompt_template": "conspiracies/xml_style_template",
+            "backend": "test_packing_api",
+            "api_key": "",
+            "packing_token_budget": sum(count_tokens(text) for text in texts[:3]),
+        },
+    )
+    docs = list(nlp.pipe(texts))
+
+    # the first three tweets are packed, and the second is prompted for again
+    assert len(calls) == 2
+    assert len(calls[0]) == 2 and calls[0][1] == texts[3]
+    assert calls[1] == [texts[1]]
+    objects = [doc._.relation_triplets[0].object.text for doc in docs]
+    assert objects == [text.split(" ", 2)[2] for text in texts]
+
+
+def test_prompt_relation_extraction_batch_job(tmp_path):
+    nlp = spacy.blank("da")
+    nlp.add_pipe("sentencizer")
+    component = nlp.add_pipe(
+        "conspiracies/prompt_relation_extraction",
+        config={
+            "prompt_template": "conspiracies/xml_style_template",
+            "split_doc_fn": None,
+            "api_key": "",
+        },
+    )
+    texts = ["This is a test tweet", "They are here", "This is a test tweet", "No"]
+    docs = list(nlp.pipe(texts, disable=[component.name]))
+
+    request_paths = component.write_batch_requests(
+        docs,
+        tmp_path / "requests.jsonl",
+        max_requests_per_file=2,
+    )
+    # identical targets share a request
+    assert [path.name for path in request_paths] == [
+        "requests-00000.jsonl",
+        "requests-00001.jsonl",
+    ]
+
+    def complete_fn(prompts):
+        # tag the target on the last line of the prompt, except for "No"
+        responses = []
+        for prompt in prompts:
+            target = prompt.strip().split("\n")[-1]
+            if target == "No":
+                responses.append("")
+                continue
+            subject, predicate, obj = target.split(" ", 2)
+            responses.append(
+                f"<subject-1>{subject}</subject-1> <predicate-1>{predicate}"
+                f"</predicate-1> <object-1>{obj}</object-1>",
+            )
+        return responses
+
+    results_path = execute_batch_requests(
+        request_paths,
+        tmp_path / "results.jsonl",
+        complete_fn,
+    )
+    docs = list(component.read_batch_results(docs, [results_path]))
+
+    assert [len(doc._.relation_triplets) for doc in docs] == [1, 1, 1, 0]
+    assert docs[1]._.relation_triplets[0].object.text == "here"
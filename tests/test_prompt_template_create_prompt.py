@@ -7,6 +7,9 @@ from conspiracies.docprocessing.relationextraction.gptprompting import (
     XMLStylePromptTemplate,
     chatGPTPromptTemplate,
 )
+from conspiracies.docprocessing.relationextraction.gptprompting.prompt_templates import (
+    count_tokens,
+)
 
 from .test_data.prompt_data import (
     MarkdownPromptTemplate1_expected_prompt,
@@ -86,3 +89,44 @@ def test_PromptTemplate_create_prompt(
     template = Template(task_description=task_description, examples=examples)
     prompt = template.create_prompt(target)
     assert prompt == expected_prompt
+
+
+@pytest.mark.parametrize(
+    "Template",
+    [
+        PromptTemplate1,
+        PromptTemplate2,
+        MarkdownPromptTemplate1,
+        MarkdownPromptTemplate2,
+        XMLStylePromptTemplate,
+        chatGPTPromptTemplate,
+    ],
+)
+def test_PromptTemplate_select_examples(Template):
+    template = Template(task_description=task_description, examples=examples)
+    full_prompt = template.create_prompt(test_tweet)
+    example_tokens = template.example_tokens
+    assert len(example_tokens) == len(examples)
+
+    # leave room for all but the longest example, with a margin for the rounding
+    # of the estimated token counts
+    longest = max(range(len(examples)), key=lambda i: example_tokens[i])
+    template.max_prompt_tokens = (
+        count_tokens(full_prompt) - example_tokens[longest] + len(examples)
+    )
+    selected = template.select_examples(test_tweet)
+    assert selected == tuple(i for i in range(len(examples)) if i != longest)
+    prompt = template.create_prompt(test_tweet)
+    assert count_tokens(prompt) <= template.max_prompt_tokens
+    assert prompt == Template(
+        task_description=task_description,
+        examples=[examples[i] for i in selected],
+    ).create_prompt(test_tweet)
+
+    # the selection is made per target without changing the examples
+    assert template.select_examples(test_tweet * 100) == ()
+    assert template.create_prompt(test_tweet) == prompt
+    assert len(template.examples) == len(examples)
+
+    template.max_prompt_tokens = None
+    assert template.create_prompt(test_tweet) == full_prompt
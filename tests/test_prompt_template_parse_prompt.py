@@ -80,3 +80,53 @@ def test_PromptTemplate_parse_prompt(
         assert parsed_triplet == expected_triplet
     parsed_triplets = template_instance.parse_prompt(response, target)
     assert parsed_triplets == expected_triplets
+
+
+@pytest.mark.parametrize(
+    "template, response, expected_triplets",
+    [
+        (
+            XMLStylePromptTemplate,
+            XMLStylePromptTemplate_expected_response,
+            XMLStylePromptTemplate_expected_triplets,
+        ),
+        (
+            chatGPTPromptTemplate,
+            chatGPTPromptTemplate_expected_response,
+            chatGPTPromptTemplate_expected_triplets,
+        ),
+    ],
+)
+def test_PromptTemplate_unpack_response(template, response, expected_triplets):
+    template_instance = template(examples=[])
+    assert template_instance.supports_packing
+
+    packed_target = template_instance.pack_targets([test_tweet, "second", "third"])
+    assert template_instance.is_packed(packed_target)
+    assert "<tweet-n>" in str(template_instance.create_prompt(packed_target))
+
+    # the model answers the first and third tweet, but skips the second
+    packed_response = f"<tweet-1>\n{response}\n</tweet-1>\n<tweet-3></tweet-3>"
+    unpacked = template_instance.unpack_response(packed_response, n_targets=3)
+    assert unpacked == [response, None, ""]
+    assert template_instance.parse_prompt(unpacked[0], test_tweet) == expected_triplets
+
+
+@pytest.mark.parametrize(
+    "template, response",
+    [
+        (XMLStylePromptTemplate, XMLStylePromptTemplate_expected_response),
+        (chatGPTPromptTemplate, chatGPTPromptTemplate_expected_response),
+    ],
+)
+def test_PromptTemplate_unpack_parsed_response(template, response):
+    template_instance = template(examples=[])
+    targets = [test_tweet, "second", "third"]
+
+    # the second answer is present but malformed, and the third is missing
+    packed_response = (
+        f"<tweet-1>\n{response}\n</tweet-1>\n"
+        "<tweet-2><subject-1>second</subject-1> second -</tweet-2>"
+    )
+    unpacked = template_instance.unpack_parsed_response(packed_response, targets)
+    assert unpacked == [response, None, None]
@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from conspiracies.corpusprocessing.aggregation import TripletAggregator
+from conspiracies.corpusprocessing.clustering import Mappings
+from conspiracies.corpusprocessing.triplet import Triplet, TripletField
+from conspiracies.corpusprocessing.triplet_table import (
+    TripletTable,
+    pack_strings,
+    unpack_strings,
+)
+
+
+def triplet(subject, predicate, obj, doc=None, timestamp=None, head=None):
+    return Triplet(
+        subject=TripletField(text=subject, head=head),
+        predicate=TripletField(text=predicate),
+        object=TripletField(text=obj, head=head),
+        doc=doc,
+        timestamp=timestamp,
+    )
+
+
+@pytest.fixture
+def triplets():
+    return [
+        triplet("Regeringen", "vil", "skatten", "1", datetime(2020, 1, 1, 10), "reg"),
+        triplet("Ministeren", "sagde", "nej", "1", datetime(2020, 1, 2)),
+        triplet("regeringen", "vil ikke", "noget", "2", None, "her"),
+        triplet("Folketinget", "vedtog", "loven", None, datetime(2019, 5, 5)),
+        triplet("Regeringen", "vil", "Regeringen", "3", datetime(2020, 3, 1), "reg"),
+    ]
+
+
+def test_round_trip(triplets, tmp_path):
+    cet = timezone(timedelta(hours=1))
+    triplets.append(
+        triplet("Ministeren", "sagde", "ja", "4", datetime(2020, 1, 2, tzinfo=cet)),
+    )
+    table = TripletTable.from_triplets(triplets)
+    assert len(table) == 6
+    assert table.datetimes()[-1].utcoffset() == timedelta(hours=1)
+    assert list(table.iter_triplets()) == triplets
+    # strings are interned
+    assert table.subject[0] == table.subject[4] == table.object[4]
+    assert len(table.strings) == len(set(table.strings))
+
+    table.save(tmp_path / "triplets.npz")
+    assert TripletTable.load(tmp_path / "triplets.npz") == table
+
+
+def test_from_annotated_docs():
+    path = Path(__file__).parent / "test_data" / "triplets.jsonl"
+    table = TripletTable.from_annotated_docs(path)
+    assert list(table.iter_triplets()) == list(Triplet.from_annotated_docs(path))
+
+
+def test_filter_on_stopwords(triplets):
+    table = TripletTable.from_triplets(triplets).filter_on_stopwords("da")
+    expected = Triplet.filter_on_stopwords(triplets, "da")
+    assert len(expected) < len(triplets)
+    assert list(table.iter_triplets()) == expected
+
+
+def test_fields_share_objects(triplets):
+    fields = TripletTable.from_triplets(triplets).fields("subject")
+    assert [field.text for field in fields] == [t.subject.text for t in triplets]
+    assert fields[0] is fields[4]
+    assert fields[0] is not fields[2]
+
+
+def test_map_and_aggregate(triplets):
+    mappings = Mappings(
+        entities={"regeringen": "Regeringen", "Ministeren": "Regeringen"},
+        predicates={"vil ikke": "vil"},
+    )
+    table = TripletTable.from_triplets(triplets).map(
+        mappings.entities,
+        mappings.predicates,
+    )
+    assert table.text("subject").tolist()[:3] == ["Regeringen"] * 3
+    assert table.text("predicate").tolist()[2] == "vil"
+    assert np.all(table.subject_head == -1)
+    # the head columns are separate arrays
+    table.subject_head[0] = 0
+    assert table.object_head[0] == table.predicate_head[0] == -1
+
+    aggregator = TripletAggregator(mappings)
+    stats = aggregator.aggregate(triplets)
+    assert stats == aggregator.aggregate(TripletTable.from_triplets(triplets))
+    assert stats.triplets[("Regeringen", "vil", "skatten")]["frequency"] == 1
+    assert stats.entities["Regeringen"]["frequency"] == 3
+    assert stats.entities["Regeringen"]["first_occurrence"] == "2020-01-01T10:00:00"
+    assert stats.predicates["vil"]["frequency"] == 2
+
+
+def test_isoformats():
+    timestamps = [
+        None,
+        datetime(2020, 1, 1, 10),
+        datetime(2020, 1, 1, 10, 0, 0, 250),
+        datetime(1969, 12, 31, 23, 59, 59, 999999),
+        datetime(2020, 1, 1, 23, 30, tzinfo=timezone(timedelta(hours=5, minutes=30))),
+        datetime(2020, 1, 1, 0, 15, tzinfo=timezone(timedelta(hours=-3))),
+        datetime(2020, 1, 1, tzinfo=timezone.utc),
+    ]
+    table = TripletTable.from_triplets(
+        triplet("a", "b", "c", timestamp=timestamp) for timestamp in timestamps
+    )
+    assert table.isoformats() == [
+        None if timestamp is None else timestamp.isoformat() for timestamp in timestamps
+    ]
+    assert table.isoformats(np.array([2, 0])) == [timestamps[2].isoformat(), None]
+
+
+def test_pack_strings():
+    strings = ["", "a", "æøå " * 1000, "b"]
+    buffer, offsets = pack_strings(strings)
+    assert buffer.dtype == np.uint8
+    assert len(buffer) == len("".join(strings).encode("utf-8"))
+    assert unpack_strings(buffer, offsets) == strings
+    assert unpack_strings(*pack_strings([])) == []
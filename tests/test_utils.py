@@ -1,12 +1,17 @@
+from datetime import datetime
 from pathlib import Path
 
 import pytest
 import spacy
-from conspiracies import docs_from_jsonl, docs_to_jsonl
+from conspiracies import docs_from_jsonl, docs_to_jsonl, iter_docs_from_jsonl
 from conspiracies.docprocessing.relationextraction.gptprompting import (
     DocTriplets,
     SpanTriplet,
 )
+from conspiracies.docprocessing.relationextraction.data_classes import (
+    install_extensions,
+)
+from conspiracies.document import Document
 from spacy.tokens import Doc
 
 from .utils import docs_with_triplets  # noqa: F401
@@ -58,3 +63,63 @@ def test_docs_to_jsonl(nlp, docs_with_triplets):  # noqa: F811
 
     # clean up by removing the file
     Path("test.jsonl").unlink()
+
+
+def test_docs_jsonl_round_trip(nlp, tmp_path):
+    install_extensions(force=True)
+    doc = nlp("this is a test . the test seems cool")
+    doc._.relation_triplets = [
+        SpanTriplet.from_tuple((doc[0:1], doc[1:2], doc[2:4])),
+        SpanTriplet.from_tuple((doc[5:7], doc[7:8], doc[8:9])),
+    ]
+    empty_doc = nlp("nothing here")
+    empty_doc._.relation_triplets = []
+
+    docs_to_jsonl([doc, empty_doc], tmp_path / "docs.jsonl")
+    _docs = docs_from_jsonl(tmp_path / "docs.jsonl", nlp=nlp)
+
+    assert [_doc.text for _doc in _docs] == [doc.text, empty_doc.text]
+    assert _docs[0]._.relation_triplets == doc._.relation_triplets
+    assert len(_docs[1]._.relation_triplets) == 0
+
+
+def test_iter_docs_from_jsonl(nlp, tmp_path):
+    install_extensions(force=True)
+    docs = []
+    for i in range(10):
+        doc = nlp(f"this is test number {i} .")
+        doc._.relation_triplets = [
+            SpanTriplet.from_tuple((doc[0:1], doc[1:2], doc[2:5])),
+        ]
+        document = Document(
+            id=str(i),
+            metadata={},
+            text=doc.text,
+            timestamp=datetime(2020, 1, 1 + i),
+        )
+        docs.append((doc, document))
+    path = tmp_path / "docs.jsonl"
+    docs_to_jsonl(docs, path)
+
+    _docs = iter_docs_from_jsonl(path, nlp)
+    assert not isinstance(_docs, list)
+    expected = [doc.text for doc, _ in docs]
+    assert [_doc.text for _doc in _docs] == expected
+
+    parallel_docs = list(iter_docs_from_jsonl(path, nlp, n_process=2, batch_size=3))
+    assert [_doc.text for _doc in parallel_docs] == expected
+    assert all(_doc.vocab is nlp.vocab for _doc in parallel_docs)
+    assert [_doc._.relation_triplets for _doc in parallel_docs] == [
+        doc._.relation_triplets for doc, _ in docs
+    ]
+
+    for n_process in [1, 2]:
+        filtered = iter_docs_from_jsonl(
+            path,
+            nlp,
+            ids={"1", "2", "3", "8"},
+            start=datetime(2020, 1, 3),
+            end=datetime(2020, 1, 9),
+            n_process=n_process,
+        )
+        assert [_doc.text for _doc in filtered] == [expected[2], expected[3]]
@@ -4,6 +4,7 @@ export interface Stats {
     frequency: number;
     norm_frequency?: number;
     docs?: string[];
+    n_docs?: number;
     first_occurrence?: string;
     last_occurrence?: string;
     alt_labels?: string[];
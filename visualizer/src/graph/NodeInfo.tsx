@@ -24,7 +24,11 @@ export const NodeInfo: React.FC<NodeInfoProps> = ({node, className}: NodeInfoPro
             }
             {stats.docs &&
                 <details>
-                    <summary>Documents</summary>
+                    <summary>
+                        Documents
+                        {stats.n_docs !== undefined && stats.n_docs > stats.docs.length &&
+                            ` (${stats.docs.length} of ${stats.n_docs})`}
+                    </summary>
                     <ul>{stats.docs.map(d => <li key={d}>{d}</li>)}</ul>
                 </details>
             }